@@ -0,0 +1,366 @@
+import datetime
+import json
+import os
+import re
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+DEFAULT_PER_PAGE = 30
+EPOCH = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def timestamp(offset_minutes):
+    return (EPOCH + datetime.timedelta(minutes=offset_minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakeGitHubState:
+    """Organizations, repositories, labels and issues served by the fake API, with request counters.
+
+    Repositories created through the API get a bare repository under git_root, where the
+    git server serves them, so a restore can push to them."""
+
+    def __init__(self, git_root, latency=0.0, rate_limit=5000, rate_limit_every=0, retry_after=1):
+        self.git_root = git_root
+        self.rate_limit = rate_limit
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.organizations = {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.rate_limited = 0
+        self.next_id = 1
+        self.migrations = {}
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def add_organization(self, org):
+        self.organizations.setdefault(org, {})
+
+    def add_repository(self, org, name, labels=(), issues=()):
+        self.add_organization(org)
+        self.organizations[org][name] = {
+            "id": self.new_id(),
+            "name": name,
+            "description": f"Synthetic repository {name}",
+            "homepage": "https://example.com",
+            "language": "Python",
+            "default_branch": "main",
+            "created_at": timestamp(0),
+            "updated_at": timestamp(1),
+            "pushed_at": timestamp(1),
+            "labels": list(labels),
+            "issues": list(issues)
+        }
+        return self.organizations[org][name]
+
+    def counters(self):
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "bytes": self.bytes_sent, "rate_limited": self.rate_limited,
+                    "by_endpoint": dict(self.requests)}
+
+
+def make_issues(count, labels):
+    return [{
+        "number": number,
+        "title": f"Issue {number}",
+        "body": f"Synthetic issue {number}\n" * 4,
+        "state": "closed" if number % 3 == 0 else "open",
+        "created_at": timestamp(number),
+        "updated_at": timestamp(number + 60),
+        "closed_at": timestamp(number + 60) if number % 3 == 0 else None,
+        "user": "octocat",
+        "labels": [labels[number % len(labels)]["name"]] if labels else []
+    } for number in range(count, 0, -1)]
+
+
+def write_migration_archive(state, org, names, path):
+    """Write the tar.gz GitHub exports for a migration: numbered JSON files per model, the
+    records pointing at each other by github.com URL, and a bare git repository per repository."""
+    web_url = "https://github.invalid"
+    repositories, issues = [], []
+    for name in names:
+        repository = state.organizations[org][name]
+        repository_url = f"{web_url}/{org}/{name}"
+        repositories.append({
+            "type": "repository", "url": repository_url, "owner": f"{web_url}/{org}", "name": name,
+            "description": repository["description"], "website": repository["homepage"], "private": True,
+            "created_at": repository["created_at"].replace("Z", ".000+00:00"), "default_branch": repository["default_branch"],
+            "git_url": f"tarball://root/repositories/{org}/{name}.git",
+            "labels": [{"type": "label", "url": f"{repository_url}/labels/{label['name']}", "name": label["name"], "color": label["color"]}
+                       for label in repository["labels"]]
+        })
+        issues.extend({
+            "type": "issue", "url": f"{repository_url}/issues/{issue['number']}", "repository": repository_url,
+            "user": f"{web_url}/{issue['user']}", "title": issue["title"], "body": issue["body"],
+            "labels": [f"{repository_url}/labels/{label}" for label in issue["labels"]],
+            "closed_at": issue["closed_at"], "created_at": issue["created_at"], "updated_at": issue["updated_at"]
+        } for issue in repository["issues"])
+
+    with tarfile.open(path, "w:gz") as archive:
+        for file_name, records in (("schema.json", {"version": "1.2.0"}), ("repositories_000001.json", repositories),
+                                   ("issues_000001.json", issues)):
+            with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+                json.dump(records, file)
+                file.flush()
+                archive.add(file.name, file_name)
+        for name in names:
+            git_dir = os.path.join(state.git_root, org, f"{name}.git")
+            if os.path.isdir(git_dir):
+                archive.add(git_dir, f"repositories/{org}/{name}.git")
+
+
+def make_labels(count):
+    return [{"name": f"label-{index}", "color": f"{index * 1103 % 0xffffff:06x}"} for index in range(count)]
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    """The subset of the REST API the backup and restore scripts use."""
+
+    protocol_version = "HTTP/1.1"
+    state = None
+    routes = [
+        ("GET", r"^/orgs/(?P<org>[^/]+)$", "get_organization"),
+        ("GET", r"^/orgs/(?P<org>[^/]+)/repos$", "list_repositories"),
+        ("POST", r"^/orgs/(?P<org>[^/]+)/repos$", "create_repository"),
+        ("GET", r"^/repos/(?P<org>[^/]+)/(?P<repo>[^/]+)$", "get_repository"),
+        ("PATCH", r"^/repos/(?P<org>[^/]+)/(?P<repo>[^/]+)$", "edit_repository"),
+        ("GET", r"^/repos/(?P<org>[^/]+)/(?P<repo>[^/]+)/labels$", "list_labels"),
+        ("POST", r"^/repos/(?P<org>[^/]+)/(?P<repo>[^/]+)/labels$", "create_label"),
+        ("GET", r"^/repos/(?P<org>[^/]+)/(?P<repo>[^/]+)/issues$", "list_issues"),
+        ("POST", r"^/repos/(?P<org>[^/]+)/(?P<repo>[^/]+)/issues$", "create_issue"),
+        ("POST", r"^/orgs/(?P<org>[^/]+)/migrations$", "start_migration"),
+        ("GET", r"^/orgs/(?P<org>[^/]+)/migrations/(?P<migration_id>\d+)$", "get_migration"),
+        ("GET", r"^/orgs/(?P<org>[^/]+)/migrations/(?P<migration_id>\d+)/archive$", "get_migration_archive"),
+        ("DELETE", r"^/orgs/(?P<org>[^/]+)/migrations/(?P<migration_id>\d+)/archive$", "delete_migration_archive"),
+        ("GET", r"^/migration_archives/(?P<migration_id>\d+)\.tar\.gz$", "download_migration_archive"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def base_url(self):
+        return f"http://{self.headers['Host']}"
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        state = self.state
+        with state.lock:
+            state.bytes_sent += len(body)
+            remaining = max(state.rate_limit - sum(state.requests.values()), 0)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Limit", str(self.state.rate_limit))
+        self.send_header("X-RateLimit-Remaining", str(remaining))
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        self.send_header("X-RateLimit-Resource", "core")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path, content_type):
+        size = os.path.getsize(path)
+        with self.state.lock:
+            self.state.bytes_sent += size
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        with open(path, "rb") as file:
+            while chunk := file.read(1024 * 1024):
+                self.wfile.write(chunk)
+
+    def send_redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern, url.path)
+            if route_method == method and match:
+                with self.state.lock:
+                    self.state.requests[f"{method} {handler}"] += 1
+                    count = sum(self.state.requests.values())
+                    limited = self.state.rate_limit_every and count % self.state.rate_limit_every == 0
+                    if limited:
+                        self.state.rate_limited += 1
+                if limited:
+                    self.send_json(403, {"message": "You have exceeded a secondary rate limit."}, {"Retry-After": str(self.state.retry_after)})
+                    return
+                try:
+                    getattr(self, handler)(query=query, body=body, path=url.path, **match.groupdict())
+                except KeyError:
+                    self.send_json(404, {"message": "Not Found"})
+                return
+        self.send_json(404, {"message": "Not Found"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def paginate(self, items, query, path):
+        per_page = int(query.get("per_page", DEFAULT_PER_PAGE))
+        page = int(query.get("page", 1))
+        last_page = max(1, -(-len(items) // per_page))
+        links = []
+        if page < last_page:
+            links.append(f'<{self.base_url}{path}?{urlencode(dict(query, page=page + 1))}>; rel="next"')
+            links.append(f'<{self.base_url}{path}?{urlencode(dict(query, page=last_page))}>; rel="last"')
+        self.send_json(200, items[(page - 1) * per_page:page * per_page], {"Link": ", ".join(links)} if links else None)
+
+    def organization_payload(self, org):
+        return {"login": org, "id": 1, "description": f"Synthetic organization {org}", "blog": "https://example.com",
+                "location": "Localhost", "url": f"{self.base_url}/orgs/{org}"}
+
+    def repository_payload(self, org, repository):
+        payload = {key: value for key, value in repository.items() if key not in ("labels", "issues")}
+        payload.update(full_name=f"{org}/{repository['name']}", private=True, owner={"login": org},
+                       url=f"{self.base_url}/repos/{org}/{repository['name']}")
+        return payload
+
+    def issue_payload(self, org, repo, issue):
+        payload = dict(issue)
+        payload.update(id=issue["number"], user={"login": issue["user"]},
+                       labels=[{"name": name, "color": "ededed"} for name in issue["labels"]],
+                       url=f"{self.base_url}/repos/{org}/{repo}/issues/{issue['number']}",
+                       html_url=f"http://github.invalid/{org}/{repo}/issues/{issue['number']}")
+        return payload
+
+    def get_organization(self, org, **kwargs):
+        self.state.organizations[org]
+        self.send_json(200, self.organization_payload(org))
+
+    def list_repositories(self, org, query, path, **kwargs):
+        repositories = [self.repository_payload(org, repository) for name, repository in sorted(self.state.organizations[org].items())]
+        self.paginate(repositories, query, path)
+
+    def create_repository(self, org, body, **kwargs):
+        repository = self.state.add_repository(org, body["name"])
+        repository["description"] = body.get("description")
+        subprocess.run(["git", "init", "--bare", "--quiet", "--initial-branch=main",
+                        os.path.join(self.state.git_root, org, f"{body['name']}.git")], check=True)
+        self.send_json(201, self.repository_payload(org, repository))
+
+    def get_repository(self, org, repo, **kwargs):
+        self.send_json(200, self.repository_payload(org, self.state.organizations[org][repo]))
+
+    def edit_repository(self, org, repo, body, **kwargs):
+        repository = self.state.organizations[org][repo]
+        repository.update({key: value for key, value in body.items() if key in ("description", "homepage", "default_branch")})
+        self.send_json(200, self.repository_payload(org, repository))
+
+    def list_labels(self, org, repo, query, path, **kwargs):
+        self.paginate(self.state.organizations[org][repo]["labels"], query, path)
+
+    def create_label(self, org, repo, body, **kwargs):
+        label = {"name": body["name"], "color": body["color"]}
+        self.state.organizations[org][repo]["labels"].append(label)
+        self.send_json(201, label)
+
+    def list_issues(self, org, repo, query, path, **kwargs):
+        issues = self.state.organizations[org][repo]["issues"]
+        if query.get("state", "open") != "all":
+            issues = [issue for issue in issues if issue["state"] == query.get("state", "open")]
+        if query.get("since"):
+            issues = [issue for issue in issues if issue["updated_at"] >= query["since"]]
+        self.paginate([self.issue_payload(org, repo, issue) for issue in issues], query, path)
+
+    def create_issue(self, org, repo, body, **kwargs):
+        with self.state.lock:
+            issues = self.state.organizations[org][repo]["issues"]
+            number = max((issue["number"] for issue in issues), default=0) + 1
+            issue = {"number": number, "title": body["title"], "body": body.get("body"), "state": "open",
+                     "created_at": timestamp(number), "updated_at": timestamp(number), "closed_at": None,
+                     "user": "octocat", "labels": body.get("labels", [])}
+            issues.insert(0, issue)
+        self.send_json(201, self.issue_payload(org, repo, issue))
+
+    def migration_payload(self, org, migration):
+        return {"id": migration["id"], "state": migration["state"], "lock_repositories": False, "exclude_attachments": True,
+                "repositories": [self.repository_payload(org, self.state.organizations[org][name]) for name in migration["repositories"]],
+                "url": f"{self.base_url}/orgs/{org}/migrations/{migration['id']}"}
+
+    def start_migration(self, org, body, **kwargs):
+        for name in body["repositories"]:
+            self.state.organizations[org][name]
+        migration = {"id": self.state.new_id(), "org": org, "state": "pending", "repositories": list(body["repositories"]), "archive": None}
+        self.state.migrations[migration["id"]] = migration
+        self.send_json(201, self.migration_payload(org, migration))
+
+    def get_migration(self, org, migration_id, **kwargs):
+        migration = self.state.migrations[int(migration_id)]
+        # Every check moves the export a step forward, pending, exporting then exported
+        if migration["state"] == "pending":
+            migration["state"] = "exporting"
+        elif migration["state"] == "exporting":
+            migration["archive"] = os.path.join(self.state.git_root, f"migration_{migration['id']}.tar.gz")
+            write_migration_archive(self.state, org, migration["repositories"], migration["archive"])
+            migration["state"] = "exported"
+        self.send_json(200, self.migration_payload(org, migration))
+
+    def get_migration_archive(self, org, migration_id, **kwargs):
+        migration = self.state.migrations[int(migration_id)]
+        if migration["state"] != "exported":
+            raise KeyError(migration_id)
+        self.send_redirect(f"{self.base_url}/migration_archives/{migration['id']}.tar.gz")
+
+    def delete_migration_archive(self, org, migration_id, **kwargs):
+        migration = self.state.migrations[int(migration_id)]
+        os.remove(migration["archive"])
+        migration.update(state="deleted", archive=None)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def download_migration_archive(self, migration_id, **kwargs):
+        self.send_file(self.state.migrations[int(migration_id)]["archive"], "application/gzip")
+
+
+class FakeGitHubServer:
+    """A local stand-in for the GitHub REST API, served from a background thread."""
+
+    def __init__(self, state):
+        self.state = state
+        handler = type("BoundFakeGitHubHandler", (FakeGitHubHandler,), {"state": state})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
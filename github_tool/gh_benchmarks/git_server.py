@@ -0,0 +1,72 @@
+import os
+import socket
+import subprocess
+import time
+
+FILES_PER_REPOSITORY = 10
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class GitDaemon:
+    """git daemon serving every repository under root over git://, pushes included."""
+
+    def __init__(self, root):
+        self.root = root
+        self.port = free_port()
+        self.url = f"git://127.0.0.1:{self.port}"
+        self.process = None
+
+    def start(self, timeout=10):
+        os.makedirs(self.root, exist_ok=True)
+        self.process = subprocess.Popen(["git", "daemon", "--reuseaddr", "--export-all", "--enable=receive-pack",
+                                         f"--base-path={self.root}", "--listen=127.0.0.1", f"--port={self.port}", self.root],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.2):
+                    return self
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("git daemon did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+def make_synthetic_repository(path, commits, file_kb, branches=1, tags=1):
+    """Create a bare repository of commits commits, each rewriting one of a few files with
+    file_kb of random, incompressible data, with extra branches and tags along the history."""
+    subprocess.run(["git", "init", "--bare", "--quiet", "--initial-branch=main", path], check=True)
+    stream = []
+    for number in range(1, commits + 1):
+        data = os.urandom(file_kb * 1024)
+        message = f"Commit {number}\n".encode()
+        stream.append(b"blob\nmark :%d\ndata %d\n%s\n" % (number * 2, len(data), data))
+        stream.append(b"commit refs/heads/main\nmark :%d\n" % (number * 2 + 1))
+        stream.append(b"author Bench <bench@example.com> %d +0000\n" % (1672531200 + number * 60))
+        stream.append(b"committer Bench <bench@example.com> %d +0000\n" % (1672531200 + number * 60))
+        stream.append(b"data %d\n%s" % (len(message), message))
+        if number > 1:
+            stream.append(b"from :%d\n" % (number * 2 - 1))
+        stream.append(b"M 100644 :%d file_%d.bin\n\n" % (number * 2, number % FILES_PER_REPOSITORY))
+    for index in range(1, branches):
+        stream.append(b"reset refs/heads/branch-%d\nfrom :%d\n\n" % (index, max(1, commits * index // branches) * 2 + 1))
+    for index in range(tags):
+        stream.append(b"reset refs/tags/v%d\nfrom :%d\n\n" % (index + 1, max(1, commits * (index + 1) // tags) * 2 + 1))
+    subprocess.run(["git", "--git-dir", path, "fast-import", "--quiet"], input=b"".join(stream), check=True)
+    return path
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(path) for file in files)
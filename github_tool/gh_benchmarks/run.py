@@ -0,0 +1,192 @@
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from unittest import mock
+
+from gh_benchmarks.fake_github import FakeGitHubServer, FakeGitHubState, make_issues, make_labels
+from gh_benchmarks.git_server import GitDaemon, directory_size, make_synthetic_repository
+from gh_common.archive import ARCHIVE_FORMATS, parse_archive_name
+from gh_common.ratelimit import configure_default_governor
+from gh_repo_backup import backup
+from gh_repo_restore import restore
+
+SOURCE_ORG = "bench-org"
+RESTORED_ORG = "bench-restored"
+TOKEN = "benchmark-token"
+# Metrics where a larger value is an improvement, the others are costs
+HIGHER_IS_BETTER = ("repos_per_minute",)
+
+
+def get_commit():
+    result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip() or None
+
+
+def list_refs(git_dir):
+    output = subprocess.run(["git", "--git-dir", git_dir, "for-each-ref", "--format=%(objectname) %(refname)"],
+                            capture_output=True, text=True, check=True).stdout
+    return sorted(output.splitlines())
+
+
+def measure_phase(state, repositories, run):
+    before = state.counters()
+    started = time.monotonic()
+    # The scripts print a line per object, the results are the only output of a benchmark
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = run()
+    seconds = time.monotonic() - started
+    after = state.counters()
+    api_calls = after["requests"] - before["requests"]
+    phase = {
+        "seconds": round(seconds, 3),
+        "repositories": repositories,
+        "repos_per_minute": round(repositories * 60 / seconds, 2) if seconds else None,
+        "api_calls": api_calls,
+        "api_calls_per_repo": round(api_calls / repositories, 2) if repositories else None,
+        "api_bytes": after["bytes"] - before["bytes"],
+        "rate_limited_responses": after["rate_limited"] - before["rate_limited"],
+        "api_calls_by_endpoint": {endpoint: count - before["by_endpoint"].get(endpoint, 0)
+                                  for endpoint, count in sorted(after["by_endpoint"].items())
+                                  if count != before["by_endpoint"].get(endpoint, 0)}
+    }
+    # The backup reports where its time went, stage by stage
+    if isinstance(report, dict) and "stages" in report:
+        phase["stages"] = report["stages"]
+    return phase
+
+
+def run_benchmark(repositories=5, issues=50, labels=5, commits=20, file_kb=64, branches=2, tags=2, latency_ms=0,
+                  rate_limit=1000000, rate_limit_every=0, workers=4, backup_format="zip", issues_format="json",
+                  run_restore=True, work_dir=None, rerun_unchanged=None, export_engine="rest", migration=False, archive_format="zip"):
+    """Back up, then restore, a synthetic organization served by a local fake GitHub API and git daemon.
+
+    Returns the machine readable results: parameters, per phase timings, API calls and
+    bytes, and the peak RSS of the process and of the git subprocesses. With rerun_unchanged,
+    an unchanged mode of the backup, the backup is run a second time with nothing changed.
+    With migration, the backup goes through organization migration exports."""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="gh_benchmark_")
+    git_root = os.path.join(work_dir, "git")
+    output_dir = os.path.join(work_dir, "backups")
+    parameters = {key: value for key, value in locals().items() if key not in ("work_dir", "git_root", "output_dir")}
+
+    state = FakeGitHubState(git_root, latency_ms / 1000.0, rate_limit, rate_limit_every)
+    repository_labels = make_labels(labels)
+    for index in range(repositories):
+        name = f"repo-{index}"
+        make_synthetic_repository(os.path.join(git_root, SOURCE_ORG, f"{name}.git"), commits, file_kb, branches, tags)
+        state.add_repository(SOURCE_ORG, name, repository_labels, make_issues(issues, repository_labels))
+    state.add_organization(RESTORED_ORG)
+
+    daemon = GitDaemon(git_root).start()
+    server = FakeGitHubServer(state).start()
+    # The rate limit headers of the fake API pace the run, the local governor only adds the write interval when asked to
+    configure_default_governor(requests_per_hour=rate_limit, write_interval=0, writes_per_hour=None, backoff_base=0.1)
+    environment = {"GITHUB_API_URL": server.url, "GITHUB_SERVER_URL": daemon.url}
+
+    results = {
+        "commit": get_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "parameters": parameters,
+        "source_git_bytes": directory_size(os.path.join(git_root, SOURCE_ORG)),
+        "phases": {}
+    }
+
+    def run_backup(unchanged="backup"):
+        if migration:
+            return backup.backup_organization_migration(SOURCE_ORG, TOKEN, output_dir, workers=workers, poll_interval=0, archive_format=archive_format)
+        return backup.backup_organization_resources(
+            SOURCE_ORG, TOKEN, output_dir, include_labels=True, include_issues=True, repo_clone=True, workers=workers,
+            mirror_cache_dir=os.path.join(output_dir, ".mirror_cache"), backup_format=backup_format, issues_format=issues_format,
+            unchanged=unchanged, export_engine=export_engine, archive_format=archive_format)
+
+    try:
+        with mock.patch.dict(os.environ, environment):
+            results["phases"]["backup"] = measure_phase(state, repositories, run_backup)
+            if rerun_unchanged:
+                results["phases"]["backup_unchanged"] = measure_phase(state, repositories, lambda: run_backup(rerun_unchanged))
+            archives = [os.path.join(output_dir, SOURCE_ORG, file) for file in os.listdir(os.path.join(output_dir, SOURCE_ORG)) if parse_archive_name(file)]
+            results["phases"]["backup"]["archive_bytes"] = sum(os.path.getsize(archive) for archive in archives)
+
+            if run_restore:
+                report_file = os.path.join(work_dir, "restore_report.json")
+                results["phases"]["restore"] = measure_phase(state, repositories, lambda: restore.restore_organization_archives(
+                    RESTORED_ORG, TOKEN, os.path.join(output_dir, SOURCE_ORG), repo_workers=workers, report_file=report_file))
+                results["phases"]["restore"]["pushed_git_bytes"] = directory_size(os.path.join(git_root, RESTORED_ORG))
+                restored = sum(list_refs(os.path.join(git_root, SOURCE_ORG, f"repo-{index}.git")) ==
+                               list_refs(os.path.join(git_root, RESTORED_ORG, f"repo-{index}.git"))
+                               for index in range(repositories) if os.path.exists(os.path.join(git_root, RESTORED_ORG, f"repo-{index}.git")))
+                results["phases"]["restore"]["repositories_verified"] = restored
+                results["phases"]["restore"]["issues_restored"] = sum(len(repository["issues"]) for repository in state.organizations[RESTORED_ORG].values())
+    finally:
+        server.stop()
+        daemon.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Children are forked from the process, their peak is at least its size at the time of the fork
+    results["peak_rss_kb"] = {
+        "process": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "subprocesses": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+    return results
+
+
+def compare_results(baseline, results):
+    """Relative change of every phase metric against a baseline run, positive is an improvement."""
+    changes = {}
+    for phase, metrics in results["phases"].items():
+        for metric, value in metrics.items():
+            previous = baseline.get("phases", {}).get(phase, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+                continue
+            change = (value - previous) / previous
+            changes[f"{phase}.{metric}"] = round(change if metric in HIGHER_IS_BETTER else -change, 4)
+    return changes
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Benchmark the backup and restore of a synthetic organization against a local fake GitHub.')
+    parser.add_argument('--repos', type=int, default=5, help='Number of repositories of the organization')
+    parser.add_argument('--issues', type=int, default=50, help='Issues per repository')
+    parser.add_argument('--labels', type=int, default=5, help='Labels per repository')
+    parser.add_argument('--commits', type=int, default=20, help='Commits per repository')
+    parser.add_argument('--file_kb', type=int, default=64, help='Random data written by every commit, in KB')
+    parser.add_argument('--branches', type=int, default=2, help='Branches per repository')
+    parser.add_argument('--tags', type=int, default=2, help='Tags per repository')
+    parser.add_argument('--latency_ms', type=int, default=0, help='Latency added to every API response')
+    parser.add_argument('--rate_limit', type=int, default=1000000, help='Hourly quota announced by the fake API rate limit headers')
+    parser.add_argument('--rate_limit_every', type=int, default=0, help='Answer every Nth API request with a 403 and Retry-After')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Repositories backed up and restored concurrently')
+    parser.add_argument('-f', '--backup_format', type=str, choices=backup.BACKUP_FORMATS, default="zip")
+    parser.add_argument('-if', '--issues_format', type=str, choices=backup.ISSUES_FORMATS, default="json")
+    parser.add_argument('-e', '--export_engine', type=str, choices=backup.EXPORT_ENGINES, default="rest")
+    parser.add_argument('-af', '--archive_format', type=str, choices=ARCHIVE_FORMATS, default="zip")
+    parser.add_argument('-mg', '--migration', action='store_true', help='Back up through organization migration exports')
+    parser.add_argument('--no_restore', action='store_true', help='Only benchmark the backup')
+    parser.add_argument('--rerun_unchanged', type=str, choices=backup.UNCHANGED_MODES, help='Run the backup a second time, with nothing changed, in this unchanged mode')
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', type=str, help='Results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repos, args.issues, args.labels, args.commits, args.file_kb, args.branches, args.tags, args.latency_ms,
+                            args.rate_limit, args.rate_limit_every, args.workers, args.backup_format, args.issues_format, not args.no_restore,
+                            rerun_unchanged=args.rerun_unchanged, export_engine=args.export_engine, migration=args.migration,
+                            archive_format=args.archive_format)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            results["compared_to"] = {"commit": json.load(file).get("commit")}
+            file.seek(0)
+            results["changes"] = compare_results(json.load(file), results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,52 @@
+import shutil
+import unittest
+
+from gh_benchmarks.run import compare_results, run_benchmark
+
+
+@unittest.skipUnless(shutil.which("git"), "git is required to serve the synthetic repositories")
+class TestBenchmark(unittest.TestCase):
+
+    def test_backup_and_restore_of_a_synthetic_organization(self):
+        results = run_benchmark(repositories=2, issues=10, labels=2, commits=3, file_kb=4, branches=1, tags=1, workers=2)
+
+        backup, restore = results["phases"]["backup"], results["phases"]["restore"]
+        self.assertEqual(restore["repositories_verified"], 2)
+        self.assertEqual(restore["issues_restored"], 20)
+        self.assertGreater(backup["archive_bytes"], 0)
+        self.assertGreater(restore["pushed_git_bytes"], 0)
+        # The organization, the repository listing and the labels and issues of every repository
+        self.assertNotIn("GET get_repository", backup["api_calls_by_endpoint"])
+        self.assertEqual(backup["api_calls"], 2 + 2 * 2)
+        self.assertGreater(results["peak_rss_kb"]["process"], 0)
+
+    def test_backup_through_a_migration_export_is_restored(self):
+        results = run_benchmark(repositories=2, issues=10, labels=2, commits=3, file_kb=4, branches=1, tags=1, workers=2, migration=True)
+
+        backup, restore = results["phases"]["backup"], results["phases"]["restore"]
+        self.assertEqual(restore["repositories_verified"], 2)
+        self.assertEqual(restore["issues_restored"], 20)
+        # One export for both repositories, nothing is listed per repository
+        self.assertEqual(backup["api_calls_by_endpoint"]["POST start_migration"], 1)
+        self.assertEqual(backup["api_calls_by_endpoint"]["DELETE delete_migration_archive"], 1)
+        self.assertNotIn("GET list_issues", backup["api_calls_by_endpoint"])
+
+    def test_rate_limited_responses_are_retried(self):
+        results = run_benchmark(repositories=1, issues=5, labels=1, commits=1, file_kb=1, branches=0, tags=0, rate_limit_every=4, run_restore=False)
+
+        # Every fourth request is refused, the backup still completes
+        self.assertEqual(results["phases"]["backup"]["rate_limited_responses"], 1)
+        self.assertGreater(results["phases"]["backup"]["archive_bytes"], 0)
+
+
+class TestCompareResults(unittest.TestCase):
+
+    def test_changes_are_positive_for_improvements(self):
+        baseline = {"phases": {"backup": {"seconds": 10, "repos_per_minute": 30, "api_calls": 0}}}
+        results = {"phases": {"backup": {"seconds": 5, "repos_per_minute": 60, "api_calls": 4, "api_calls_by_endpoint": {}}}}
+
+        self.assertEqual(compare_results(baseline, results), {"backup.seconds": 0.5, "backup.repos_per_minute": 1.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
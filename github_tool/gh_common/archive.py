@@ -0,0 +1,235 @@
+import collections
+import contextlib
+import datetime
+import gzip
+import os
+import re
+import shutil
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_FORMATS = ("zip", "tar.gz", "tar.zst")
+# zlib and zstd release the GIL, the blocks of an archive are compressed by threads
+ARCHIVE_WORKERS = min(4, os.cpu_count() or 1)
+COMPRESSION_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+# Already compressed content is stored in archives as it is, git packs are zlib streams
+STORED_EXTENSIONS = (".bundle", ".pack", ".gz", ".tgz", ".zip", ".zst", ".xz", ".bz2", ".7z", ".jar",
+                     ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4", ".woff2")
+# Other files are stored when the start of their content does not shrink below this ratio
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.9
+MIN_SAMPLE_SIZE = 512
+# Entries get a fixed timestamp, unchanged content gives a byte identical archive
+ARCHIVE_ENTRY_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ARCHIVE_ENTRY_MTIME = 315532800
+# <repository>_<YYYY-mm-dd>_<HH-MM-SS-microseconds>.<format>, archives of older versions only have the date
+ARCHIVE_NAME_PATTERN = re.compile(r'^(?P<repository>.+)_(?P<date>\d{4}-\d{2}-\d{2})(?:_(?P<time>\d{2}-\d{2}-\d{2}-\d{6}))?\.(?P<format>zip|tar\.gz|tar\.zst)$')
+# Extraction filters reject links and paths leaving the target, where the running Python has them
+EXTRACT_OPTIONS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+def get_archive_format(path):
+    for archive_format in ARCHIVE_FORMATS[1:]:
+        if path.endswith(f".{archive_format}"):
+            return archive_format
+    return "zip"
+
+
+def check_archive_format(archive_format):
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format {archive_format!r}, expected one of {', '.join(ARCHIVE_FORMATS)}")
+    if archive_format == "tar.zst" and zstandard is None:
+        raise RuntimeError("tar.zst archives need the zstandard package, pip install zstandard")
+
+
+def parse_archive_name(name):
+    """(repository, sort key) of an archive name, None when name is not an archive of a repository.
+
+    The sort key orders the archives of a repository from the oldest to the newest."""
+    match = ARCHIVE_NAME_PATTERN.match(os.path.basename(name))
+    if not match:
+        return None
+    return match.group("repository"), (match.group("date"), match.group("time") or "")
+
+
+def new_archive_path(directory, archive_format="zip"):
+    """Path of a new archive of directory, next to it and named after the current time.
+
+    The name is reserved by creating its temporary file, two runs of the same day, or of the
+    same second, never write the same archive."""
+    while True:
+        path = f"{directory}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')}.{archive_format}"
+        try:
+            os.close(os.open(f"{path}.partial", os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        if os.path.exists(path):
+            os.remove(f"{path}.partial")
+            continue
+        return path
+
+
+def is_incompressible(path):
+    """Whether compressing the file is wasted work: a known compressed format, or a sample that does not shrink."""
+    if path.endswith(STORED_EXTENSIONS):
+        return True
+    with open(path, "rb") as file:
+        sample = file.read(COMPRESSIBILITY_SAMPLE_SIZE)
+    if len(sample) < MIN_SAMPLE_SIZE:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+
+
+class ArchiveOutput:
+    """Write only stream copying what is written to every file given, the archive on disk and uploads.
+
+    It cannot seek, the archive writers produce the same bytes whether or not it is streamed."""
+
+    def __init__(self, *files):
+        self.files = files
+        self.position = 0
+
+    def write(self, data):
+        for file in self.files:
+            file.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        for file in self.files:
+            file.flush()
+
+
+class ParallelGzipWriter:
+    """Write only stream gzip compressing its content on several threads, as pigz does.
+
+    The content is cut in blocks of block_size, every block is compressed by a thread of the
+    pool into a gzip member of its own and the members are written to fileobj in order. A
+    gzip file of several members is a valid gzip file holding their concatenation. Blocks are
+    cut at the same offsets whatever the number of threads, and so is the output."""
+
+    def __init__(self, fileobj, level=COMPRESSION_LEVEL, workers=ARCHIVE_WORKERS, block_size=COMPRESS_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = max(1, workers) * 2
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gzip")
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def set_level(self, level):
+        """Compress what is written from now on at level, 0 stores it."""
+        if level != self.level:
+            self._submit_buffer()
+            self.level = level
+
+    def _submit_buffer(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, block, self.level, mtime=0))
+        # Compressed blocks wait in memory until the ones before them are written
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            self._submit_buffer()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def tar_entry(relative_path, full_path):
+    entry = tarfile.TarInfo(relative_path)
+    entry.size = os.path.getsize(full_path)
+    entry.mode = os.stat(full_path).st_mode & 0o7777
+    entry.mtime = ARCHIVE_ENTRY_MTIME
+    return entry
+
+
+def write_zip(directory, files, output):
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for relative_path in files:
+            full_path = os.path.join(directory, relative_path)
+            zip_info = zipfile.ZipInfo(relative_path, date_time=ARCHIVE_ENTRY_DATE_TIME)
+            zip_info.compress_type = zipfile.ZIP_STORED if is_incompressible(full_path) else zipfile.ZIP_DEFLATED
+            zip_info.external_attr = (os.stat(full_path).st_mode & 0xFFFF) << 16
+            zip_info.file_size = os.path.getsize(full_path)
+            with open(full_path, "rb") as source, zip_file.open(zip_info, "w") as target:
+                shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+
+
+def write_tar(directory, files, output, compressor=None):
+    with tarfile.open(fileobj=output, mode="w", format=tarfile.PAX_FORMAT) as tar_file:
+        for relative_path in files:
+            full_path = os.path.join(directory, relative_path)
+            if compressor is not None:
+                compressor.set_level(0 if is_incompressible(full_path) else COMPRESSION_LEVEL)
+            with open(full_path, "rb") as source:
+                tar_file.addfile(tar_entry(relative_path, full_path), source)
+
+
+def write_archive(directory, files, output, archive_format="zip", workers=ARCHIVE_WORKERS):
+    """Archive the files, relative to directory, to the write only stream output.
+
+    zip compresses every entry on the calling thread, tar.gz and tar.zst compress the blocks
+    of the whole tar on workers threads. Incompressible files are stored, except in tar.zst
+    where zstd detects them on its own and keeps their blocks raw."""
+    check_archive_format(archive_format)
+    files = sorted(files)
+    if archive_format == "zip":
+        write_zip(directory, files, output)
+    elif archive_format == "tar.gz":
+        compressor = ParallelGzipWriter(output, workers=workers)
+        try:
+            write_tar(directory, files, compressor, compressor)
+        finally:
+            compressor.close()
+    else:
+        # Multi threaded zstd gives the same frames for any number of workers above zero
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=max(1, workers), write_checksum=True)
+        with compressor.stream_writer(output, closefd=False) as writer:
+            write_tar(directory, files, writer)
+
+
+@contextlib.contextmanager
+def open_tar_archive(path):
+    """Open a tar.gz or tar.zst archive for one pass over its members, in the order they were written."""
+    if get_archive_format(path) == "tar.zst":
+        check_archive_format("tar.zst")
+        with open(path, "rb") as file, zstandard.ZstdDecompressor().stream_reader(file) as reader, \
+                tarfile.open(fileobj=reader, mode="r|") as tar_file:
+            yield tar_file
+    else:
+        # The tar stream reader stops after the first gzip member, GzipFile reads them all
+        with gzip.open(path, "rb") as file, tarfile.open(fileobj=file, mode="r|") as tar_file:
+            yield tar_file
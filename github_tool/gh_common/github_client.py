@@ -0,0 +1,119 @@
+import os
+from urllib.parse import urlsplit
+
+from github import Consts, Github
+from github.Requester import HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass
+from requests.adapters import HTTPAdapter
+
+from gh_common.metrics import record_api_response, record_api_retry
+from gh_common.ratelimit import WRITE_METHODS
+
+
+def is_write_request(request):
+    # GraphQL queries are sent with POST but create no content, they are not spaced out like writes
+    return request.method in WRITE_METHODS and not request.path_url.split("?")[0].endswith("/graphql")
+
+
+def is_idempotent_request(request):
+    # A POST or PATCH the server failed may still have created its content, it is not sent twice.
+    # GraphQL queries that fail are made smaller by the exporter instead of being sent again as they are
+    return request.method not in ("POST", "PATCH")
+
+
+class GitHubHTTPAdapter(HTTPAdapter):
+    """requests adapter pacing GitHub requests with a RateLimitGovernor and
+    revalidating GET responses against an HTTPResponseCache."""
+
+    def __init__(self, governor=None, cache=None, **kwargs):
+        self.governor = governor
+        self.cache = cache
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        cache_key = None
+        entry = None
+        if self.cache is not None and request.method == "GET" and not kwargs.get("stream"):
+            cache_key = self.cache.key(request)
+            entry = self.cache.load(cache_key)
+            if entry is not None:
+                request.headers.update(self.cache.conditional_headers(entry))
+
+        response = self._send_paced(request, **kwargs)
+
+        if entry is not None and response.status_code == 304:
+            self.cache.count(hit=True)
+            return self.cache.build_response(entry, request, response)
+        if cache_key is not None:
+            self.cache.count(hit=False)
+            if self.cache.cacheable(response):
+                self.cache.store(cache_key, response)
+        return response
+
+    def _send_counted(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # Streamed bodies are left unread, their announced length is counted
+        size = int(response.headers.get("Content-Length") or 0) if kwargs.get("stream") else len(response.content)
+        record_api_response(size)
+        return response
+
+    def _send_paced(self, request, **kwargs):
+        if self.governor is None:
+            return self._send_counted(request, **kwargs)
+        attempt = 0
+        while True:
+            self.governor.acquire(write=is_write_request(request))
+            response = self._send_counted(request, **kwargs)
+            self.governor.update(response.status_code, response.headers)
+            # Secondary rate limits are only told apart by the message of the 403, error bodies are small
+            body = response.text if response.status_code == 403 else None
+            delay = self.governor.retry_delay(response.status_code, response.headers, attempt, body, is_idempotent_request(request))
+            if delay is None:
+                return response
+            response.close()
+            record_api_retry()
+            self.governor.wait(delay)
+            attempt += 1
+
+
+def make_connection_class(base_class, governor, cache=None):
+    """PyGithub connection class whose session goes through a GitHubHTTPAdapter."""
+
+    class GitHubConnectionClass(base_class):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.adapter = GitHubHTTPAdapter(governor, cache, max_retries=self.retry,
+                                             pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self.session.mount(f"{self.protocol}://", self.adapter)
+
+    return GitHubConnectionClass
+
+
+def get_api_url():
+    # The variables GitHub Actions sets, they also point the tools at GitHub Enterprise or a local stand-in
+    return os.getenv("GITHUB_API_URL") or Consts.DEFAULT_BASE_URL
+
+
+def get_git_url(full_name, token=None):
+    """URL of the git repository full_name on the server of GITHUB_SERVER_URL, with the token when given."""
+    server_url = urlsplit(os.getenv("GITHUB_SERVER_URL") or "https://github.com")
+    if token and server_url.scheme in ("http", "https"):
+        return f"{server_url.scheme}://{token}@{server_url.netloc}{server_url.path}/{full_name}.git"
+    return f"{server_url.scheme}://{server_url.netloc}{server_url.path}/{full_name}.git"
+
+
+def build_github_client(governor=None, cache=None, **github_kwargs):
+    """Create a Github client whose API requests are paced by the given governor and
+    revalidated against the given response cache.
+
+    The governor takes over the pacing and retries PyGithub would otherwise do on its own,
+    secondary rate limits and server errors included, see RateLimitGovernor.retry_delay."""
+    github_kwargs.setdefault("base_url", get_api_url())
+    if governor is not None:
+        github_kwargs.update(retry=0, seconds_between_requests=None, seconds_between_writes=None)
+    client = Github(**github_kwargs)
+
+    if governor is not None or cache is not None:
+        base_class = HTTPRequestsConnectionClass if github_kwargs.get("base_url", "").startswith("http://") else HTTPSRequestsConnectionClass
+        # PyGithub has no public hook to wrap its session, the connection class is set per requester
+        client.requester._Requester__connectionClass = make_connection_class(base_class, governor, cache)
+    return client
@@ -0,0 +1,267 @@
+import heapq
+import logging
+import math
+import time
+from datetime import datetime
+
+from github import GithubException
+
+# GitHub charges a query one point per 100 connection requests, a page is sized to stay under this cost
+DEFAULT_MAX_QUERY_COST = 2
+MAX_PAGE_SIZE = 100
+MIN_PAGE_SIZE = 5
+# Nested connections fetched with every issue, the rare issues with more are completed by follow-up queries
+ISSUE_LABELS = 20
+COLUMN_CARDS = 50
+MAX_TIMEOUT_RETRIES = 4
+
+ISSUE_FIELDS = """
+        id number title body state createdAt updatedAt closedAt
+        author { login }
+        labels(first: $labels) { pageInfo { hasNextPage endCursor } nodes { name } }
+"""
+
+ISSUES_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String, $since: DateTime, $labels: Int!) {
+  rateLimit { cost remaining resetAt }
+  repository(owner: $owner, name: $name) {
+    issues(first: $first, after: $after, orderBy: {field: CREATED_AT, direction: DESC}, filterBy: {since: $since}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {""" + ISSUE_FIELDS + """      }
+    }
+  }
+}
+"""
+
+# The REST issue listing includes pull requests, the issues connection does not
+PULL_REQUESTS_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String, $order: IssueOrderField!, $labels: Int!) {
+  rateLimit { cost remaining resetAt }
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $first, after: $after, orderBy: {field: $order, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {""" + ISSUE_FIELDS + """      }
+    }
+  }
+}
+"""
+
+LABELS_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String) {
+  rateLimit { cost remaining resetAt }
+  repository(owner: $owner, name: $name) {
+    labels(first: $first, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name color }
+    }
+  }
+}
+"""
+
+NODE_CONNECTION_QUERY = """
+query($id: ID!, $first: Int!, $after: String) {
+  rateLimit { cost remaining resetAt }
+  node(id: $id) {
+    ... on %(type)s {
+      %(connection)s(first: $first, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes { %(fields)s }
+      }
+    }
+  }
+}
+"""
+
+CARD_FIELDS = "note content { ... on Issue { url } ... on PullRequest { url } }"
+
+PROJECT_COLUMNS_QUERY = """
+query($id: ID!, $first: Int!, $after: String, $cards: Int!) {
+  rateLimit { cost remaining resetAt }
+  node(id: $id) {
+    ... on Project {
+      columns(first: $first, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes {
+          id name
+          cards(first: $cards) { pageInfo { hasNextPage endCursor } nodes { """ + CARD_FIELDS + """ } }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def estimate_query_cost(page_size, nested_sizes=()):
+    """Rate limit points GitHub charges for a page of page_size nodes each with the nested connections."""
+    requests = 1 + page_size * len(nested_sizes)
+    return max(1, math.ceil(requests / 100))
+
+
+class PageSizer:
+    """Page size of a paginated GraphQL connection.
+
+    The page starts at the largest size whose estimated cost fits max_cost. It is halved
+    when GitHub gives up on a query (timeouts and 502s come from queries that are too
+    large) and grows back by half after every successful page."""
+
+    def __init__(self, nested_sizes=(), max_cost=DEFAULT_MAX_QUERY_COST, maximum=MAX_PAGE_SIZE, minimum=MIN_PAGE_SIZE):
+        self.minimum = minimum
+        self.maximum = maximum
+        while self.maximum > minimum and estimate_query_cost(self.maximum, nested_sizes) > max_cost:
+            self.maximum -= minimum
+        self.size = self.maximum
+
+    def shrink(self):
+        if self.size <= self.minimum:
+            return False
+        self.size = max(self.minimum, self.size // 2)
+        return True
+
+    def grow(self):
+        self.size = min(self.maximum, self.size + max(1, self.size // 2))
+
+
+def is_query_timeout(exception):
+    message = str(exception).lower()
+    return exception.status in (502, 504) or "timeout" in message or "something went wrong" in message
+
+
+class GraphQLExporter:
+    """Export engine reading issues, labels and project cards through the GraphQL API.
+
+    Queries go through the requester of a PyGithub client, so they are paced by its
+    rate limit governor like every REST request. The results use the layout of the REST
+    backup, restore.py reads both."""
+
+    def __init__(self, requester, governor=None, max_cost=DEFAULT_MAX_QUERY_COST, clock=time.time):
+        self.requester = requester
+        self.governor = governor
+        self.max_cost = max_cost
+        self.clock = clock
+        self.queries = 0
+        self.cost = 0
+
+    def query(self, query, variables):
+        headers, data = self.requester.graphql_query(query, variables)
+        rate_limit = data["data"].get("rateLimit") or {}
+        self.queries += 1
+        self.cost += rate_limit.get("cost", 0)
+        if rate_limit and rate_limit["remaining"] < rate_limit["cost"]:
+            delay = datetime.fromisoformat(rate_limit["resetAt"].replace("Z", "+00:00")).timestamp() - self.clock()
+            if delay > 0:
+                logging.warning(f"GraphQL rate limit nearly exhausted, waiting {delay:.0f}s for the reset")
+                if self.governor is not None:
+                    self.governor.wait(delay)
+                else:
+                    time.sleep(delay)
+        return data["data"]
+
+    def paginate(self, query, variables, path, nested_sizes=()):
+        """Yield the nodes of the connection found at path in the query result, page by page."""
+        sizer = PageSizer(nested_sizes, self.max_cost)
+        after = None
+        timeouts = 0
+        while True:
+            try:
+                data = self.query(query, dict(variables, first=sizer.size, after=after))
+            except GithubException as e:
+                if not is_query_timeout(e) or timeouts >= MAX_TIMEOUT_RETRIES:
+                    raise
+                timeouts += 1
+                sizer.shrink()
+                logging.warning(f"GraphQL query timed out, retrying with pages of {sizer.size}")
+                continue
+            connection = data
+            for key in path:
+                connection = connection[key]
+            yield from connection["nodes"]
+            if not connection["pageInfo"]["hasNextPage"]:
+                return
+            after = connection["pageInfo"]["endCursor"]
+            sizer.grow()
+
+    def remaining_nodes(self, node_type, node_id, connection, fields, page):
+        """Fetch the rest of a nested connection whose first page came with its parent."""
+        if not page["pageInfo"]["hasNextPage"]:
+            return page["nodes"]
+        query = NODE_CONNECTION_QUERY % {"type": node_type, "connection": connection, "fields": fields}
+        nodes = list(page["nodes"])
+        sizer = PageSizer(max_cost=self.max_cost)
+        after = page["pageInfo"]["endCursor"]
+        while after:
+            result = self.query(query, {"id": node_id, "first": sizer.size, "after": after})["node"][connection]
+            nodes.extend(result["nodes"])
+            after = result["pageInfo"]["endCursor"] if result["pageInfo"]["hasNextPage"] else None
+        return nodes
+
+    def iter_issues(self, owner, name, since=None):
+        """Yield the issues, pull requests included, of a repository as serialize_issue dicts.
+
+        Without since they come newest first, like the REST listing. pullRequests cannot be
+        filtered by update time, they are read by last update until the older ones."""
+        variables = {"owner": owner, "name": name, "labels": ISSUE_LABELS}
+        issues = (self.serialize_issue("Issue", issue) for issue in
+                  self.paginate(ISSUES_QUERY, dict(variables, since=since.isoformat() if since else None), ("repository", "issues"), (ISSUE_LABELS,)))
+        pull_requests = (self.serialize_issue("PullRequest", pull_request) for pull_request in
+                         self.paginate(PULL_REQUESTS_QUERY, dict(variables, order="UPDATED_AT" if since else "CREATED_AT"), ("repository", "pullRequests"), (ISSUE_LABELS,)))
+        if since is None:
+            yield from heapq.merge(issues, pull_requests, key=lambda issue: issue["number"], reverse=True)
+            return
+        yield from issues
+        for pull_request in pull_requests:
+            if datetime.fromisoformat(pull_request["updated_at"]) < since:
+                return
+            yield pull_request
+
+    def serialize_issue(self, node_type, issue):
+        labels = self.remaining_nodes(node_type, issue["id"], "labels", "name", issue["labels"])
+        return {
+            "number": issue["number"],
+            "title": issue["title"],
+            "body": issue["body"],
+            # A merged pull request is closed in the REST API
+            "state": "open" if issue["state"] == "OPEN" else "closed",
+            "created_at": to_isoformat(issue["createdAt"]),
+            "updated_at": to_isoformat(issue["updatedAt"]),
+            "closed_at": to_isoformat(issue["closedAt"]),
+            "user": login(issue["author"]),
+            "labels": [label["name"] for label in labels]
+        }
+
+    def get_labels(self, owner, name):
+        variables = {"owner": owner, "name": name}
+        return [{"name": label["name"], "color": label["color"]}
+                for label in self.paginate(LABELS_QUERY, variables, ("repository", "labels"))]
+
+    def get_project_columns(self, project_node_id):
+        """Columns of a classic project with the note and content url of every card."""
+        columns = []
+        variables = {"id": project_node_id, "cards": COLUMN_CARDS}
+        for column in self.paginate(PROJECT_COLUMNS_QUERY, variables, ("node", "columns"), (COLUMN_CARDS,)):
+            cards = self.remaining_nodes("ProjectColumn", column["id"], "cards", CARD_FIELDS, column["cards"])
+            columns.append({
+                "name": column["name"],
+                "cards": [serialize_card(card) for card in cards]
+            })
+        return columns
+
+    def report(self):
+        return {"queries": self.queries, "cost": self.cost}
+
+
+def serialize_card(card):
+    card_data = {"note": card["note"]}
+    if card.get("content"):
+        card_data["content_url"] = card["content"]["url"]
+    return card_data
+
+
+def to_isoformat(timestamp):
+    # The REST backup writes datetime.isoformat(), GraphQL returns the UTC Z suffix
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).isoformat() if timestamp else None
+
+
+def login(actor):
+    # Deleted accounts come back as null, the REST API reports them as ghost
+    return actor["login"] if actor else "ghost"
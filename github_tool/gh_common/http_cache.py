@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Evict down to this share of the limit, so a full cache does not evict on every store
+EVICTION_TARGET = 0.9
+
+
+class HTTPResponseCache:
+    """On-disk cache of GitHub GET responses, revalidated with ETag / Last-Modified.
+
+    A cached response is sent back with If-None-Match / If-Modified-Since. GitHub
+    answers 304 Not Modified when nothing changed, which does not count against the
+    rate limit, and the stored body is served instead. Entries are keyed by URL,
+    Accept header and a hash of the credentials. The least recently used entries are
+    evicted once the cache grows past max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def key(self, request):
+        identity = "\n".join([
+            request.url,
+            request.headers.get("Accept", ""),
+            hashlib.sha256(request.headers.get("Authorization", "").encode()).hexdigest()
+        ])
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+            # The modification time is the last use, eviction removes the oldest first
+            os.utime(path)
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, response):
+        # The body is stored decoded, the transfer headers no longer describe it
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")}
+        entry = {
+            "url": response.url,
+            "headers": headers,
+            "encoding": response.encoding,
+            "body": response.content.decode(response.encoding or "utf-8")
+        }
+        path = self._path(key)
+        partial_path = f"{path}.{threading.get_ident()}.partial"
+        with open(partial_path, "w") as file:
+            json.dump(entry, file)
+        with self.lock:
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(partial_path, path)
+            self.size += os.path.getsize(path) - previous_size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")),
+                         key=lambda entry: entry.stat().st_mtime)
+        target = self.max_bytes * EVICTION_TARGET
+        for entry in entries:
+            if self.size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                pass
+        logging.info(f"HTTP cache evicted down to {self.size} bytes")
+
+    def conditional_headers(self, entry):
+        headers = {}
+        cached_headers = CaseInsensitiveDict(entry["headers"])
+        if "ETag" in cached_headers:
+            headers["If-None-Match"] = cached_headers["ETag"]
+        if "Last-Modified" in cached_headers:
+            headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+        return headers
+
+    def build_response(self, entry, request, not_modified):
+        """200 response carrying the cached body and the fresh headers of the 304."""
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.headers.update(not_modified.headers)
+        response.encoding = entry["encoding"]
+        response._content = entry["body"].encode(entry["encoding"] or "utf-8")
+        response.url = entry["url"]
+        response.request = request
+        response.connection = not_modified.connection
+        return response
+
+    def cacheable(self, response):
+        return response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers)
+
+    def report(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self.size}
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+_default_cache = None
+
+
+def configure_default_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """Set the cache used by the clients built afterwards, None disables it."""
+    global _default_cache
+    _default_cache = HTTPResponseCache(cache_dir, max_bytes) if cache_dir else None
+    return _default_cache
+
+
+def get_default_cache():
+    return _default_cache
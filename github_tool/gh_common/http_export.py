@@ -0,0 +1,175 @@
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from github import Consts
+
+from gh_common.github_client import GitHubHTTPAdapter
+from gh_common.graphql_export import to_isoformat
+from gh_common.metrics import attributed_to, get_current_stage
+
+PER_PAGE = 100
+# Pages of a listing requested ahead of the one being consumed
+PAGE_WORKERS = 4
+REQUEST_TIMEOUT = 30
+PROJECTS_MEDIA_TYPE = "application/vnd.github.inertia-preview+json"
+
+
+def page_url(url, page):
+    """url with its page query parameter set to page."""
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query) if name != "page"] + [("page", str(page))]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def last_page(response):
+    last = response.links.get("last")
+    if last is None:
+        return None
+    return int(dict(parse_qsl(urlsplit(last["url"]).query)).get("page", 1))
+
+
+def serialize_issue(issue):
+    """The issue of a REST listing as gh_repo_backup.backup.serialize_issue writes it."""
+    return {
+        "number": issue["number"],
+        "title": issue["title"],
+        "body": issue["body"],
+        "state": issue["state"],
+        "created_at": to_isoformat(issue["created_at"]),
+        "updated_at": to_isoformat(issue["updated_at"]),
+        "closed_at": to_isoformat(issue["closed_at"]),
+        "user": issue["user"]["login"],
+        "labels": [label["name"] for label in issue["labels"]]
+    }
+
+
+class HTTPExporter:
+    """Export engine reading issues, labels and project cards with plain REST requests.
+
+    Listings are read from a keep-alive session whose pool is shared by the pages of a
+    listing, 100 items per page. Once the first page announces the last one in its Link
+    header the next pages are requested ahead by a small pool of threads, and yielded
+    in order. Items stay the decoded JSON, only the fields the backup writes are read, no
+    PyGithub object is built and none can complete itself with a hidden request.
+
+    Requests go through a GitHubHTTPAdapter, paced by the rate limit governor and
+    revalidated against the response cache of the PyGithub clients. The results are
+    those of the PyGithub export, byte for byte once written."""
+
+    def __init__(self, auth=None, governor=None, cache=None, workers=PAGE_WORKERS, per_page=PER_PAGE, user_agent=Consts.DEFAULT_USER_AGENT):
+        self.auth = auth
+        self.governor = governor
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.per_page = per_page
+        self.session = requests.Session()
+        adapter = GitHubHTTPAdapter(governor, cache, pool_connections=1, pool_maxsize=self.workers + 1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/vnd.github+json", "User-Agent": user_agent})
+        if auth is not None:
+            auth.authentication(self.session.headers)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prefetched = 0
+
+    @classmethod
+    def from_requester(cls, requester, governor=None, cache=None, **kwargs):
+        """Exporter with the credentials of a PyGithub client."""
+        return cls(requester.auth, governor, cache, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+        response.raise_for_status()
+        with self.lock:
+            self.requests += 1
+        return response
+
+    def get(self, url, params=None, headers=None):
+        return self.request("GET", url, params=params, headers=headers)
+
+    def iter_pages(self, url, params=None, headers=None):
+        """Yield the items of every page of a listing."""
+        response = self.get(url, dict(params or {}, per_page=self.per_page), headers)
+        yield from response.json()
+        pages = last_page(response)
+        if pages is None:
+            # Without a last link the pages can only be followed one after the other
+            while "next" in response.links:
+                response = self.get(response.links["next"]["url"], headers=headers)
+                yield from response.json()
+            return
+
+        stage = get_current_stage()
+
+        def fetch(page):
+            # The requests count against the stage that reads the listing
+            with attributed_to(stage):
+                return self.get(page_url(response.url, page), headers=headers).json()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="page") as executor:
+            ahead = collections.deque()
+            next_page = 2
+            while ahead or next_page <= pages:
+                while next_page <= pages and len(ahead) < self.workers:
+                    ahead.append(executor.submit(fetch, next_page))
+                    next_page += 1
+                items = ahead.popleft().result()
+                with self.lock:
+                    self.prefetched += 1
+                yield from items
+
+    def iter_issues(self, repository_url, since=None):
+        """Yield the issues, pull requests included, of the repository at the API url repository_url,
+        newest first, in the layout of serialize_issue."""
+        params = {"state": "all"}
+        if since:
+            params["since"] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        for issue in self.iter_pages(f"{repository_url}/issues", params):
+            yield serialize_issue(issue)
+
+    def get_labels(self, repository_url):
+        return [{"name": label["name"], "color": label["color"]} for label in self.iter_pages(f"{repository_url}/labels")]
+
+    def get_card_data(self, card):
+        card_data = {"note": card["note"]}
+        try:
+            if card.get("content_url"):
+                content = self.get(card["content_url"]).json()
+                card_data["content_url"] = content["html_url"]
+        except Exception as e:
+            print(f"Error while getting card data: {e}")
+        return card_data
+
+    def get_column_cards(self, column):
+        try:
+            return list(self.iter_pages(column["cards_url"], headers={"Accept": PROJECTS_MEDIA_TYPE}))
+        except Exception as e:
+            print(f"Error while getting column data: {e}")
+            return []
+
+    def get_project_columns(self, project_url):
+        """Columns of a classic project with the note and content url of every card."""
+        columns = list(self.iter_pages(f"{project_url}/columns", headers={"Accept": PROJECTS_MEDIA_TYPE}))
+        stage = get_current_stage()
+
+        def attributed(function):
+            def call(item):
+                with attributed_to(stage):
+                    return function(item)
+            return call
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="card") as executor:
+            column_cards = list(executor.map(attributed(self.get_column_cards), columns))
+            cards_data = iter(executor.map(attributed(self.get_card_data), [card for cards in column_cards for card in cards]))
+            return [{"name": column["name"], "cards": [next(cards_data) for card in cards]}
+                    for column, cards in zip(columns, column_cards)]
+
+    def report(self):
+        return {"requests": self.requests, "prefetched_pages": self.prefetched}
+
+    def close(self):
+        self.session.close()
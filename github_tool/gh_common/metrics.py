@@ -0,0 +1,216 @@
+import contextlib
+import datetime
+import logging
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+STAGE_COUNTERS = ("seconds", "cpu_seconds", "api_calls", "api_bytes", "bytes_read", "bytes_written", "retries")
+# Prometheus metric and help text of every stage counter
+PROMETHEUS_STAGE_METRICS = {
+    "seconds": ("stage_duration_seconds", "Wall time of a stage"),
+    "cpu_seconds": ("stage_cpu_seconds", "CPU time of the thread running a stage, git subprocesses excluded"),
+    "api_calls": ("stage_api_calls", "GitHub API responses received by a stage, retries included"),
+    "api_bytes": ("stage_api_bytes", "Bytes of the GitHub API responses received by a stage"),
+    "bytes_read": ("stage_read_bytes", "Bytes of local files read by a stage"),
+    "bytes_written": ("stage_written_bytes", "Bytes written by a stage, to disk or to the storage account"),
+    "retries": ("stage_retries", "GitHub API requests of a stage retried after a rate limit"),
+}
+
+_current = threading.local()
+
+
+def path_size(path):
+    """Size of a file, or of every file under a directory."""
+    if path is None or not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            full_path = os.path.join(root, name)
+            if not os.path.islink(full_path):
+                size += os.path.getsize(full_path)
+    return size
+
+
+class Stage:
+    """Counters of one stage of one repository, filled while the stage runs."""
+
+    def __init__(self, repository, name):
+        self.repository = repository
+        self.name = name
+        self.counters = dict.fromkeys(STAGE_COUNTERS, 0)
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add(self, **counters):
+        # Helper threads of the stage, see attributed_to, add to the same counters
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+
+def get_current_stage():
+    return getattr(_current, "stage", None)
+
+
+@contextlib.contextmanager
+def attributed_to(stage):
+    """Count what the calling thread does against stage, started by another thread.
+
+    Used by the helper threads a stage hands requests to, such as page prefetching."""
+    previous = getattr(_current, "stage", None)
+    _current.stage = stage
+    try:
+        yield stage
+    finally:
+        _current.stage = previous
+
+
+def add_stage_counters(**counters):
+    """Add to the counters of the stage running on the calling thread, if any."""
+    stage = getattr(_current, "stage", None)
+    if stage is not None:
+        stage.add(**counters)
+
+
+def record_api_response(size):
+    """Count a GitHub API response against the stage running on the calling thread."""
+    add_stage_counters(api_calls=1, api_bytes=size)
+
+
+def record_api_retry():
+    add_stage_counters(retries=1)
+
+
+class RunMetrics:
+    """Per repository and per stage timings and counters of a run.
+
+    API calls are attributed to the stage running on the thread that sends them, every
+    repository is backed up by a single worker thread with its own client."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started_at = clock()
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.repositories = {}
+
+    @contextlib.contextmanager
+    def stage(self, repository, name):
+        stage = Stage(repository, name)
+        previous = getattr(_current, "stage", None)
+        _current.stage = stage
+        started = time.monotonic()
+        cpu_started = time.thread_time()
+        try:
+            yield stage
+        except BaseException as e:
+            stage.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.stage = previous
+            stage.add(seconds=time.monotonic() - started, cpu_seconds=time.thread_time() - cpu_started)
+            self.record(stage)
+
+    def record(self, stage):
+        with self.lock:
+            repository = self.repositories.setdefault(stage.repository, {"status": None, "stages": {}})
+            counters = repository["stages"].setdefault(stage.name, dict.fromkeys(STAGE_COUNTERS, 0))
+            for name, value in stage.counters.items():
+                counters[name] += value
+            if stage.error:
+                counters["error"] = stage.error
+        logging.info(f"{stage.repository}: {stage.name} {'failed' if stage.error else 'done'} in {stage.counters['seconds']:.2f}s, "
+                     f"{stage.counters['api_calls']} API calls, {stage.counters['bytes_written']} bytes written")
+
+    def set_status(self, repository, status):
+        with self.lock:
+            self.repositories.setdefault(repository, {"status": None, "stages": {}})["status"] = status
+
+    def finish(self):
+        self.finished_at = self.clock()
+
+    def report(self, **extra):
+        """JSON serializable summary: counters per repository and stage, and their totals per stage."""
+        with self.lock:
+            repositories = {}
+            stages = {}
+            for name, repository in sorted(self.repositories.items()):
+                totals = dict.fromkeys(STAGE_COUNTERS, 0)
+                for stage_name, counters in repository["stages"].items():
+                    stage_totals = stages.setdefault(stage_name, dict.fromkeys(STAGE_COUNTERS, 0))
+                    for counter in STAGE_COUNTERS:
+                        totals[counter] += counters[counter]
+                        stage_totals[counter] += counters[counter]
+                repositories[name] = {"status": repository["status"], "stages": round_counters(repository["stages"]),
+                                      "totals": round_counters(totals)}
+            statuses = {}
+            for repository in repositories.values():
+                statuses[repository["status"]] = statuses.get(repository["status"], 0) + 1
+
+        finished_at = self.finished_at or self.clock()
+        report = {
+            "started_at": datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+            "finished_at": datetime.datetime.fromtimestamp(finished_at, datetime.timezone.utc).isoformat(),
+            "seconds": round(finished_at - self.started_at, 3),
+            "repositories_by_status": statuses,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+            "stages": round_counters(stages),
+            "repositories": repositories
+        }
+        report.update(extra)
+        return report
+
+    def write_prometheus_textfile(self, path, prefix="gh_backup", labels=None):
+        """Write the run in the Prometheus text format, for the node_exporter textfile collector.
+
+        The file is replaced atomically, the collector never reads a partial run."""
+        report = self.report()
+        labels = labels or {}
+        lines = []
+
+        def add_metric(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for sample_labels, value in samples:
+                lines.append(f"{prefix}_{name}{format_labels(dict(labels, **sample_labels))} {value}")
+
+        for counter, (name, help_text) in PROMETHEUS_STAGE_METRICS.items():
+            add_metric(name, help_text, [({"repository": repository, "stage": stage}, counters[counter])
+                                         for repository, data in report["repositories"].items()
+                                         for stage, counters in sorted(data["stages"].items())])
+        add_metric("stage_total_duration_seconds", "Wall time of a stage summed over the repositories",
+                   [({"stage": stage}, counters["seconds"]) for stage, counters in sorted(report["stages"].items())])
+        add_metric("run_duration_seconds", "Wall time of the run", [({}, report["seconds"])])
+        add_metric("run_repositories", "Repositories of the run by final status",
+                   [({"status": str(status)}, count) for status, count in sorted(report["repositories_by_status"].items(), key=str)])
+        add_metric("run_finished_timestamp_seconds", "Time the run finished", [({}, round(self.finished_at or self.clock(), 3))])
+        if report["peak_rss_kb"] is not None:
+            add_metric("run_peak_rss_kilobytes", "Peak resident set size of the process", [({}, report["peak_rss_kb"])])
+
+        partial_path = f"{path}.partial"
+        with open(partial_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(partial_path, path)
+
+
+def round_counters(counters):
+    if isinstance(counters, dict):
+        return {name: round_counters(value) for name, value in counters.items()}
+    return round(counters, 3) if isinstance(counters, float) else counters
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {name: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in sorted(escaped.items())) + "}"
@@ -0,0 +1,172 @@
+import datetime
+import json
+import logging
+import os
+import re
+import tarfile
+import time
+from urllib.parse import unquote, urlsplit
+
+from gh_common.archive import EXTRACT_OPTIONS
+
+MIGRATION_BATCH_SIZE = 20
+POLL_INTERVAL = 30
+EXPORT_TIMEOUT = 6 * 60 * 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# The records of an archive are split in numbered files per model, repositories_000001.json, issues_000001.json...
+DATA_FILE_PATTERN = re.compile(r"^(?:\./)?(?P<model>[a-z_]+)_\d+\.json$")
+
+
+class MigrationExporter:
+    """Organization migration exports: GitHub archives the git data, issues and labels of a
+    batch of repositories on its side, the backup only downloads one tarball per batch.
+
+    Requests are made on the session of an HTTPExporter, so they are paced and counted
+    like every other API request. The archive is streamed to disk chunk by chunk."""
+
+    def __init__(self, http, organization_url, poll_interval=POLL_INTERVAL, timeout=EXPORT_TIMEOUT, clock=time.monotonic, sleep=time.sleep):
+        self.http = http
+        self.organization_url = organization_url
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+
+    def start(self, repositories, exclude_attachments=True):
+        migration = self.http.request("POST", f"{self.organization_url}/migrations", json={
+            "repositories": list(repositories),
+            # The repositories stay writable, the export is a backup and not a move
+            "lock_repositories": False,
+            "exclude_attachments": exclude_attachments
+        }).json()
+        logging.info(f"Migration {migration['id']} started for {len(repositories)} repositories")
+        return migration
+
+    def wait(self, migration):
+        """Poll the migration until GitHub exported it, returns its last state."""
+        deadline = self.clock() + self.timeout
+        while migration["state"] != "exported":
+            if migration["state"] == "failed":
+                raise RuntimeError(f"Migration {migration['id']} failed on GitHub")
+            if self.clock() > deadline:
+                raise TimeoutError(f"Migration {migration['id']} not exported after {self.timeout}s, still {migration['state']}")
+            self.sleep(self.poll_interval)
+            migration = self.http.get(migration["url"]).json()
+            logging.info(f"Migration {migration['id']}: {migration['state']}")
+        return migration
+
+    def download(self, migration, path):
+        """Stream the archive of an exported migration to path and return its size.
+
+        The archive is written under a temporary name, path only ever holds a complete one."""
+        partial_path = f"{path}.partial"
+        size = 0
+        # GitHub redirects to a short lived storage URL, requests drops the token on the way
+        with self.http.request("GET", f"{migration['url']}/archive", stream=True) as response, open(partial_path, "wb") as file:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                size += len(chunk)
+        os.replace(partial_path, path)
+        logging.info(f"Migration {migration['id']} archive downloaded to {path}, {size} bytes")
+        return size
+
+    def delete_archive(self, migration):
+        # GitHub would otherwise keep the archive of the whole batch for seven days
+        try:
+            self.http.request("DELETE", f"{migration['url']}/archive")
+        except Exception as e:
+            logging.warning(f"Archive of migration {migration['id']} not deleted from GitHub: {e}")
+
+    def export(self, repositories, path, exclude_attachments=True, keep_archive=False):
+        """Export the repositories to the archive at path, returns the migration and the archive size.
+
+        The archive is deleted from GitHub once downloaded, unless keep_archive."""
+        migration = self.wait(self.start(repositories, exclude_attachments))
+        size = self.download(migration, path)
+        if not keep_archive:
+            self.delete_archive(migration)
+        return migration, size
+
+
+def url_name(url):
+    """Last segment of a github.com URL: the name of a repository, a label or a user."""
+    return unquote(urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]) if url else None
+
+
+def to_utc_isoformat(timestamp):
+    # Archives keep the offset of the instance and milliseconds, the REST backup writes UTC seconds
+    if not timestamp:
+        return None
+    value = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    return value.astimezone(datetime.timezone.utc).replace(microsecond=0).isoformat()
+
+
+def serialize_repository(repository):
+    return {
+        "name": repository["name"],
+        "description": repository.get("description"),
+        "website": repository.get("website") or repository.get("homepage"),
+        "language": repository.get("language"),
+        "created_at": to_utc_isoformat(repository.get("created_at")),
+        "updated_at": to_utc_isoformat(repository.get("updated_at") or repository.get("created_at"))
+    }
+
+
+def serialize_issue(issue):
+    """An issue record of the archive in the layout of the REST backup."""
+    return {
+        "number": int(url_name(issue["url"])),
+        "title": issue["title"],
+        "body": issue.get("body"),
+        "state": issue.get("state") or ("closed" if issue.get("closed_at") else "open"),
+        "created_at": to_utc_isoformat(issue.get("created_at")),
+        "updated_at": to_utc_isoformat(issue.get("updated_at") or issue.get("created_at")),
+        "closed_at": to_utc_isoformat(issue.get("closed_at")),
+        # Records point at users and labels by URL, deleted accounts have none
+        "user": url_name(issue.get("user")) or "ghost",
+        "labels": [url_name(label) for label in issue.get("labels") or []]
+    }
+
+
+def read_migration_archive(archive_path, git_dir=None):
+    """Read a migration archive in one pass and return its repositories in the backup layout.
+
+    Returns {name: {"repository", "labels", "issues", "git_dir"}}. The bare git repository
+    of every repository is extracted under git_dir when given, the records are read from
+    the archive directly. Pull requests are not part of the REST issue layout."""
+    records = {}
+    git_dirs = {}
+    with tarfile.open(archive_path, "r|*") as archive:
+        for member in archive:
+            match = DATA_FILE_PATTERN.match(member.name)
+            if match and member.isfile():
+                with archive.extractfile(member) as file:
+                    records.setdefault(match.group("model"), []).extend(json.load(file))
+                continue
+            # Git data is kept as repositories/<org>/<name>.git bare repositories
+            parts = member.name.removeprefix("./").split("/")
+            if git_dir and len(parts) > 2 and parts[0] == "repositories" and parts[2].endswith(".git"):
+                archive.extract(member, git_dir, **EXTRACT_OPTIONS)
+                git_dirs[parts[2][:-len(".git")]] = os.path.join(git_dir, *parts[:3])
+
+    repositories = {}
+    for repository in records.get("repositories", []):
+        repositories[repository["url"]] = {
+            "repository": serialize_repository(repository),
+            "labels": [{"name": label["name"], "color": label["color"]} for label in repository.get("labels") or []],
+            "issues": [],
+            "git_dir": git_dirs.get(repository["name"])
+        }
+    # Older archives list the labels in their own files
+    for label in records.get("labels", []):
+        if label.get("repository") in repositories:
+            repositories[label["repository"]]["labels"].append({"name": label["name"], "color": label["color"]})
+    for issue in records.get("issues", []):
+        if issue.get("repository") in repositories:
+            repositories[issue["repository"]]["issues"].append(serialize_issue(issue))
+
+    converted = {}
+    for data in repositories.values():
+        data["issues"].sort(key=lambda issue: issue["number"], reverse=True)
+        converted[data["repository"]["name"]] = data
+    return converted
@@ -0,0 +1,35 @@
+import gzip
+import json
+import os
+
+
+def open_ndjson(path, mode="r", compressed=None):
+    """Open a newline delimited JSON file, gzip compressed when its name ends with .gz."""
+    if compressed is None:
+        compressed = path.endswith(".gz")
+    if compressed:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_ndjson(path):
+    """Yield the objects of an NDJSON file one at a time."""
+    with open_ndjson(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_ndjson(path, items):
+    """Write the items one per line as they are produced and return how many were written.
+
+    The file is written under a temporary name and renamed once complete."""
+    partial_path = f"{path}.partial"
+    count = 0
+    with open_ndjson(partial_path, "w", compressed=path.endswith(".gz")) as file:
+        for item in items:
+            file.write(json.dumps(item))
+            file.write("\n")
+            count += 1
+    os.replace(partial_path, path)
+    return count
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+
+_CLOSED = object()
+
+
+class BoundedQueue:
+    """FIFO queue between two pipeline stages, bounded by a number of items and optionally
+    by their total size in bytes.
+
+    put blocks while the queue is full, which holds the producing stage back. An item
+    larger than max_bytes is still accepted once the queue is empty, so it cannot block
+    the pipeline forever."""
+
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = []
+        self.bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.peak_items = 0
+        self.peak_bytes = 0
+        self.blocked_seconds = 0.0
+
+    def _full(self, size):
+        if not self.items:
+            return False
+        if self.max_items and len(self.items) >= self.max_items:
+            return True
+        return bool(self.max_bytes) and self.bytes + size > self.max_bytes
+
+    def put(self, item, size=0):
+        with self.condition:
+            started = time.monotonic()
+            while self._full(size):
+                self.condition.wait()
+            self.blocked_seconds += time.monotonic() - started
+            self.items.append((item, size))
+            self.bytes += size
+            self.peak_items = max(self.peak_items, len(self.items))
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.condition.notify_all()
+
+    def get(self):
+        """Next item, or _CLOSED once the queue is closed and drained."""
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return _CLOSED
+            item, size = self.items.pop(0)
+            self.bytes -= size
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def report(self):
+        with self.condition:
+            return {"peak_items": self.peak_items, "peak_bytes": self.peak_bytes,
+                    "producer_blocked_seconds": round(self.blocked_seconds, 3)}
+
+
+class PipelineStage:
+    """One step of a pipeline: function is applied to the value produced by the previous
+    stage by workers threads.
+
+    max_queued and max_queued_bytes bound the queue in front of the stage, size gives the
+    bytes an item takes while it waits there (the size of an intermediate artifact)."""
+
+    def __init__(self, name, function, workers=1, max_queued=None, max_queued_bytes=None, size=None):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.max_queued_bytes = max_queued_bytes
+        self.size = size
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+
+def run_pipeline(items, stages, on_done=None, on_error=None):
+    """Pass every item through the stages, each stage running its own pool of worker threads.
+
+    A stage works on the next item as soon as it handed the previous one over, so the
+    stages of different items overlap. on_done(item, value) is called with the value
+    returned by the last stage, on_error(item, stage_name, exception) when a stage raises,
+    the item then leaves the pipeline. Returns a report per stage."""
+    queues = [BoundedQueue()] + [BoundedQueue(stage.max_queued, stage.max_queued_bytes) for stage in stages[1:]]
+    for item in items:
+        queues[0].put((item, item))
+    queues[0].close()
+
+    lock = threading.Lock()
+    running = [stage.workers for stage in stages]
+
+    def handle(index, item, value):
+        stage = stages[index]
+        started = time.monotonic()
+        try:
+            value = stage.function(value)
+        except Exception as e:
+            logging.error(f"Pipeline stage {stage.name} failed: {e}")
+            with lock:
+                stage.failed += 1
+                stage.busy_seconds += time.monotonic() - started
+            if on_error is not None:
+                on_error(item, stage.name, e)
+            return
+        with lock:
+            stage.processed += 1
+            stage.busy_seconds += time.monotonic() - started
+        if index + 1 < len(stages):
+            next_stage = stages[index + 1]
+            queues[index + 1].put((item, value), next_stage.size(value) if next_stage.size else 0)
+        elif on_done is not None:
+            on_done(item, value)
+
+    def work(index):
+        try:
+            while True:
+                entry = queues[index].get()
+                if entry is _CLOSED:
+                    break
+                try:
+                    handle(index, *entry)
+                except Exception as e:
+                    # A failing callback loses its item, never the worker
+                    logging.exception(f"Pipeline stage {stages[index].name} could not hand over an item: {e}")
+        finally:
+            with lock:
+                running[index] -= 1
+                last_worker = running[index] == 0
+            # The next stage stops once everything this stage produced is consumed
+            if last_worker and index + 1 < len(stages):
+                queues[index + 1].close()
+
+    threads = [threading.Thread(target=work, args=(index,), name=f"{stage.name}-{worker}", daemon=True)
+               for index, stage in enumerate(stages) for worker in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        stage.name: {
+            "workers": stage.workers,
+            "processed": stage.processed,
+            "failed": stage.failed,
+            "busy_seconds": round(stage.busy_seconds, 3),
+            "queue": queues[index].report() if index else None
+        } for index, stage in enumerate(stages)
+    }
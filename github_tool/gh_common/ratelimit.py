@@ -0,0 +1,202 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import deque
+
+# GitHub's primary limit for a token, the bucket is re-paced from the response headers
+DEFAULT_REQUESTS_PER_HOUR = 5000
+DEFAULT_BURST = 50
+# Secondary limits ask for at least one second between content creating requests,
+# and for no more than 500 of them in an hour
+DEFAULT_WRITE_INTERVAL = 1.0
+DEFAULT_WRITES_PER_HOUR = 500
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 120.0
+
+WRITE_METHODS = ("POST", "PATCH", "PUT", "DELETE")
+# Server errors are transient, requests that cannot create content twice are retried
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+# GitHub asks to wait at least a minute after a secondary rate limit announced without Retry-After
+SECONDARY_LIMIT_DELAY = 60.0
+SECONDARY_LIMIT_MESSAGE = "secondary rate limit"
+
+
+class RateLimitGovernor:
+    """Token bucket shared by every GitHub API request of a run.
+
+    Requests take a token before they are sent. The bucket refills at the configured
+    rate, slowed down to spread the remaining quota (X-RateLimit-Remaining) until
+    X-RateLimit-Reset. Content creating requests are also spaced by write_interval, and
+    no more than writes_per_hour of them are sent in any hour. Rate limited responses (429, or 403 with Retry-After, an
+    exhausted quota or a secondary rate limit message) block every caller until the
+    limit is lifted, and are retried with an exponential backoff with jitter when GitHub
+    gives no explicit delay. Server errors are retried with the same backoff, without
+    blocking the other callers."""
+
+    def __init__(self, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, burst=DEFAULT_BURST, write_interval=DEFAULT_WRITE_INTERVAL,
+                 writes_per_hour=DEFAULT_WRITES_PER_HOUR, max_retries=DEFAULT_MAX_RETRIES, backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                 clock=time.time, sleep=time.sleep):
+        self.max_rate = requests_per_hour / 3600.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.write_interval = write_interval
+        self.writes_per_hour = writes_per_hour
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.updated_at = clock()
+        self.next_write_at = 0.0
+        # Send times of the writes of the last hour, writes_per_hour at most
+        self.write_times = deque()
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self.resources = {}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, write=False):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self._refill(now)
+                wait = max(self.blocked_until - now, 0.0)
+                if self.tokens < 1:
+                    wait = max(wait, (1 - self.tokens) / self.rate)
+                if write:
+                    wait = max(wait, self.next_write_at - now)
+                    while self.write_times and self.write_times[0] <= now - 3600:
+                        self.write_times.popleft()
+                    if self.writes_per_hour and len(self.write_times) >= self.writes_per_hour:
+                        wait = max(wait, self.write_times[0] + 3600 - now)
+                if wait <= 0:
+                    self.tokens -= 1
+                    self.requests += 1
+                    if write:
+                        self.next_write_at = now + self.write_interval
+                        if self.writes_per_hour:
+                            self.write_times.append(now)
+                    return
+                self.throttled_seconds += wait
+            self.sleep(wait)
+
+    def update(self, status, headers):
+        """Re-pace the bucket from the rate limit headers of a response."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        remaining = int(float(remaining))
+        reset = float(reset)
+        resource = headers.get("X-RateLimit-Resource", "core")
+
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            usage = self.resources.setdefault(resource, {"requests": 0, "first_remaining": remaining})
+            # 304 Not Modified responses are not counted against the quota
+            if status != 304:
+                usage["requests"] += 1
+            usage.update(remaining=remaining, limit=int(float(headers.get("X-RateLimit-Limit", 0))), reset=reset)
+
+            if resource != "core":
+                return
+            seconds_left = max(reset - now, 1.0)
+            self.rate = max(min(self.max_rate, remaining / seconds_left), 1.0 / seconds_left)
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining == 0:
+                self.blocked_until = max(self.blocked_until, reset)
+
+    def backoff(self, attempt):
+        # Exponential backoff with jitter, so workers released together do not retry together
+        return min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def retry_delay(self, status, headers, attempt, body=None, idempotent=True):
+        """Seconds to wait before retrying a rate limited or failed response, None when it must not be retried.
+
+        body is the text of a 403 response, secondary rate limits are only told apart by
+        their message. A server error is only retried for an idempotent request."""
+        if attempt >= self.max_retries:
+            return None
+        retry_after = headers.get("Retry-After")
+        exhausted = headers.get("X-RateLimit-Remaining") == "0"
+        secondary = status == 403 and SECONDARY_LIMIT_MESSAGE in (body or "").lower()
+        if status == 429 or (status == 403 and (retry_after is not None or exhausted or secondary)):
+            if retry_after is not None:
+                delay = float(retry_after)
+            elif exhausted and headers.get("X-RateLimit-Reset"):
+                delay = float(headers["X-RateLimit-Reset"]) - self.clock()
+            elif secondary:
+                delay = SECONDARY_LIMIT_DELAY
+            else:
+                delay = 0
+            delay = max(delay, 0) + self.backoff(attempt)
+            with self.lock:
+                self.retries += 1
+                self.blocked_until = max(self.blocked_until, self.clock() + delay)
+            logging.warning(f"GitHub rate limit hit (HTTP {status}), retrying in {delay:.1f}s")
+            return delay
+        if status in SERVER_ERROR_STATUSES and idempotent:
+            delay = max(float(retry_after or 0), 0) + self.backoff(attempt)
+            with self.lock:
+                self.retries += 1
+            logging.warning(f"GitHub server error (HTTP {status}), retrying in {delay:.1f}s")
+            return delay
+        return None
+
+    def wait(self, delay):
+        with self.lock:
+            self.throttled_seconds += delay
+        self.sleep(delay)
+
+    def report(self):
+        """Requests sent, retries, time spent waiting and quota used per rate limit resource."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "resources": {
+                    name: {
+                        "quota_used": usage["requests"],
+                        "remaining": usage["remaining"],
+                        "limit": usage["limit"],
+                        "reset": usage["reset"]
+                    } for name, usage in sorted(self.resources.items())
+                }
+            }
+
+
+_default_governor = None
+_default_governor_lock = threading.Lock()
+
+
+def configure_default_governor(**kwargs):
+    """Replace the governor shared by every client of the process."""
+    global _default_governor
+    with _default_governor_lock:
+        _default_governor = RateLimitGovernor(**kwargs)
+        return _default_governor
+
+
+def get_default_governor():
+    """The governor shared by every client of the process."""
+    global _default_governor
+    with _default_governor_lock:
+        if _default_governor is None:
+            _default_governor = RateLimitGovernor(int(os.getenv("GITHUB_REQUESTS_PER_HOUR", DEFAULT_REQUESTS_PER_HOUR)),
+                                                  write_interval=float(os.getenv("GITHUB_WRITE_INTERVAL", DEFAULT_WRITE_INTERVAL)),
+                                                  writes_per_hour=int(os.getenv("GITHUB_WRITES_PER_HOUR", DEFAULT_WRITES_PER_HOUR)))
+        return _default_governor
@@ -0,0 +1,111 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from gh_common import archive
+from gh_common.archive import (ArchiveOutput, ParallelGzipWriter, is_incompressible, new_archive_path, open_tar_archive,
+                               parse_archive_name, write_archive)
+
+
+class TestArchiveWriters(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.folder = os.path.join(self.temp_dir, "repo")
+        os.makedirs(os.path.join(self.folder, "repo_cloned", ".git", "objects", "pack"))
+        self.files = {
+            "issues.json": b'[{"title": "an issue"}]\n' * 2000,
+            os.path.join("repo_cloned", ".git", "objects", "pack", "pack-1.pack"): os.urandom(4096),
+            # Random content without a compressed extension is recognised from a sample
+            "random.bin": os.urandom(128 * 1024)
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.folder, name), "wb") as file:
+                file.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, archive_format, workers=2):
+        output = io.BytesIO()
+        write_archive(self.folder, list(self.files), ArchiveOutput(output), archive_format, workers)
+        return output.getvalue()
+
+    def test_incompressible_files_are_detected(self):
+        self.assertFalse(is_incompressible(os.path.join(self.folder, "issues.json")))
+        self.assertTrue(is_incompressible(os.path.join(self.folder, "repo_cloned", ".git", "objects", "pack", "pack-1.pack")))
+        self.assertTrue(is_incompressible(os.path.join(self.folder, "random.bin")))
+
+    def test_zip_stores_incompressible_files(self):
+        with zipfile.ZipFile(io.BytesIO(self.write("zip"))) as zip_file:
+            self.assertEqual({info.filename: info.compress_type for info in zip_file.infolist()}, {
+                "issues.json": zipfile.ZIP_DEFLATED,
+                "random.bin": zipfile.ZIP_STORED,
+                "repo_cloned/.git/objects/pack/pack-1.pack": zipfile.ZIP_STORED
+            })
+            self.assertEqual(zip_file.read("random.bin"), self.files["random.bin"])
+
+    def test_tar_gz_is_the_same_whatever_the_number_of_workers(self):
+        content = self.write("tar.gz", workers=1)
+        self.assertEqual(self.write("tar.gz", workers=4), content)
+
+        path = os.path.join(self.temp_dir, "repo.tar.gz")
+        with open(path, "wb") as file:
+            file.write(content)
+        with open_tar_archive(path) as tar_file:
+            read = {member.name: tar_file.extractfile(member).read() for member in tar_file}
+        self.assertEqual(read, {name.replace(os.sep, "/"): data for name, data in self.files.items()})
+
+    def test_parallel_gzip_members_decompress_to_the_content(self):
+        output = io.BytesIO()
+        writer = ParallelGzipWriter(output, workers=3, block_size=1000)
+        writer.write(b"a" * 2500)
+        writer.set_level(0)
+        writer.write(b"b" * 10)
+        writer.close()
+
+        self.assertEqual(gzip.decompress(output.getvalue()), b"a" * 2500 + b"b" * 10)
+        self.assertEqual(writer.tell(), 2510)
+
+    @unittest.skipUnless(archive.zstandard, "zstandard is not installed")
+    def test_tar_zst_round_trip(self):
+        path = os.path.join(self.temp_dir, "repo.tar.zst")
+        with open(path, "wb") as file:
+            file.write(self.write("tar.zst"))
+        with open_tar_archive(path) as tar_file:
+            self.assertEqual(sorted(member.name for member in tar_file), sorted(name.replace(os.sep, "/") for name in self.files))
+
+    def test_tar_zst_without_zstandard_is_refused(self):
+        if archive.zstandard is not None:
+            self.skipTest("zstandard is installed")
+        with self.assertRaisesRegex(RuntimeError, "zstandard"):
+            self.write("tar.zst")
+
+
+class TestArchiveNames(unittest.TestCase):
+    def test_new_archive_paths_never_collide(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        directory = os.path.join(temp_dir, "repo")
+
+        paths = {new_archive_path(directory, "tar.gz") for attempt in range(20)}
+
+        self.assertEqual(len(paths), 20)
+        self.assertTrue(all(parse_archive_name(path)[0] == "repo" for path in paths))
+
+    def test_names_sort_from_the_oldest_to_the_newest(self):
+        names = ["my_repo_2023-01-01.zip", "my_repo_2023-01-01_08-00-00-000000.tar.gz", "my_repo_2023-01-01_17-30-00-000001.zip"]
+        self.assertEqual([parse_archive_name(name) for name in names], [
+            ("my_repo", ("2023-01-01", "")),
+            ("my_repo", ("2023-01-01", "08-00-00-000000")),
+            ("my_repo", ("2023-01-01", "17-30-00-000001"))
+        ])
+        self.assertIsNone(parse_archive_name("upload_manifest.json"))
+        self.assertIsNone(parse_archive_name("migration_2023-01-01_08-00-00_1.tar.gz"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import datetime
+import json
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from github import Auth
+
+from gh_common.github_client import build_github_client
+from gh_common.graphql_export import GraphQLExporter, PageSizer, estimate_query_cost
+from gh_common.ratelimit import RateLimitGovernor
+from gh_repo_backup.backup import serialize_issue
+
+
+def make_issue_node(number, labels=1):
+    return {
+        "id": f"I_{number}",
+        "number": number,
+        "title": f"Issue {number}",
+        "body": "body",
+        "state": "CLOSED" if number % 2 else "OPEN",
+        "createdAt": f"2023-01-{number:02d}T00:00:00Z",
+        "updatedAt": f"2023-01-{number:02d}T12:00:00Z",
+        "closedAt": "2023-02-01T00:00:00Z" if number % 2 else None,
+        "author": {"login": "octocat"} if number != 2 else None,
+        "labels": {"pageInfo": {"hasNextPage": labels > 1, "endCursor": "l1"}, "nodes": [{"name": "bug"}]}
+    }
+
+
+def make_pull_request_node(number, state="MERGED"):
+    return dict(make_issue_node(number), id=f"PR_{number}", state=state,
+                closedAt=None if state == "OPEN" else "2023-02-01T00:00:00Z")
+
+
+def make_rest_issue(node):
+    # The REST listing of the same issue or pull request, a merged pull request is closed there
+    issue = {
+        "id": node["number"],
+        "number": node["number"],
+        "title": node["title"],
+        "body": node["body"],
+        "state": "open" if node["state"] == "OPEN" else "closed",
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "closed_at": node["closedAt"],
+        "user": node["author"] or {"login": "ghost"},
+        "labels": [{"name": label["name"], "color": "ededed"} for label in node["labels"]["nodes"]]
+    }
+    if node["id"].startswith("PR_"):
+        issue["pull_request"] = {"url": f"http://example.com/pulls/{node['number']}"}
+    return issue
+
+
+class GraphQLApi(BaseHTTPRequestHandler):
+    issues = []
+    pull_requests = []
+    queries = []
+    timeouts = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Resource", "graphql")
+        self.send_header("X-RateLimit-Remaining", "4000")
+        self.send_header("X-RateLimit-Reset", "9999999999")
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/repos/org/repo/issues"):
+            nodes = sorted(GraphQLApi.issues + GraphQLApi.pull_requests, key=lambda node: node["number"], reverse=True)
+            self.reply(200, [make_rest_issue(node) for node in nodes])
+        else:
+            self.reply(200, {"name": "repo", "full_name": "org/repo", "url": f"http://{self.headers['Host']}/repos/org/repo"})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        variables = request["variables"]
+        GraphQLApi.queries.append(variables)
+        if GraphQLApi.timeouts:
+            GraphQLApi.timeouts -= 1
+            self.reply(502, {"message": "Something went wrong while executing your query. This may be the result of a timeout"})
+            return
+
+        rate_limit = {"cost": 1, "remaining": 4000, "resetAt": "2030-01-01T00:00:00Z"}
+        if "node(id: $id)" in request["query"]:
+            labels = {"pageInfo": {"hasNextPage": False, "endCursor": None}, "nodes": [{"name": "enhancement"}]}
+            self.reply(200, {"data": {"rateLimit": rate_limit, "node": {"labels": labels}}})
+            return
+
+        if "pullRequests(" in request["query"]:
+            connection, nodes = "pullRequests", GraphQLApi.pull_requests
+            if variables["order"] == "UPDATED_AT":
+                nodes = sorted(nodes, key=lambda node: node["updatedAt"], reverse=True)
+        else:
+            connection, nodes = "issues", GraphQLApi.issues
+        start = int(variables["after"] or 0)
+        page = nodes[start:start + variables["first"]]
+        end = start + len(page)
+        result = {"pageInfo": {"hasNextPage": end < len(nodes), "endCursor": str(end)}, "nodes": page}
+        self.reply(200, {"data": {"rateLimit": rate_limit, "repository": {connection: result}}})
+
+
+class TestGraphQLExport(unittest.TestCase):
+
+    def setUp(self):
+        GraphQLApi.issues = [make_issue_node(number, labels=2 if number == 5 else 1) for number in range(12, 0, -1)]
+        GraphQLApi.pull_requests = []
+        GraphQLApi.queries = []
+        GraphQLApi.timeouts = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), GraphQLApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.governor = RateLimitGovernor(write_interval=60)
+        self.client = build_github_client(self.governor, auth=Auth.Token("token"), base_url=f"http://127.0.0.1:{self.server.server_port}")
+        self.exporter = GraphQLExporter(self.client.requester, self.governor)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_issues_are_exported_in_the_rest_layout(self):
+        issues = list(self.exporter.iter_issues("org", "repo"))
+
+        self.assertEqual([issue["number"] for issue in issues], list(range(12, 0, -1)))
+        rest_issue = mock.MagicMock(number=3, title="Issue 3", body="body", state="closed", labels=[mock.MagicMock()],
+                                    created_at=datetime.datetime(2023, 1, 3, tzinfo=datetime.timezone.utc),
+                                    updated_at=datetime.datetime(2023, 1, 3, 12, tzinfo=datetime.timezone.utc),
+                                    closed_at=datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc))
+        rest_issue.user.login = "octocat"
+        rest_issue.labels[0].name = "bug"
+        self.assertEqual(issues[9], serialize_issue(rest_issue))
+
+        self.assertEqual(issues[10]["user"], "ghost")
+        self.assertEqual(issues[7]["labels"], ["bug", "enhancement"])
+        # One query for the twelve issues, one for the pull requests and one to complete the labels of issue 5
+        self.assertEqual(len(GraphQLApi.queries), 3)
+        # GraphQL queries are not spaced out like content creating requests
+        self.assertEqual(self.governor.report()["throttled_seconds"], 0)
+
+    def test_rest_and_graphql_engines_export_the_same_issues(self):
+        GraphQLApi.issues = [make_issue_node(number) for number in (7, 4, 2, 1)]
+        GraphQLApi.pull_requests = [make_pull_request_node(6, "OPEN"), make_pull_request_node(5, "CLOSED"), make_pull_request_node(3)]
+
+        rest = [serialize_issue(issue) for issue in self.client.get_repo("org/repo").get_issues(state="all")]
+        graphql = list(self.exporter.iter_issues("org", "repo"))
+
+        self.assertEqual([issue["number"] for issue in graphql], [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual(graphql, rest)
+
+    def test_pull_requests_updated_since_are_exported(self):
+        GraphQLApi.pull_requests = [make_pull_request_node(number) for number in (20, 14, 13)]
+        since = datetime.datetime(2023, 1, 14, tzinfo=datetime.timezone.utc)
+
+        numbers = [issue["number"] for issue in self.exporter.iter_issues("org", "repo", since)]
+
+        self.assertEqual(numbers[-2:], [20, 14])
+        self.assertEqual(GraphQLApi.queries[-1]["order"], "UPDATED_AT")
+
+    def test_page_is_halved_when_the_query_times_out(self):
+        GraphQLApi.timeouts = 1
+        GraphQLApi.issues = GraphQLApi.issues[:3]
+        self.assertEqual(len(list(self.exporter.iter_issues("org", "repo", datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)))), 3)
+        self.assertEqual([query["first"] for query in GraphQLApi.queries[:2]], [100, 50])
+        self.assertEqual(GraphQLApi.queries[1]["since"], "2023-01-01T00:00:00+00:00")
+
+    def test_page_size_fits_the_query_cost(self):
+        self.assertEqual(estimate_query_cost(100), 1)
+        self.assertEqual(estimate_query_cost(100, (20, 20)), 3)
+        self.assertEqual(PageSizer((20, 20), max_cost=2).size, 95)
+        self.assertEqual(PageSizer((50,), max_cost=1).size, 95)
+        self.assertEqual(PageSizer((), max_cost=1).size, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from github import Auth
+
+from gh_common.github_client import build_github_client
+from gh_common.http_cache import HTTPResponseCache
+from gh_common.ratelimit import RateLimitGovernor
+
+
+class EtagApi(BaseHTTPRequestHandler):
+    description = "first"
+    seen_conditional = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        etag = f'"{EtagApi.description}"'
+        rate_headers = {"X-RateLimit-Remaining": "4000", "X-RateLimit-Reset": "9999999999", "X-RateLimit-Limit": "5000"}
+        EtagApi.seen_conditional.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            for name, value in rate_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        body = json.dumps({"login": "org", "description": EtagApi.description, "url": "http://localhost/orgs/org"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        for name, value in rate_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestHTTPResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        EtagApi.description = "first"
+        EtagApi.seen_conditional = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), EtagApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def make_client(self, cache, governor=None):
+        return build_github_client(governor, cache, auth=Auth.Token("token"), base_url=f"http://127.0.0.1:{self.server.server_port}")
+
+    def test_not_modified_is_served_from_cache(self):
+        cache = HTTPResponseCache(self.temp_dir)
+        governor = RateLimitGovernor()
+        self.assertEqual(self.make_client(cache, governor).get_organization("org").description, "first")
+        # A later run, with a new client, revalidates what the previous one stored
+        self.assertEqual(self.make_client(HTTPResponseCache(self.temp_dir), governor).get_organization("org").description, "first")
+
+        self.assertEqual(EtagApi.seen_conditional, [None, '"first"'])
+        self.assertEqual(governor.report()["resources"]["core"]["quota_used"], 1)
+
+    def test_changed_resource_is_downloaded_again(self):
+        cache = HTTPResponseCache(self.temp_dir)
+        self.make_client(cache).get_organization("org")
+        EtagApi.description = "second"
+        self.assertEqual(self.make_client(cache).get_organization("org").description, "second")
+        self.assertEqual(self.make_client(cache).get_organization("org").description, "second")
+        self.assertEqual(cache.report()["hits"], 1)
+
+    def test_entries_depend_on_credentials(self):
+        cache = HTTPResponseCache(self.temp_dir)
+        first = requests.Request("GET", "https://api.github.com/orgs/org", headers={"Authorization": "token a"}).prepare()
+        second = requests.Request("GET", "https://api.github.com/orgs/org", headers={"Authorization": "token b"}).prepare()
+        self.assertNotEqual(cache.key(first), cache.key(second))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = HTTPResponseCache(self.temp_dir, max_bytes=2500)
+        for index in range(5):
+            response = requests.Response()
+            response.status_code = 200
+            response.headers["ETag"] = f'"{index}"'
+            response._content = b"x" * 600
+            response.encoding = "utf-8"
+            response.url = f"https://api.github.com/{index}"
+            cache.store(str(index), response)
+            os.utime(os.path.join(self.temp_dir, f"{index}.json"), (index, index))
+
+        self.assertLessEqual(cache.size, 2500)
+        self.assertIsNone(cache.load("0"))
+        self.assertIsNotNone(cache.load("4"))
+
+
+if __name__ == '__main__':
+    unittest.main()
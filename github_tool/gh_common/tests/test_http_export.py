@@ -0,0 +1,111 @@
+import json
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from github import Auth
+
+from gh_common.http_export import HTTPExporter, page_url
+from gh_common.metrics import RunMetrics
+
+
+class ListingApi(BaseHTTPRequestHandler):
+    """Items 1 to 250 of a listing with first, next and last Link headers, and a classic project."""
+    item_count = 250
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        ListingApi.requests.append((url.path, query, self.headers.get("Authorization"), self.headers.get("Accept")))
+        base = f"http://{self.headers['Host']}"
+        if url.path == "/items":
+            per_page, page = int(query.get("per_page", 30)), int(query.get("page", 1))
+            last = -(-self.item_count // per_page)
+            links = []
+            if page < last:
+                links.append(f'<{base}/items?per_page={per_page}&page={page + 1}>; rel="next"')
+                links.append(f'<{base}/items?per_page={per_page}&page={last}>; rel="last"')
+            items = [{"id": number} for number in range((page - 1) * per_page + 1, min(page * per_page, self.item_count) + 1)]
+            self.send_json(items, {"Link": ", ".join(links)} if links else None)
+        elif url.path == "/projects/1/columns":
+            self.send_json([{"name": name, "cards_url": f"{base}/projects/columns/{index}/cards"} for index, name in enumerate(["To do", "Done"])])
+        elif url.path == "/projects/columns/0/cards":
+            self.send_json([{"note": "first", "content_url": f"{base}/repos/org/repo/issues/1"}, {"note": "note only", "content_url": None}])
+        elif url.path == "/projects/columns/1/cards":
+            self.send_json([{"note": "second", "content_url": f"{base}/repos/org/repo/issues/2"}])
+        elif url.path.startswith("/repos/org/repo/issues/"):
+            number = url.path.rsplit("/", 1)[1]
+            self.send_json({"html_url": f"https://github.com/org/repo/issues/{number}", "title": f"Issue {number}"})
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+
+class TestHTTPExporter(unittest.TestCase):
+    def setUp(self):
+        ListingApi.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ListingApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.exporter = HTTPExporter(Auth.Token("secret"), workers=2)
+
+    def tearDown(self):
+        self.exporter.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pages_are_read_ahead_and_yielded_in_order(self):
+        metrics = RunMetrics()
+        with metrics.stage("repo", "issues"):
+            items = [item["id"] for item in self.exporter.iter_pages(f"{self.base_url}/items")]
+
+        self.assertEqual(items, list(range(1, 251)))
+        self.assertEqual(sorted(int(query["page"]) for path, query, auth, accept in ListingApi.requests if "page" in query), [2, 3])
+        self.assertTrue(all(query["per_page"] == "100" for path, query, auth, accept in ListingApi.requests))
+        self.assertEqual({auth for path, query, auth, accept in ListingApi.requests}, {"token secret"})
+        # The pages read ahead on other threads count against the stage of the listing
+        self.assertEqual(metrics.report()["repositories"]["repo"]["stages"]["issues"]["api_calls"], 3)
+        self.assertEqual(self.exporter.report(), {"requests": 3, "prefetched_pages": 2})
+
+    def test_next_links_are_followed_without_a_last_link(self):
+        self.exporter.per_page = 250
+        self.assertEqual(len(list(self.exporter.iter_pages(f"{self.base_url}/items"))), 250)
+
+    def test_project_columns_have_their_card_contents(self):
+        columns = self.exporter.get_project_columns(f"{self.base_url}/projects/1")
+
+        self.assertEqual(columns, [
+            {"name": "To do", "cards": [
+                {"note": "first", "content_url": "https://github.com/org/repo/issues/1"},
+                {"note": "note only"}
+            ]},
+            {"name": "Done", "cards": [
+                {"note": "second", "content_url": "https://github.com/org/repo/issues/2"}
+            ]}
+        ])
+        self.assertEqual({accept for path, query, auth, accept in ListingApi.requests if path.startswith("/projects")},
+                         {"application/vnd.github.inertia-preview+json"})
+
+    def test_page_url_replaces_the_page(self):
+        self.assertEqual(page_url("https://api.github.com/items?state=all&page=9&per_page=100", 2),
+                         "https://api.github.com/items?state=all&per_page=100&page=2")
+
+
+if __name__ == "__main__":
+    unittest.main()
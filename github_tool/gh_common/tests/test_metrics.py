@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from http.server import ThreadingHTTPServer
+
+from github import Auth
+
+from gh_common.github_client import build_github_client
+from gh_common.metrics import RunMetrics, add_stage_counters, path_size
+from gh_common.tests.test_ratelimit import FakeClock, RateLimitedApi, make_governor
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_stages_are_summed_per_repository_and_stage(self):
+        metrics = RunMetrics()
+        with metrics.stage("a", "labels") as stage:
+            stage.add(bytes_written=10)
+        with metrics.stage("a", "clone"):
+            add_stage_counters(bytes_written=100)
+        with metrics.stage("b", "labels"):
+            add_stage_counters(bytes_written=5)
+        # Counters added outside of a stage are ignored
+        add_stage_counters(bytes_written=1000)
+        metrics.set_status("a", "backed_up")
+        metrics.set_status("b", "failed")
+        metrics.finish()
+
+        report = metrics.report(organization="org")
+        self.assertEqual(report["organization"], "org")
+        self.assertEqual(report["repositories"]["a"]["totals"]["bytes_written"], 110)
+        self.assertEqual(report["stages"]["labels"]["bytes_written"], 15)
+        self.assertEqual(report["repositories_by_status"], {"backed_up": 1, "failed": 1})
+        self.assertGreaterEqual(report["repositories"]["a"]["stages"]["clone"]["seconds"], 0)
+        json.dumps(report)
+
+    def test_failed_stage_is_recorded(self):
+        metrics = RunMetrics()
+        with self.assertRaises(RuntimeError):
+            with metrics.stage("a", "compress"):
+                raise RuntimeError("disk full")
+        self.assertEqual(metrics.report()["repositories"]["a"]["stages"]["compress"]["error"], "RuntimeError: disk full")
+
+    def test_prometheus_textfile(self):
+        metrics = RunMetrics()
+        with metrics.stage('repo "quoted"', "issues") as stage:
+            stage.add(api_calls=3)
+        metrics.set_status('repo "quoted"', "backed_up")
+        path = os.path.join(self.temp_dir, "gh_backup.prom")
+        metrics.write_prometheus_textfile(path, labels={"organization": "org"})
+
+        with open(path) as file:
+            lines = file.read().splitlines()
+        self.assertIn("# TYPE gh_backup_stage_api_calls gauge", lines)
+        self.assertIn('gh_backup_stage_api_calls{organization="org",repository="repo \\"quoted\\"",stage="issues"} 3', lines)
+        self.assertIn('gh_backup_run_repositories{organization="org",status="backed_up"} 1', lines)
+        self.assertFalse(os.path.exists(f"{path}.partial"))
+
+    def test_path_size(self):
+        os.makedirs(os.path.join(self.temp_dir, "sub"))
+        for name, size in (("a", 3), (os.path.join("sub", "b"), 5)):
+            with open(os.path.join(self.temp_dir, name), "wb") as file:
+                file.write(b"x" * size)
+        self.assertEqual(path_size(self.temp_dir), 8)
+        self.assertEqual(path_size(os.path.join(self.temp_dir, "a")), 3)
+        self.assertEqual(path_size(os.path.join(self.temp_dir, "missing")), 0)
+
+
+class TestApiCallAttribution(unittest.TestCase):
+
+    def setUp(self):
+        RateLimitedApi.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_calls_and_retries_are_counted_against_the_running_stage(self):
+        RateLimitedApi.responses = [(403, {"Retry-After": "5"}), (200, {})]
+        client = build_github_client(make_governor(FakeClock()), auth=Auth.Token("token"), base_url=f"http://127.0.0.1:{self.server.server_port}")
+        metrics = RunMetrics()
+
+        with metrics.stage("a", "metadata"):
+            client.get_organization("org")
+        client.get_organization("org")
+
+        counters = metrics.report()["repositories"]["a"]["stages"]["metadata"]
+        self.assertEqual((counters["api_calls"], counters["retries"]), (2, 1))
+        self.assertGreater(counters["api_bytes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from gh_common.migration_export import MigrationExporter, read_migration_archive, to_utc_isoformat, url_name
+
+
+class Response:
+    def __init__(self, payload=None, chunks=()):
+        self.payload = payload
+        self.chunks = chunks
+
+    def json(self):
+        return self.payload
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class MigrationsApi:
+    """The requests of an HTTPExporter answered from a list of migration states."""
+
+    def __init__(self, states, chunks=()):
+        self.states = list(states)
+        self.chunks = chunks
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs.get("json")))
+        if url.endswith("/archive"):
+            return Response(chunks=self.chunks)
+        return Response({"id": 7, "state": self.states.pop(0), "url": "https://api.github.com/orgs/org/migrations/7"})
+
+    def get(self, url, params=None, headers=None):
+        return self.request("GET", url)
+
+
+class TestMigrationExporter(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.sleeps = []
+
+    def exporter(self, api, timeout=3600):
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+        return MigrationExporter(api, "https://api.github.com/orgs/org", poll_interval=30, timeout=timeout, clock=lambda: self.now, sleep=sleep)
+
+    def test_export_polls_until_exported_and_streams_the_archive(self):
+        api = MigrationsApi(["pending", "exporting", "exported"], [b"abc", b"def"])
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, "migration.tar.gz")
+
+        migration, size = self.exporter(api).export(["repo-a", "repo-b"], path)
+
+        self.assertEqual((migration["state"], size), ("exported", 6))
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"abcdef")
+        self.assertEqual(os.listdir(folder), ["migration.tar.gz"])
+        self.assertEqual(self.sleeps, [30, 30])
+        self.assertEqual(api.requests[0], ("POST", "https://api.github.com/orgs/org/migrations",
+                                           {"repositories": ["repo-a", "repo-b"], "lock_repositories": False, "exclude_attachments": True}))
+        self.assertEqual(api.requests[-2][:2], ("GET", "https://api.github.com/orgs/org/migrations/7/archive"))
+        # The archive is downloaded once, GitHub no longer has to keep it
+        self.assertEqual(api.requests[-1][:2], ("DELETE", "https://api.github.com/orgs/org/migrations/7/archive"))
+
+    def test_kept_archive_stays_on_github(self):
+        api = MigrationsApi(["exported"], [b"abc"])
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        self.exporter(api).export(["repo-a"], os.path.join(folder, "migration.tar.gz"), keep_archive=True)
+
+        self.assertNotIn("DELETE", [method for method, url, body in api.requests])
+
+    def test_a_failed_migration_raises(self):
+        exporter = self.exporter(MigrationsApi(["pending", "failed"]))
+        with self.assertRaisesRegex(RuntimeError, "failed"):
+            exporter.wait(exporter.start(["repo-a"]))
+
+    def test_a_migration_never_exported_times_out(self):
+        exporter = self.exporter(MigrationsApi(["pending"] * 5), timeout=60)
+        with self.assertRaises(TimeoutError):
+            exporter.wait(exporter.start(["repo-a"]))
+
+
+class TestReadMigrationArchive(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def add_json(self, archive, name, records):
+        content = json.dumps(records).encode()
+        member = tarfile.TarInfo(name)
+        member.size = len(content)
+        archive.addfile(member, io.BytesIO(content))
+
+    def test_records_and_git_data_are_converted(self):
+        path = os.path.join(self.folder, "migration.tar.gz")
+        with tarfile.open(path, "w:gz") as archive:
+            self.add_json(archive, "schema.json", {"version": "1.2.0"})
+            self.add_json(archive, "repositories_000001.json", [{
+                "url": "https://github.com/org/repo-a", "name": "repo-a", "description": "A", "website": None,
+                "created_at": "2024-01-01T10:00:00.123+02:00",
+                "labels": [{"url": "https://github.com/org/repo-a/labels/bug", "name": "bug", "color": "d73a4a"}]
+            }])
+            self.add_json(archive, "issues_000001.json", [
+                {"url": "https://github.com/org/repo-a/issues/1", "repository": "https://github.com/org/repo-a",
+                 "user": "https://github.com/octocat", "title": "First", "body": "Body",
+                 "labels": ["https://github.com/org/repo-a/labels/good%20first%20issue"],
+                 "created_at": "2024-01-02T00:00:00.000Z", "updated_at": "2024-01-03T00:00:00.000Z", "closed_at": None},
+                {"url": "https://github.com/org/repo-a/issues/2", "repository": "https://github.com/org/repo-a",
+                 "user": None, "title": "Second", "body": None, "labels": [],
+                 "created_at": "2024-01-04T00:00:00.000Z", "updated_at": None, "closed_at": "2024-01-05T00:00:00.000Z"}
+            ])
+            head = tarfile.TarInfo("repositories/org/repo-a.git/HEAD")
+            head.size = len(b"ref: refs/heads/main\n")
+            archive.addfile(head, io.BytesIO(b"ref: refs/heads/main\n"))
+
+        converted = read_migration_archive(path, os.path.join(self.folder, "git"))
+
+        data = converted["repo-a"]
+        self.assertEqual(data["repository"]["created_at"], "2024-01-01T08:00:00+00:00")
+        self.assertEqual(data["labels"], [{"name": "bug", "color": "d73a4a"}])
+        self.assertEqual(data["git_dir"], os.path.join(self.folder, "git", "repositories", "org", "repo-a.git"))
+        self.assertTrue(os.path.isfile(os.path.join(data["git_dir"], "HEAD")))
+        self.assertEqual(data["issues"], [
+            {"number": 2, "title": "Second", "body": None, "state": "closed", "created_at": "2024-01-04T00:00:00+00:00",
+             "updated_at": "2024-01-04T00:00:00+00:00", "closed_at": "2024-01-05T00:00:00+00:00", "user": "ghost", "labels": []},
+            {"number": 1, "title": "First", "body": "Body", "state": "open", "created_at": "2024-01-02T00:00:00+00:00",
+             "updated_at": "2024-01-03T00:00:00+00:00", "closed_at": None, "user": "octocat", "labels": ["good first issue"]}
+        ])
+
+    def test_url_helpers(self):
+        self.assertEqual(url_name("https://github.com/org/repo/labels/needs%20review"), "needs review")
+        self.assertIsNone(url_name(None))
+        self.assertIsNone(to_utc_isoformat(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+
+from gh_common.pipeline import BoundedQueue, PipelineStage, run_pipeline
+
+
+class TestBoundedQueue(unittest.TestCase):
+
+    def test_put_blocks_on_the_byte_limit(self):
+        queue = BoundedQueue(max_items=10, max_bytes=100)
+        queue.put("a", 60)
+        released = threading.Event()
+
+        def producer():
+            queue.put("b", 60)
+            released.set()
+
+        threading.Thread(target=producer, daemon=True).start()
+        self.assertFalse(released.wait(0.1))
+        self.assertEqual(queue.get(), "a")
+        self.assertTrue(released.wait(1))
+        self.assertEqual(queue.report()["peak_bytes"], 60)
+
+    def test_oversized_item_enters_an_empty_queue(self):
+        queue = BoundedQueue(max_items=1, max_bytes=10)
+        queue.put("large", 1000)
+        queue.close()
+        self.assertEqual(queue.get(), "large")
+
+
+class TestRunPipeline(unittest.TestCase):
+
+    def test_stages_overlap(self):
+        lock = threading.Lock()
+        events = []
+
+        def stage(name, seconds):
+            def function(value):
+                with lock:
+                    events.append((name, "start", value))
+                time.sleep(seconds)
+                with lock:
+                    events.append((name, "end", value))
+                return value
+            return function
+
+        results = {}
+        report = run_pipeline(range(4), [PipelineStage("clone", stage("clone", 0.05), 1),
+                                         PipelineStage("compress", stage("compress", 0.05), 1, max_queued=1)],
+                              on_done=lambda item, value: results.__setitem__(item, value))
+
+        self.assertEqual(results, {0: 0, 1: 1, 2: 2, 3: 3})
+        # The second clone starts before the first compression is over
+        self.assertLess(events.index(("clone", "start", 1)), events.index(("compress", "end", 0)))
+        self.assertEqual(report["compress"]["processed"], 4)
+        self.assertLessEqual(report["compress"]["queue"]["peak_items"], 1)
+
+    def test_queue_bound_holds_the_producer_back(self):
+        lock = threading.Lock()
+        state = {"waiting": 0, "peak": 0}
+
+        def produce(value):
+            with lock:
+                state["waiting"] += 1
+                state["peak"] = max(state["peak"], state["waiting"])
+            return value
+
+        def consume(value):
+            time.sleep(0.02)
+            with lock:
+                state["waiting"] -= 1
+            return value
+
+        run_pipeline(range(10), [PipelineStage("produce", produce, 4), PipelineStage("consume", consume, 1, max_queued=2)])
+        # Two queued, one being consumed and one produced item per blocked producer
+        self.assertLessEqual(state["peak"], 2 + 1 + 4)
+
+    def test_failed_item_leaves_the_pipeline(self):
+        def fail_on_two(value):
+            if value == 2:
+                raise RuntimeError("boom")
+            return value * 10
+
+        done = []
+        errors = []
+        run_pipeline(range(4), [PipelineStage("first", fail_on_two, 2), PipelineStage("second", lambda value: value + 1, 2)],
+                     on_done=lambda item, value: done.append(value),
+                     on_error=lambda item, stage, e: errors.append((item, stage, str(e))))
+
+        self.assertEqual(sorted(done), [1, 11, 31])
+        self.assertEqual(errors, [(2, "first", "boom")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import json
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from github import Auth
+
+from gh_common.github_client import build_github_client
+from gh_common.ratelimit import RateLimitGovernor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_governor(clock, **kwargs):
+    return RateLimitGovernor(clock=clock.time, sleep=clock.sleep, **kwargs)
+
+
+class TestRateLimitGovernor(unittest.TestCase):
+
+    def test_burst_then_paced(self):
+        clock = FakeClock()
+        governor = make_governor(clock, requests_per_hour=3600, burst=2)
+        for _ in range(4):
+            governor.acquire()
+        self.assertAlmostEqual(sum(clock.sleeps), 2.0)
+
+    def test_remaining_quota_is_spread_until_reset(self):
+        clock = FakeClock()
+        governor = make_governor(clock, burst=1)
+        governor.update(200, {"X-RateLimit-Remaining": "10", "X-RateLimit-Reset": str(clock.now + 100), "X-RateLimit-Limit": "5000"})
+        governor.acquire()
+        governor.acquire()
+        self.assertAlmostEqual(clock.sleeps[-1], 10.0)
+
+    def test_exhausted_quota_blocks_until_reset(self):
+        clock = FakeClock()
+        governor = make_governor(clock)
+        governor.update(200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(clock.now + 60), "X-RateLimit-Limit": "5000"})
+        governor.acquire()
+        self.assertGreaterEqual(clock.now, 1060.0)
+
+    def test_writes_are_spaced(self):
+        clock = FakeClock()
+        governor = make_governor(clock, write_interval=1.0)
+        governor.acquire(write=True)
+        governor.acquire()
+        governor.acquire(write=True)
+        self.assertAlmostEqual(sum(clock.sleeps), 1.0)
+
+    def test_writes_fit_the_hourly_budget(self):
+        clock = FakeClock()
+        governor = make_governor(clock, write_interval=1.0, writes_per_hour=3)
+        for _ in range(3):
+            governor.acquire(write=True)
+        self.assertEqual(clock.now, 1002.0)
+        # The fourth write waits for the first one to leave the hour, reads are not held back
+        governor.acquire()
+        self.assertEqual(clock.now, 1002.0)
+        governor.acquire(write=True)
+        self.assertEqual(clock.now, 4600.0)
+        governor.acquire(write=True)
+        self.assertEqual(clock.now, 4601.0)
+
+    def test_default_write_budget_follows_github_guidance(self):
+        clock = FakeClock()
+        governor = make_governor(clock)
+        for _ in range(501):
+            governor.acquire(write=True)
+        self.assertEqual(clock.now, 1000.0 + 3600)
+
+    def test_retry_after_and_backoff(self):
+        clock = FakeClock()
+        governor = make_governor(clock, backoff_base=1.0, max_retries=2)
+        delay = governor.retry_delay(403, {"Retry-After": "30"}, 0)
+        self.assertGreaterEqual(delay, 30.5)
+        self.assertLessEqual(delay, 31.5)
+        self.assertIsNotNone(governor.retry_delay(429, {}, 1))
+        self.assertIsNone(governor.retry_delay(429, {}, 2))
+        self.assertIsNone(governor.retry_delay(403, {}, 0))
+        self.assertIsNone(governor.retry_delay(404, {}, 0))
+
+    def test_secondary_rate_limit_without_retry_after_waits_a_minute(self):
+        clock = FakeClock()
+        governor = make_governor(clock, backoff_base=1.0)
+        body = '{"message": "You have exceeded a secondary rate limit. Please wait a few minutes before you try again."}'
+        self.assertGreaterEqual(governor.retry_delay(403, {"X-RateLimit-Remaining": "4000"}, 0, body), 60.5)
+        self.assertIsNone(governor.retry_delay(403, {"X-RateLimit-Remaining": "4000"}, 0, '{"message": "Resource not accessible"}'))
+        governor.acquire()
+        self.assertGreaterEqual(clock.now, 1060.5)
+
+    def test_server_errors_of_idempotent_requests_are_retried(self):
+        clock = FakeClock()
+        governor = make_governor(clock, backoff_base=1.0, max_retries=2)
+        self.assertIsNotNone(governor.retry_delay(502, {}, 0))
+        self.assertGreaterEqual(governor.retry_delay(503, {"Retry-After": "10"}, 1), 11.0)
+        self.assertIsNone(governor.retry_delay(502, {}, 2))
+        self.assertIsNone(governor.retry_delay(502, {}, 0, idempotent=False))
+        self.assertIsNone(governor.retry_delay(501, {}, 0))
+        self.assertEqual(governor.report()["retries"], 2)
+
+    def test_report_counts_quota_per_resource(self):
+        clock = FakeClock()
+        governor = make_governor(clock)
+        headers = {"X-RateLimit-Remaining": "4999", "X-RateLimit-Reset": str(clock.now + 3600), "X-RateLimit-Limit": "5000"}
+        governor.acquire()
+        governor.update(200, headers)
+        governor.acquire()
+        governor.update(304, headers)
+        governor.acquire()
+        governor.update(200, dict(headers, **{"X-RateLimit-Resource": "graphql"}))
+
+        report = governor.report()
+        self.assertEqual(report["requests"], 3)
+        self.assertEqual(report["resources"]["core"]["quota_used"], 1)
+        self.assertEqual(report["resources"]["graphql"]["quota_used"], 1)
+
+
+class RateLimitedApi(BaseHTTPRequestHandler):
+    responses = []
+    requests = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        RateLimitedApi.requests += 1
+        status, headers, *message = RateLimitedApi.responses.pop(0) if RateLimitedApi.responses else (200, {})
+        body = json.dumps({"message": message[0]} if message else {"login": "org", "url": "http://localhost/orgs/org"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestGovernedGithubClient(unittest.TestCase):
+
+    def setUp(self):
+        RateLimitedApi.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_secondary_rate_limit_is_retried(self):
+        clock = FakeClock()
+        governor = make_governor(clock)
+        RateLimitedApi.responses = [(403, {"Retry-After": "5"}), (200, {"X-RateLimit-Remaining": "4990", "X-RateLimit-Reset": "9999999999", "X-RateLimit-Limit": "5000"})]
+        client = build_github_client(governor, auth=Auth.Token("token"), base_url=f"http://127.0.0.1:{self.server.server_port}")
+
+        org = client.get_organization("org")
+
+        self.assertEqual(org.login, "org")
+        self.assertEqual(RateLimitedApi.requests, 2)
+        self.assertGreaterEqual(clock.sleeps[0], 5.0)
+        report = governor.report()
+        self.assertEqual((report["requests"], report["retries"]), (2, 1))
+        self.assertEqual(report["resources"]["core"]["remaining"], 4990)
+
+    def test_server_errors_and_secondary_limits_are_retried(self):
+        clock = FakeClock()
+        governor = make_governor(clock)
+        RateLimitedApi.responses = [(502, {}), (403, {"X-RateLimit-Remaining": "4000"}, "You have exceeded a secondary rate limit"), (200, {})]
+        client = build_github_client(governor, auth=Auth.Token("token"), base_url=f"http://127.0.0.1:{self.server.server_port}")
+
+        self.assertEqual(client.get_organization("org").login, "org")
+        self.assertEqual(RateLimitedApi.requests, 3)
+        self.assertEqual(governor.report()["retries"], 2)
+        self.assertGreaterEqual(sum(clock.sleeps), 60.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import uuid
+from collections import Counter
+
+from azure.storage.blob import BlobServiceClient
+
+from gh_common.work_queue import ContainerLeaseStore, DirectoryLeaseStore, WorkQueue, parse_shard, shard_of
+
+AZURITE_CONNECTION_STRING = os.getenv("AZURITE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+
+
+def azurite_available():
+    try:
+        with socket.create_connection(("127.0.0.1", 10000), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_shards_are_stable_and_cover_every_repository(self):
+        names = [f"repo-{index}" for index in range(200)]
+        shards = Counter(shard_of(name, 4) for name in names)
+        self.assertEqual(sorted(shards), [1, 2, 3, 4])
+        self.assertGreater(min(shards.values()), 30)
+        self.assertEqual(shard_of("gh-backup", 4), shard_of("gh-backup", 4))
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("2/4"), (2, 4))
+        for value in ("0/4", "5/4", "2", "a/b"):
+            with self.assertRaises(ValueError):
+                parse_shard(value)
+
+
+class WorkQueueTests:
+    """Behaviour every store must provide, run against each of them."""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = self.make_store()
+        self.node_a = WorkQueue(self.store, "a", lease_seconds=60, clock=self.clock.time)
+        self.node_b = WorkQueue(self.store, "b", lease_seconds=60, clock=self.clock.time)
+
+    def test_item_is_claimed_once_and_never_after_completion(self):
+        self.assertTrue(self.node_a.claim("repo"))
+        self.assertFalse(self.node_b.claim("repo"))
+        self.node_a.complete("repo", "repo_2023-01-01.zip")
+        self.assertFalse(self.node_b.claim("repo"))
+        self.assertFalse(self.node_a.claim("repo"))
+
+    def test_released_item_can_be_retried(self):
+        self.assertTrue(self.node_a.claim("repo"))
+        self.node_a.release("repo")
+        self.assertTrue(self.node_b.claim("repo"))
+
+    def test_expired_lease_is_taken_over_unless_renewed(self):
+        self.assertTrue(self.node_a.claim("renewed"))
+        self.assertTrue(self.node_a.claim("abandoned"))
+        self.clock.now += 50
+        self.node_a.held.pop("abandoned")
+        self.node_a.renew()
+        self.clock.now += 50
+
+        self.assertFalse(self.node_b.claim("renewed"))
+        self.assertTrue(self.node_b.claim("abandoned"))
+        # The node that lost the lease notices it at its next renewal
+        self.node_a.held["abandoned"] = "stale"
+        self.node_a.renew()
+        self.assertNotIn("abandoned", self.node_a.held)
+
+    def test_documents_can_be_replaced(self):
+        self.node_a.put("fragments/a.json", {"repositories": ["x"]})
+        self.node_a.put("fragments/a.json", {"repositories": ["x", "y"]})
+        self.assertEqual(self.store.list("fragments/"), ["fragments/a.json"])
+        self.assertEqual(self.store.read("fragments/a.json")[0], {"repositories": ["x", "y"]})
+
+
+class TestDirectoryWorkQueue(WorkQueueTests, unittest.TestCase):
+
+    def make_store(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        return DirectoryLeaseStore(self.temp_dir)
+
+    def test_concurrent_nodes_share_the_items(self):
+        claimed = Counter()
+        lock = threading.Lock()
+
+        def node(name):
+            queue = WorkQueue(self.store, name)
+            for index in range(50):
+                if queue.claim(f"repo-{index}"):
+                    with lock:
+                        claimed[f"repo-{index}"] += 1
+                    queue.complete(f"repo-{index}")
+
+        threads = [threading.Thread(target=node, args=(f"node-{index}",)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), 50)
+        self.assertEqual(set(claimed.values()), {1})
+
+
+@unittest.skipUnless(azurite_available(), "Azurite is not running on 127.0.0.1:10000")
+class TestContainerWorkQueue(WorkQueueTests, unittest.TestCase):
+
+    def make_store(self):
+        service = BlobServiceClient.from_connection_string(AZURITE_CONNECTION_STRING)
+        container_client = service.create_container(f"queue-{uuid.uuid4().hex}")
+        self.addCleanup(container_client.delete_container)
+        return ContainerLeaseStore(container_client, "work_queue/org/run/")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+DEFAULT_LEASE_SECONDS = 30 * 60
+# A directory lock older than this was left by a crashed node
+STALE_LOCK_SECONDS = 30
+
+
+def parse_shard(value):
+    """Parse a shard given as i/N, i counted from 1 as in a workflow matrix. Returns (i, N)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {value!r}, expected i/N such as 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard {value!r}, i must be between 1 and N")
+    return index, count
+
+
+def shard_of(name, count):
+    """Shard of a repository, from 1 to count.
+
+    Computed from a sha256 of the name, so every runner and Python version agrees on it,
+    which the built-in hash does not."""
+    return int(hashlib.sha256(name.encode()).hexdigest()[:16], 16) % count + 1
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class DirectoryLeaseStore:
+    """Small JSON documents in a local or shared directory, created and replaced atomically.
+
+    A document is created with a hard link, which fails if it exists, and replaced under a
+    directory lock when it still holds the content the caller read. The token of a document
+    is the sha256 of its content."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, name):
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _write_temporary(self, path, content):
+        temporary_path = f"{path}.{uuid.uuid4().hex}.partial"
+        with open(temporary_path, "w") as file:
+            file.write(content)
+        return temporary_path
+
+    def _lock(self):
+        lock_path = os.path.join(self.path, ".lock")
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return lock_path
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.01)
+
+    def create(self, name, data):
+        path = self._path(name)
+        content = json.dumps(data, sort_keys=True)
+        temporary_path = self._write_temporary(path, content)
+        try:
+            os.link(temporary_path, path)
+        except FileExistsError:
+            return None
+        finally:
+            os.remove(temporary_path)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.path, name), "r") as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None, None
+        return json.loads(content), hashlib.sha256(content.encode()).hexdigest()
+
+    def replace(self, name, data, token):
+        path = self._path(name)
+        content = json.dumps(data, sort_keys=True)
+        lock_path = self._lock()
+        try:
+            if self.read(name)[1] != token:
+                return None
+            os.replace(self._write_temporary(path, content), path)
+        finally:
+            os.remove(lock_path)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def delete(self, name, token):
+        lock_path = self._lock()
+        try:
+            if self.read(name)[1] == token:
+                os.remove(os.path.join(self.path, name))
+        finally:
+            os.remove(lock_path)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def list(self, prefix):
+        directory = os.path.join(self.path, prefix)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(f"{prefix}{name}" for name in os.listdir(directory) if not name.endswith(".partial"))
+
+
+class ContainerLeaseStore:
+    """The same documents as blobs under a prefix of a storage container, with etags as tokens."""
+
+    def __init__(self, container_client, prefix=""):
+        self.container_client = container_client
+        self.prefix = prefix
+
+    def create(self, name, data):
+        try:
+            result = self.container_client.get_blob_client(self.prefix + name).upload_blob(json.dumps(data, sort_keys=True), overwrite=False)
+        except ResourceExistsError:
+            return None
+        return result["etag"]
+
+    def read(self, name):
+        try:
+            downloader = self.container_client.download_blob(self.prefix + name)
+            return json.loads(downloader.readall()), downloader.properties.etag
+        except ResourceNotFoundError:
+            return None, None
+
+    def replace(self, name, data, token):
+        try:
+            result = self.container_client.get_blob_client(self.prefix + name).upload_blob(
+                json.dumps(data, sort_keys=True), overwrite=True, etag=token, match_condition=MatchConditions.IfNotModified)
+        except (ResourceModifiedError, ResourceNotFoundError, ResourceExistsError):
+            return None
+        return result["etag"]
+
+    def delete(self, name, token):
+        try:
+            self.container_client.delete_blob(self.prefix + name, etag=token, match_condition=MatchConditions.IfNotModified)
+        except (ResourceModifiedError, ResourceNotFoundError):
+            pass
+
+    def exists(self, name):
+        return self.container_client.get_blob_client(self.prefix + name).exists()
+
+    def list(self, prefix):
+        return sorted(blob.name[len(self.prefix):] for blob in self.container_client.list_blobs(name_starts_with=self.prefix + prefix))
+
+
+class WorkQueue:
+    """Work items shared by the nodes of a run through leases kept in a store.
+
+    A node claims an item by creating its lease, which expires after lease_seconds unless
+    renewed. Held leases are renewed in the background, an expired lease, left by a node
+    that crashed, is taken over. Completed items get a done marker and are never claimed
+    again."""
+
+    def __init__(self, store, owner=None, lease_seconds=DEFAULT_LEASE_SECONDS, clock=time.time):
+        self.store = store
+        self.owner = owner or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.held = {}
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    def _lease(self):
+        return {"owner": self.owner, "expires_at": self.clock() + self.lease_seconds}
+
+    def is_done(self, item):
+        return self.store.exists(f"done/{item}")
+
+    def claim(self, item):
+        """Take the lease of item, False when it is done or leased by a live node."""
+        if self.is_done(item):
+            return False
+        token = self.store.create(f"leases/{item}", self._lease())
+        if token is None:
+            current, current_token = self.store.read(f"leases/{item}")
+            if current is None:
+                token = self.store.create(f"leases/{item}", self._lease())
+            elif current["expires_at"] <= self.clock():
+                logging.info(f"Taking over the expired lease of {item} held by {current['owner']}")
+                token = self.store.replace(f"leases/{item}", self._lease(), current_token)
+        if token is None:
+            return False
+        # The node that held the item may have completed it in between
+        if self.is_done(item):
+            self.store.delete(f"leases/{item}", token)
+            return False
+        with self.lock:
+            self.held[item] = token
+        return True
+
+    def put(self, name, data):
+        """Create or replace a document of the run, such as the result of a node."""
+        if self.store.create(name, data) is None:
+            self.store.replace(name, data, self.store.read(name)[1])
+
+    def complete(self, item, result=None):
+        with self.lock:
+            token = self.held.pop(item, None)
+        self.store.create(f"done/{item}", {"owner": self.owner, "completed_at": self.clock(), "result": result})
+        if token is not None:
+            self.store.delete(f"leases/{item}", token)
+
+    def release(self, item):
+        """Give the item back, another node may retry it."""
+        with self.lock:
+            token = self.held.pop(item, None)
+        if token is not None:
+            self.store.delete(f"leases/{item}", token)
+
+    def renew(self):
+        with self.lock:
+            held = dict(self.held)
+        for item, token in held.items():
+            new_token = self.store.replace(f"leases/{item}", self._lease(), token)
+            with self.lock:
+                if item not in self.held:
+                    continue
+                if new_token is None:
+                    logging.warning(f"Lease of {item} was lost, another node may back it up as well")
+                    self.held.pop(item)
+                else:
+                    self.held[item] = new_token
+
+    def start(self):
+        def renew_periodically():
+            while not self.stopped.wait(self.lease_seconds / 3):
+                try:
+                    self.renew()
+                except Exception as e:
+                    logging.warning(f"Leases could not be renewed: {e}")
+
+        self.renewer = threading.Thread(target=renew_periodically, name="lease-renewer", daemon=True)
+        self.renewer.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
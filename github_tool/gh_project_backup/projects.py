@@ -1,67 +1,116 @@
 import json
 import argparse
+import threading
 
-from github import Github 
+from github import Github
 
 import os
 import logging
 
-from github import BadCredentialsException 
-from github import RateLimitExceededException 
-from github import Github 
+from github import Auth
+from github import BadCredentialsException
+from github import Github
+from github.ProjectCard import ProjectCard
+from github.ProjectColumn import ProjectColumn
+from concurrent.futures import ThreadPoolExecutor
+
+from gh_common.github_client import build_github_client
+from gh_common.graphql_export import GraphQLExporter
+from gh_common.http_export import HTTPExporter
+from gh_common.http_cache import get_default_cache
+from gh_common.ratelimit import get_default_governor
 
 global org_name
 global access_token
-global output_dir 
+global output_dir
 
-def get_project_data(project, output_dir):
-    try:
-        project_data = {
-            "name": project.name,
-            "columns": []
-        }
-
-        columns = project.get_columns()
-        for column in columns:
-            column_data = get_column_data(column)
-            project_data["columns"].append(column_data)
-
-        output_file = os.path.join(output_dir, "github_project_backup.json")
-        save_data_to_json(project_data, output_file)
-        print(f"GitHub project backup saved to '{output_dir}/github_project_backup.json'")
-    except Exception as e:
-        print(f"Error while getting project data: {e}")
+# Columns and cards fetched concurrently
+PROJECT_WORKERS = 8
 
-def get_column_data(column):
-    try:
-        column_data = {
-            "name": column.name,
-            "cards": []
-        }
+_thread_state = threading.local()
 
-        cards = column.get_cards()
-        for card in cards:
-            card_data = get_card_data(card)
-            column_data["cards"].append(card_data)
 
-        return column_data
-    except Exception as e:
-        print(f"Error while getting column data: {e}")
-        return {"name": column.name, "cards": []}
+def get_thread_github_client(access_token):
+    """Return the Github client owned by the calling thread.
+
+    PyGithub keeps a single connection object per client, so worker threads
+    must not share one."""
+    client = getattr(_thread_state, "github", None)
+    if client is None:
+        client = github_auth(access_token=access_token)
+        _thread_state.github = client
+    return client
 
-def get_card_data(card):
+
+def bind_to_thread(github_object, github_class, access_token):
+    # Rebuild the object from the payload already fetched, no extra API call is made
+    if access_token is None:
+        return github_object
+    client = get_thread_github_client(access_token)
+    return client.create_from_raw_data(github_class, github_object._rawData, github_object._headers)
+
+
+def get_column_cards(column, access_token=None):
     try:
-        card_data = {
-            "note": card.note
-        }
+        return list(bind_to_thread(column, ProjectColumn, access_token).get_cards())
+    except Exception as e:
+        print(f"Error while getting column data: {e}")
+        return []
 
-        if card.content:
-            card_data["content_url"] = card.content.html_url
 
-        return card_data
+def get_card_data(card, access_token=None):
+    card_data = {
+        "note": card.note
+    }
+    try:
+        if card.content_url:
+            # card.content does not exist, the issue or pull request is fetched once for its url
+            card_data["content_url"] = bind_to_thread(card, ProjectCard, access_token).get_content().html_url
     except Exception as e:
         print(f"Error while getting card data: {e}")
-        return {"note": card.note}
+    return card_data
+
+
+def get_project_data(project, access_token=None, workers=PROJECT_WORKERS, export_engine="rest"):
+    """Fetch the columns, cards and card contents of a project in one traversal.
+
+    The cards of every column are listed concurrently, then the content of every card
+    is fetched concurrently, each worker thread with its own client. The GraphQL engine
+    gets the columns with their cards and card contents in a few queries instead, the
+    HTTP engine makes the REST requests on one pooled session without building PyGithub
+    objects."""
+    project_data = {
+        "name": project.name,
+        "columns": []
+    }
+
+    if export_engine == "graphql":
+        exporter = GraphQLExporter(project.requester, get_default_governor())
+        project_data["columns"] = exporter.get_project_columns(project.node_id)
+        logging.info(f"GraphQL export of project {project.id}: {json.dumps(exporter.report())}")
+        return project_data
+
+    if export_engine == "http":
+        exporter = HTTPExporter.from_requester(project.requester, get_default_governor(), get_default_cache(), workers=workers)
+        try:
+            project_data["columns"] = exporter.get_project_columns(project.url)
+        finally:
+            exporter.close()
+        logging.info(f"HTTP export of project {project.id}: {json.dumps(exporter.report())}")
+        return project_data
+
+    columns = list(project.get_columns())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        column_cards = list(executor.map(lambda column: get_column_cards(column, access_token), columns))
+        cards_data = iter(executor.map(lambda card: get_card_data(card, access_token), [card for cards in column_cards for card in cards]))
+
+    for column, cards in zip(columns, column_cards):
+        project_data["columns"].append({
+            "name": column.name,
+            "cards": [next(cards_data) for card in cards]
+        })
+    return project_data
+
 
 def save_data_to_json(data, output_file):
     try:
@@ -70,12 +119,14 @@ def save_data_to_json(data, output_file):
     except Exception as e:
         print(f"Error while saving data to JSON: {e}")
 
+
 def github_auth(client_id=None, client_secret=None, access_token=None):
     try:
         if client_id and client_secret:
             g = Github(client_id=client_id, client_secret=client_secret)
         elif access_token:
-            g = Github(access_token)
+            # Every client of the run shares one rate limit governor and response cache
+            g = build_github_client(get_default_governor(), get_default_cache(), auth=Auth.Token(access_token))
         else:
             raise ValueError("No auth parameters provided.")
 
@@ -83,92 +134,63 @@ def github_auth(client_id=None, client_secret=None, access_token=None):
 
     except BadCredentialsException as e:
         print("Github Invalid Credentials:", e)
-    except RateLimitExceededException as e:
-        print("Github Rate limit exceeded.", e)
     except Exception as e:
         print("Github Auth issues:", e)
 
     return None
-        
-def backup_github_project(organization_name, project_ids, access_token, output_dir):
+
+
+def backup_github_project(organization_name, project_ids, access_token, output_dir, workers=PROJECT_WORKERS, export_engine="rest"):
     logging.info("INIT backup_organization_resources Method")
     g = github_auth(access_token=access_token)
 
-    project_details_list = []
-
     try:
         org = g.get_organization(organization_name)
         logging.info("Getting organization details " + organization_name)
     except Exception as e:
         print(f"Error getting the organization: {e}")
         return
-    
-    org_projects = org.get_projects()
-    
+
+    # One pass over the organization projects, every requested id is then looked up in the index
+    org_projects = {org_project.id: org_project for org_project in org.get_projects(state="all")}
+    logging.info(f"Organization projects: {', '.join(f'{project.id}: {project.name}' for project in org_projects.values())}")
+
     for project_id in project_ids:
-        # Find the project with the specified ID
-        project = None
-        for org_project in org_projects:
-            logging.info("Project!!!!!!!!!!!!!!!" + str(org_project))
-            if org_project.id == int(project_id):
-                project = org_project
-                break
-
-        # Print some debug information
-        print(f"Searching for project with ID {project_id}")
-        print("Organization projects:")
-        for org_project in org_projects:
-            print(f" - {org_project.id}: {org_project.name}")
-
-        # Check if the project is found
-        if project:
-            project_details = {
-                "Project ID": project.id,
-                "Project Name": project.name,
-                "Project State": project.state,
-                "Created At": str(project.created_at),
-                # Add more details as needed
-            }
-
-            # Get the columns of the project
-            columns = project.get_columns()
-
-            # Add column details to the dictionary
-            project_details["Columns"] = []
-
-            for column in columns:
-                column_details = {
-                    "Column Name": column.name,
-                    "Cards": [card.get_content().title for card in column.get_cards()]
-                }
-                project_details["Columns"].append(column_details)
-
-            project_details_list.append(project_details)
-            get_project_data(project, output_dir)
-        else:
+        project = org_projects.get(int(project_id))
+        if project is None:
             print(f"Project with ID {project_id} not found.")
+            continue
+
+        try:
+            project_data = get_project_data(project, access_token, workers, export_engine)
+            output_file = os.path.join(output_dir, "github_project_backup.json")
+            save_data_to_json(project_data, output_file)
+            print(f"GitHub project backup saved to '{output_dir}/github_project_backup.json'")
+        except Exception as e:
+            print(f"Error while getting project data: {e}")
+
+    logging.info(f"GitHub API usage: {json.dumps(get_default_governor().report())}")
+
 
-      
 if __name__ == "__main__":
-    
+
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        
+
         parser = argparse.ArgumentParser(description='Backup GitHub organization resources.')
         parser.add_argument('-o', '--org_name', type=str, help='GitHub organization name')
         parser.add_argument('-p', '--project_ids', type=str, nargs='*', help='List of Github Project IDs names to include in the backup')
         parser.add_argument('-t', '--access_token', type=str, help='GitHub access token')
         parser.add_argument('-d', '--output_dir', type=str, help='Output directory for backup')
+        parser.add_argument('-w', '--workers', type=int, default=int(os.getenv("GITHUB_PROJECT_WORKERS", PROJECT_WORKERS)), help='Number of columns and cards fetched concurrently')
+        parser.add_argument('-e', '--export_engine', type=str, choices=("rest", "graphql", "http"), default=os.getenv("GITHUB_EXPORT_ENGINE", "rest"), help='rest: one request per column and card, graphql: columns and cards in bulk GraphQL queries, http: the REST requests on one pooled session')
         args = parser.parse_args()
 
         org_name = args.org_name or os.environ.get("GITHUB_ORG")
-        project_ids = args.project_ids or os.environ.get("GITHUB_PROJECT_ID")
+        project_ids = args.project_ids or os.environ.get("GITHUB_PROJECT_ID", "").split() or None
         access_token = args.access_token or os.environ.get("GITHUB_ACCESS_TOKEN")
         output_dir = args.output_dir or os.environ.get("GITHUB_BACKUP_DIR")
-    
-        
+
         if project_ids is None or access_token is None or output_dir is None:
             raise ValueError("Please provide project_id, access token, and output directory.")
-        
-        backup_github_project(org_name,project_ids, access_token, output_dir)
- 
-    
\ No newline at end of file
+
+        backup_github_project(org_name,project_ids, access_token, output_dir, args.workers, args.export_engine)
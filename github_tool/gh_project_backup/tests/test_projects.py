@@ -0,0 +1,88 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+import threading
+
+from unittest import mock
+
+from gh_project_backup import projects
+
+
+def make_card(note, number=None):
+    card = mock.MagicMock()
+    card.note = note
+    card.content_url = f"https://api.github.com/repos/org/repo/issues/{number}" if number else None
+    content = mock.MagicMock()
+    content.html_url = f"https://github.com/org/repo/issues/{number}"
+    content.title = f"Issue {number}"
+    card.get_content.return_value = content
+    return card
+
+
+def make_column(name, cards):
+    column = mock.MagicMock()
+    column.name = name
+    column.get_cards.return_value = cards
+    return column
+
+
+def make_project(project_id, columns):
+    project = mock.MagicMock()
+    project.id = project_id
+    project.name = f"Project {project_id}"
+    project.state = "open"
+    project.created_at = "2023-01-01 00:00:00"
+    project.get_columns.return_value = columns
+    return project
+
+
+class TestProjectBackup(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_columns_and_cards_are_fetched_once_and_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        todo = make_column("To do", [make_card("first", 1), make_card("note only")])
+        done = make_column("Done", [make_card("second", 2)])
+        for column in (todo, done):
+            # Both columns must be listing their cards at the same time to get past the barrier
+            column.get_cards.side_effect = lambda cards=column.get_cards.return_value: (barrier.wait(), cards)[1]
+
+        project_data = projects.get_project_data(make_project(1, [todo, done]), workers=2)
+
+        self.assertEqual(project_data["columns"], [
+            {"name": "To do", "cards": [
+                {"note": "first", "content_url": "https://github.com/org/repo/issues/1"},
+                {"note": "note only"}
+            ]},
+            {"name": "Done", "cards": [
+                {"note": "second", "content_url": "https://github.com/org/repo/issues/2"}
+            ]}
+        ])
+        for card in todo.get_cards.return_value[:1] + done.get_cards.return_value:
+            card.get_content.assert_called_once_with()
+        todo.get_cards.return_value[1].get_content.assert_not_called()
+
+    def test_projects_are_listed_once(self):
+        org = mock.MagicMock()
+        org.get_projects.return_value = [make_project(project_id, []) for project_id in (1, 2, 3)]
+        client = mock.MagicMock()
+        client.get_organization.return_value = org
+
+        with mock.patch.object(projects, "github_auth", return_value=client):
+            projects.backup_github_project("org", ["3", "1", "4"], "token", self.temp_dir)
+
+        org.get_projects.assert_called_once_with(state="all")
+        # The file name and layout of the original backup are kept
+        self.assertEqual(os.listdir(self.temp_dir), ["github_project_backup.json"])
+        with open(os.path.join(self.temp_dir, "github_project_backup.json")) as file:
+            self.assertEqual(json.load(file), {"name": "Project 1", "columns": []})
+
+
+if __name__ == "__main__":
+    unittest.main()
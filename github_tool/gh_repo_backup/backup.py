@@ -1,124 +1,361 @@
 import json
 import argparse
 import shutil
+import stat
 import time
-import zipfile
 import os
+import sys
 import datetime
 import logging
 import gc
+import threading
+import tempfile
+import hashlib
+import types
 
+from concurrent.futures import ThreadPoolExecutor
+
+from git    import Git
 from git    import Repo
 from git    import GitCommandError
-from github import BadCredentialsException 
-from github import RateLimitExceededException 
-from github import Github 
+from github import Auth
+from github import BadCredentialsException
+from github import Github
+from github.Repository import Repository
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+from azure.storage.blob import BlobBlock, BlobServiceClient, BlobClient, ContainerClient
 
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from gh_common.archive import ARCHIVE_FORMATS, ARCHIVE_WORKERS, ArchiveOutput, check_archive_format, new_archive_path, write_archive
+from gh_common.github_client import build_github_client, get_git_url
+from gh_common.graphql_export import GraphQLExporter
+from gh_common.http_export import HTTPExporter
+from gh_common.migration_export import MIGRATION_BATCH_SIZE, POLL_INTERVAL, MigrationExporter, read_migration_archive
+from gh_common.ndjson import iter_ndjson, write_ndjson
+from gh_common.pipeline import PipelineStage, run_pipeline
+from gh_common.http_cache import DEFAULT_MAX_BYTES, configure_default_cache, get_default_cache
+from gh_common.metrics import RunMetrics, add_stage_counters, path_size
+from gh_common.ratelimit import get_default_governor
+from gh_common.work_queue import DEFAULT_LEASE_SECONDS, ContainerLeaseStore, DirectoryLeaseStore, WorkQueue, default_node_id, parse_shard, shard_of
 
 global org_name
 global access_token
-global output_dir 
+global output_dir
 global remove_local_repo_dir
 
 global azure_account_name
 global azure_account_key
 global azure_container_name
 
-  
+_thread_state = threading.local()
+
+BACKUP_FORMATS = ("zip", "bundle")
+ISSUES_FORMATS = ("json", "ndjson")
+EXPORT_ENGINES = ("rest", "graphql", "http")
+# What happens to a repository unchanged since its last backup
+UNCHANGED_MODES = ("backup", "metadata", "skip")
+ISSUES_FILES = ("issues.json", "issues.ndjson", "issues.ndjson.gz")
+BUNDLE_FULL_INTERVAL = 30
+# Incremental bundles go on until they weigh as much as the full one, and at least this much
+BUNDLE_CHAIN_MIN_BYTES = 1024 * 1024
+UPLOAD_WORKERS = 4
+# zlib releases the GIL, archives are compressed in parallel by threads
+COMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+# Fetched repositories waiting to be compressed, and archives waiting to be uploaded, per queue
+PIPELINE_QUEUE_SIZE = 2
+UPLOAD_MAX_CONCURRENCY = 4
+# Streamed uploads stage a block of the blob every UPLOAD_BLOCK_SIZE bytes of the archive
+UPLOAD_BLOCK_SIZE = 8 * 1024 * 1024
+UPLOAD_MANIFEST_NAME = "upload_manifest.json"
+# Nodes of a sharded run update the published manifest concurrently
+UPLOAD_MANIFEST_SAVE_ATTEMPTS = 5
+HASH_CHUNK_SIZE = 1024 * 1024
+# Files of a clone's .git folder that change with every clone of the same history, they are not archived
+VOLATILE_GIT_FILES = ("index", "FETCH_HEAD", "ORIG_HEAD")
+VOLATILE_GIT_FOLDERS = ("logs",)
+REPORT_FILE_NAME = "backup_report.json"
+STATE_FILE_NAME = "backup_state.json"
+JOURNAL_FILE_NAME = "backup_journal.ndjson"
+
+
 def github_auth(client_id=None, client_secret=None, access_token=None):
     try:
         if client_id and client_secret:
             g = Github(client_id=client_id, client_secret=client_secret)
         elif access_token:
-            g = Github(access_token)
+            # Every client of the run shares one rate limit governor and response cache
+            g = build_github_client(get_default_governor(), get_default_cache(), auth=Auth.Token(access_token))
         else:
             raise ValueError("No auth parameters provided.")
         return g
 
     except BadCredentialsException as e:
         print("Github Invalid Credentials:", e)
-    except RateLimitExceededException as e:
-        print("Github Rate limit exceeded.", e)
     except Exception as e:
         print("Github Auth issues:", e)
 
     return None
 
+
+def get_thread_github_client(access_token):
+    """Return the Github client owned by the calling thread.
+
+    PyGithub keeps a single connection object per client, so worker threads
+    must not share one."""
+    client = getattr(_thread_state, "github", None)
+    if client is None:
+        client = github_auth(access_token=access_token)
+        _thread_state.github = client
+    return client
+
+
+def bind_repository_to_thread(repo, access_token):
+    # Rebuild the repository from the listing payload. The raw_data and raw_headers properties
+    # would first complete the object with one more request per repository, the fields are read as they are
+    client = get_thread_github_client(access_token)
+    return client.create_from_raw_data(Repository, repo._rawData, repo._headers)
+
+
 def create_folder(path):
     os.makedirs(path, exist_ok=True)
 
+
 def save_data_to_json(data, output_file):
+    # Written under a temporary name and renamed, a crash never leaves a truncated file behind
+    partial_file = f"{output_file}.partial"
     try:
-        with open(output_file, "w") as file:
+        with open(partial_file, "w") as file:
             json.dump(data, file, indent=4)
+        os.replace(partial_file, output_file)
     except Exception as e:
         print(f"Error while saving data to JSON: {e}")
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
 
+def compress_directory(directory, files=None, archive_format="zip", workers=ARCHIVE_WORKERS, archive_path=None, outputs=()):
+    """Archive the directory next to it, or only the given files relative to it.
 
-def compress_directory(directory):
-    
+    Entries are written in a fixed order with a fixed timestamp, so unchanged content
+    gives a byte identical archive. The index and reflogs of a clone are left out. Files whose content is already compressed, git
+    bundles and packs among them, are stored as they are. The archive is named after
+    the time it is taken, archive_path names it instead, see new_archive_path. What is
+    written is also sent to every stream of outputs, an upload can start before the
+    archive is complete."""
+
+    archive_path = archive_path or new_archive_path(directory, archive_format)
+    # Written under a temporary name so concurrent publishers never pick up a partial archive
+    partial_file_name = f'{archive_path}.partial'
     try:
-        current_date = datetime.datetime.now()
-        date_str = current_date.strftime('%Y-%m-%d')
-        zip_file_name = f'{directory}_{date_str}.zip'
-        
-        with zipfile.ZipFile(zip_file_name, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for root, subdirs, files in os.walk(directory):
-                for file in files:
-                    full_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(full_path, directory)
-                    zip_file.write(full_path, relative_path)
-
-        print(f'ZIP file created: {zip_file_name}')
-        logging.info(f'ZIP file created: {zip_file_name}')
+        if files is None:
+            files = []
+            for root, subdirs, file_names in os.walk(directory):
+                # Leftovers of an interrupted run are not part of the backup
+                subdirs[:] = [subdir for subdir in subdirs if not subdir.endswith(".partial")]
+                if os.path.basename(root) == ".git":
+                    # The index and the reflogs hold file times and clone times, restores do not need them
+                    subdirs[:] = [subdir for subdir in subdirs if subdir not in VOLATILE_GIT_FOLDERS]
+                    file_names = [file for file in file_names if file not in VOLATILE_GIT_FILES]
+                for file in file_names:
+                    if not file.endswith(".partial"):
+                        files.append(os.path.relpath(os.path.join(root, file), directory))
+
+        with open(partial_file_name, "wb") as archive_file:
+            write_archive(directory, files, ArchiveOutput(archive_file, *outputs), archive_format, workers)
+        os.replace(partial_file_name, archive_path)
+
+        print(f'Archive created: {archive_path}')
+        logging.info(f'Archive created: {archive_path}')
+        return archive_path
 
     except Exception as e:
         error_message = f'Error during compression: {str(e)}'
         print(error_message)
         logging.error(error_message)
+        if os.path.exists(partial_file_name):
+            os.remove(partial_file_name)
         raise
-    
-def backup_labels(repo, repo_folder):
+
+
+def get_graphql_exporter(repo):
+    return GraphQLExporter(repo.requester, get_default_governor())
+
+
+def get_http_exporter(repo):
+    """Return the HTTP exporter owned by the calling thread, its connections stay open across repositories."""
+    exporter = getattr(_thread_state, "http_exporter", None)
+    governor, cache = get_default_governor(), get_default_cache()
+    if exporter is None or (exporter.auth, exporter.governor, exporter.cache) != (repo.requester.auth, governor, cache):
+        if exporter is not None:
+            exporter.close()
+        exporter = HTTPExporter.from_requester(repo.requester, governor, cache)
+        _thread_state.http_exporter = exporter
+    return exporter
+
+
+def backup_labels(repo, repo_folder, export_engine="rest"):
 
     try:
-        labels = repo.get_labels()
-        labels_data = [{"name": label.name, "color": label.color} for label in labels]
+        if export_engine == "graphql":
+            labels_data = get_graphql_exporter(repo).get_labels(*repo.full_name.split("/"))
+        elif export_engine == "http":
+            labels_data = get_http_exporter(repo).get_labels(repo.url)
+        else:
+            labels = repo.get_labels()
+            labels_data = [{"name": label.name, "color": label.color} for label in labels]
         output_file = os.path.join(repo_folder, "labels.json")
         save_data_to_json(labels_data, output_file)
-        
+
     except Exception as e:
         print(f"Error backing up labels for the repository {repo.name}: {e}")
     logging.info("END Backing up repo Labels...")
 
 
-def backup_issues(repo, repo_folder):
+def serialize_issue(issue):
+    return {
+        "number": issue.number,
+        "title": issue.title,
+        "body": issue.body,
+        "state": issue.state,
+        "created_at": issue.created_at.isoformat(),
+        "updated_at": issue.updated_at.isoformat(),
+        "closed_at": issue.closed_at.isoformat() if issue.closed_at else None,
+        "user": issue.user.login,
+        # The issue listing already embeds the labels, issue.get_labels() would cost one request per issue
+        "labels": [label.name for label in issue.labels]
+    }
+
+
+def get_issues_file_name(issues_format="json", compress_issues=False):
+    if issues_format == "ndjson":
+        return "issues.ndjson.gz" if compress_issues else "issues.ndjson"
+    return "issues.json"
 
+
+def load_issues_watermark(repo_folder, issues_file="issues.json"):
+    state_file = os.path.join(repo_folder, "issues_state.json")
+    if not os.path.exists(state_file) or not os.path.exists(os.path.join(repo_folder, issues_file)):
+        return None
     try:
-        issues = repo.get_issues(state="all")
-        issues_data = []
+        with open(state_file, "r") as file:
+            return datetime.datetime.fromisoformat(json.load(file)["updated_at"])
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable issues watermark {state_file}: {e}")
+        return None
+
+
+def merge_issues(existing_issues, updated_issues):
+    # Issues are keyed by number, newer data replaces the stored copy
+    issues_by_number = {issue["number"]: issue for issue in existing_issues}
+    for issue in updated_issues:
+        issues_by_number[issue["number"]] = issue
+    return sorted(issues_by_number.values(), key=lambda issue: issue["number"], reverse=True)
+
+
+def merge_issue_stream(issues_file, updated_issues):
+    """Yield the issues stored in an NDJSON file with the updated ones swapped in.
+
+    Only the issue numbers of the stored file are held in memory, issues that were
+    not stored yet come first."""
+    updated_by_number = {issue["number"]: issue for issue in updated_issues}
+    stored_numbers = {issue["number"] for issue in iter_ndjson(issues_file)}
+    for number in sorted(set(updated_by_number) - stored_numbers, reverse=True):
+        yield updated_by_number[number]
+    for issue in iter_ndjson(issues_file):
+        yield updated_by_number.get(issue["number"], issue)
+
+
+def iter_issue_pages(issues, per_page):
+    """Yield the issues of a paginated list one page at a time.
+
+    Iterating a PaginatedList keeps every element it fetched, get_page does not."""
+    page = 0
+    while True:
+        items = issues.get_page(page)
+        yield from items
+        if len(items) < per_page:
+            return
+        page += 1
+
+
+def backup_issues_ndjson(repo, issues, output_file, since=None):
+    """Stream the serialized issues to an NDJSON file and return the newest updated_at seen."""
+    newest = {"updated_at": since}
+
+    def serialized_issues():
         for issue in issues:
-            issue_info = {
-                "number": issue.number,
-                "title": issue.title,
-                "body": issue.body,
-                "state": issue.state,
-                "created_at": issue.created_at.isoformat(),
-                "updated_at": issue.updated_at.isoformat(),
-                "closed_at": issue.closed_at.isoformat() if issue.closed_at else None,
-                "user": issue.user.login,
-                "labels": [label.name for label in issue.get_labels()]
-            }
-            issues_data.append(issue_info)
-            
-        output_file = os.path.join(repo_folder, "issues.json")
-        save_data_to_json(issues_data, output_file)
-        
+            updated_at = datetime.datetime.fromisoformat(issue["updated_at"])
+            if newest["updated_at"] is None or updated_at > newest["updated_at"]:
+                newest["updated_at"] = updated_at
+            yield issue
+
+    if since:
+        # Only the issues updated since the watermark are held in memory
+        updated_issues = sorted(serialized_issues(), key=lambda issue: issue["number"], reverse=True)
+        count = write_ndjson(output_file, merge_issue_stream(output_file, updated_issues))
+    else:
+        count = write_ndjson(output_file, serialized_issues())
+    logging.info(f"{count} issues of {repo.name} written to {output_file}")
+    return newest["updated_at"].isoformat() if newest["updated_at"] else None
+
+
+def backup_issues(repo, repo_folder, full_resync=False, issues_format="json", compress_issues=False, export_engine="rest"):
+
+    try:
+        issues_file = get_issues_file_name(issues_format, compress_issues)
+        output_file = os.path.join(repo_folder, issues_file)
+        since = None if full_resync else load_issues_watermark(repo_folder, issues_file)
+
+        if since:
+            logging.info(f"Fetching issues of {repo.name} updated since {since.isoformat()}")
+
+        if export_engine == "graphql":
+            # Issues and pull requests come with their labels, a page of about a hundred per query
+            exporter = get_graphql_exporter(repo)
+            issues = exporter.iter_issues(*repo.full_name.split("/"), since.astimezone(datetime.timezone.utc) if since else None)
+        elif export_engine == "http":
+            # Pages of a hundred issues read ahead on a pooled session, serialized from their JSON
+            issues = get_http_exporter(repo).iter_issues(repo.url, since.astimezone(datetime.timezone.utc) if since else None)
+        elif since:
+            issues = repo.get_issues(state="all", since=since.astimezone(datetime.timezone.utc))
+        else:
+            issues = repo.get_issues(state="all")
+
+        if export_engine == "rest" and issues_format == "ndjson":
+            issues = (serialize_issue(issue) for issue in iter_issue_pages(issues, repo.requester.per_page))
+        elif export_engine == "rest":
+            issues = (serialize_issue(issue) for issue in issues)
+
+        if issues_format == "ndjson":
+            watermark = backup_issues_ndjson(repo, issues, output_file, since)
+        else:
+            issues_data = list(issues)
+            watermark = max((issue["updated_at"] for issue in issues_data), key=datetime.datetime.fromisoformat, default=None)
+
+            if since:
+                with open(output_file, "r") as file:
+                    issues_data = merge_issues(json.load(file), issues_data)
+                if watermark is None:
+                    watermark = since.isoformat()
+
+            save_data_to_json(issues_data, output_file)
+
+        if export_engine == "graphql":
+            logging.info(f"GraphQL export of {repo.name}: {json.dumps(exporter.report())}")
+        if watermark:
+            save_data_to_json({"updated_at": watermark}, os.path.join(repo_folder, "issues_state.json"))
+        # Issues saved in another format by a previous run would be restored instead
+        for stale_file in ISSUES_FILES:
+            if stale_file != issues_file and os.path.exists(os.path.join(repo_folder, stale_file)):
+                os.remove(os.path.join(repo_folder, stale_file))
+
     except Exception as e:
         print(f"Error backing up issues for the repository {repo.name}: {e}")
 
+
 def backup_repository(repo, repo_folder):
-    
+
     repo_data = {
         "name": repo.name,
         "description": repo.description,
@@ -127,42 +364,204 @@ def backup_repository(repo, repo_folder):
         "created_at": repo.created_at.isoformat(),
         "updated_at": repo.updated_at.isoformat()
     }
-    
+
     output_file = os.path.join(repo_folder, "repository.json")
     save_data_to_json(repo_data, output_file)
-        
-        
-def clone_repository(repo, repo_backup_folder, token):
+
+
+def get_clone_url(repo, token=None):
+    return get_git_url(repo.full_name, token)
+
+
+def update_mirror_cache(repo, mirror_cache_dir, token):
+    """Create or refresh the bare --mirror copy of the repository kept in mirror_cache_dir.
+
+    The first run clones the whole repository, later runs only fetch what changed
+    since the previous one."""
+    mirror_path = os.path.join(mirror_cache_dir, f"{repo.full_name}.git")
+
+    if os.path.isdir(mirror_path):
+        mirror = Repo(mirror_path)
+        try:
+            mirror.git.remote("set-url", "origin", get_clone_url(repo, token))
+            mirror.git.fetch("--prune", "origin")
+            logging.info(f"Mirror cache updated: {mirror_path}")
+        except GitCommandError as e:
+            logging.warning(f"Mirror cache {mirror_path} could not be updated, cloning it again: {str(e)}")
+            shutil.rmtree(mirror_path)
+            mirror = Repo.clone_from(get_clone_url(repo, token), mirror_path, mirror=True)
+    else:
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+        mirror = Repo.clone_from(get_clone_url(repo, token), mirror_path, mirror=True)
+        logging.info(f"Mirror cache created: {mirror_path}")
+
+    # Do not keep the token in the cached configuration
+    mirror.git.remote("set-url", "origin", get_clone_url(repo))
+    mirror.git.clear_cache()
+    return mirror_path
+
+
+def clone_repository(repo, repo_backup_folder, token, mirror_cache_dir=None):
     logging.info("Cloning repository...")
-    logging.info(f"Parameters: repo_folder={repo_backup_folder}, repo_clone={repo_clone}, repo_name={repo.name}")
-    
-    now = datetime.datetime.now()
-    subfolder_name = f"repo_cloned_{repo.name}_{now.strftime('%Y-%m-%d_%H-%M-%S')}"
+    logging.info(f"Parameters: repo_folder={repo_backup_folder}, mirror_cache_dir={mirror_cache_dir}, repo_name={repo.name}")
+
+    # The folder keeps its name from one run to the next, an unchanged repository archives to the same bytes
+    subfolder_name = f"repo_cloned_{repo.name}"
     subfolder_path = os.path.join(repo_backup_folder, subfolder_name)
-        
+    # Cloned under a temporary name, a clone interrupted by a crash is never taken for a complete one
+    partial_path = f"{subfolder_path}.partial"
+
     try:
-        os.makedirs(subfolder_path, exist_ok=True)
-            
-        clone_url_with_token = f"https://{token}@github.com/{repo.full_name}.git"
-        repo_temp = Repo.clone_from(clone_url_with_token, subfolder_path, no_single_branch=True)
-            
-        #TODO Should we include and create the Zip at this level ? this could improve in performance the process ?
-        #repo_temp.git.archive("--format", "zip", "--output", f"{subfolder_path}.zip", "HEAD")
+        if os.path.exists(partial_path):
+            rmtree(partial_path)
+        os.makedirs(partial_path)
+
+        if mirror_cache_dir:
+            # Local clone from the cache, objects are hard linked instead of downloaded
+            source_url = update_mirror_cache(repo, mirror_cache_dir, token)
+        else:
+            source_url = get_clone_url(repo, token)
+        repo_temp = Repo.clone_from(source_url, partial_path, no_single_branch=True)
+        # Neither the token nor the path of the mirror is kept in the archived configuration
+        repo_temp.git.remote("set-url", "origin", get_clone_url(repo))
+        repo_temp.git.clear_cache()
+        # The previous clone is replaced, a directory is only renamed over an empty one
+        if os.path.exists(subfolder_path):
+            rmtree(subfolder_path)
+        os.replace(partial_path, subfolder_path)
+        # Clones of older versions were named after their time, the archive holds the newest clone only
+        for name in os.listdir(repo_backup_folder):
+            if name.startswith(f"repo_cloned_{repo.name}_"):
+                rmtree(os.path.join(repo_backup_folder, name))
+
         logging.info(f"Repository cloned successfully to {subfolder_path}")
-            
+
         if os.listdir(subfolder_path):
             logging.info("Repository folder contains files.")
         else:
             logging.warning("Repository folder is empty.")
-                
+
         gc.collect()
-        repo_temp.git.clear_cache()
-        return subfolder_path 
-            
+        return subfolder_path
+
     except GitCommandError as e:
         logging.error(f"Error during repository cloning: {str(e)}")
-        return None 
-        
+        if os.path.exists(partial_path):
+            rmtree(partial_path)
+        return None
+
+
+def list_mirror_refs(mirror):
+    refs = {}
+    for line in mirror.git.for_each_ref("--format=%(objectname) %(refname)").splitlines():
+        sha, ref = line.split(" ", 1)
+        refs[ref] = sha
+    return refs
+
+
+def load_bundle_manifest(repo_backup_folder):
+    manifest_file = os.path.join(repo_backup_folder, "bundles.json")
+    if not os.path.exists(manifest_file):
+        return {"chain": []}
+    with open(manifest_file, "r") as file:
+        return json.load(file)
+
+
+def create_repository_bundle(repo, repo_backup_folder, mirror_path, full_interval=BUNDLE_FULL_INTERVAL):
+    """Write a git bundle of the mirror and record it in the bundles.json chain manifest.
+
+    The first bundle of a chain holds every ref and object. The following ones only hold
+    the objects that are not reachable from the refs recorded by the previous entry, so a
+    point in time is rebuilt by fetching the chain in order up to that entry. Every archive
+    carries the whole chain, see bundle_archive_files. A new full bundle starts a new chain
+    every full_interval entries, once the incremental bundles together are as large as the
+    full one, and BUNDLE_CHAIN_MIN_BYTES, or when a bundle of the chain is missing. Returns the path of the new bundle,
+    or None when nothing had to be written."""
+    mirror = Repo(mirror_path)
+    refs = list_mirror_refs(mirror)
+    if not refs:
+        logging.warning(f"Repository {repo.name} has no refs, no bundle created.")
+        return None
+
+    manifest = load_bundle_manifest(repo_backup_folder)
+    chain = manifest["chain"]
+
+    if chain and len(chain) < full_interval and is_bundle_chain_reusable(repo_backup_folder, chain):
+        previous_refs = chain[-1]["refs"]
+        if previous_refs == refs:
+            logging.info(f"Repository {repo.name} unchanged since the last bundle.")
+            return None
+        # Objects that were garbage collected from the mirror can no longer be excluded
+        prerequisites = sorted({sha for sha in previous_refs.values() if mirror.git.cat_file("-t", sha, with_exceptions=False)})
+        bundle_type = "incremental"
+    else:
+        for entry in chain:
+            if entry["file"] and os.path.exists(os.path.join(repo_backup_folder, entry["file"])):
+                os.remove(os.path.join(repo_backup_folder, entry["file"]))
+        chain = []
+        prerequisites = []
+        bundle_type = "full"
+
+    now = datetime.datetime.now()
+    bundle_file = f"{repo.name}_{now.strftime('%Y-%m-%d_%H-%M-%S')}.bundle"
+    bundle_path = os.path.join(repo_backup_folder, bundle_file)
+    try:
+        # Renamed once complete, like every file of a backup
+        mirror.git.bundle("create", f"{bundle_path}.partial", "--all", *[f"^{sha}" for sha in prerequisites])
+        os.replace(f"{bundle_path}.partial", bundle_path)
+        logging.info(f"{bundle_type.capitalize()} bundle created: {bundle_path}")
+    except GitCommandError as e:
+        if "empty bundle" not in str(e):
+            raise
+        # Refs only moved to commits the chain already holds, the manifest entry is enough
+        logging.info(f"No new objects for {repo.name}, recording the ref changes only.")
+        bundle_file = None
+        bundle_path = None
+
+    chain.append({
+        "file": bundle_file,
+        "type": bundle_type,
+        "created_at": now.isoformat(),
+        "prerequisites": prerequisites,
+        "refs": refs
+    })
+    save_data_to_json({"repository": repo.full_name, "chain": chain}, os.path.join(repo_backup_folder, "bundles.json"))
+    mirror.git.clear_cache()
+    return bundle_path
+
+
+def is_bundle_chain_reusable(repo_backup_folder, chain):
+    # An archive holds the full bundle and every incremental one, they stay below twice the full one
+    paths = [os.path.join(repo_backup_folder, entry["file"]) for entry in chain if entry["file"]]
+    if not all(os.path.exists(path) for path in paths):
+        return False
+    return sum(os.path.getsize(path) for path in paths[1:]) < max(os.path.getsize(paths[0]), BUNDLE_CHAIN_MIN_BYTES)
+
+
+def backup_repository_bundle(repo, repo_backup_folder, token, mirror_cache_dir=None, full_interval=BUNDLE_FULL_INTERVAL):
+    if mirror_cache_dir:
+        mirror_path = update_mirror_cache(repo, mirror_cache_dir, token)
+        create_repository_bundle(repo, repo_backup_folder, mirror_path, full_interval)
+    else:
+        temp_cache_dir = tempfile.mkdtemp(prefix="gh_backup_mirror_")
+        try:
+            mirror_path = update_mirror_cache(repo, temp_cache_dir, token)
+            create_repository_bundle(repo, repo_backup_folder, mirror_path, full_interval)
+        finally:
+            shutil.rmtree(temp_cache_dir, ignore_errors=True)
+
+    return bundle_archive_files(repo_backup_folder)
+
+
+def bundle_archive_files(repo_backup_folder):
+    """Files of a bundle backup archive: the metadata, the bundles.json manifest and every bundle of its chain.
+
+    An archive restores on its own, the incremental bundles need the ones before them."""
+    files = [name for name in sorted(os.listdir(repo_backup_folder))
+             if os.path.isfile(os.path.join(repo_backup_folder, name)) and not name.endswith((".bundle", ".partial"))]
+    return files + [entry["file"] for entry in load_bundle_manifest(repo_backup_folder)["chain"] if entry["file"]]
+
+
 def rmtree(path):
     """Remove the given recursively.
 
@@ -179,60 +578,577 @@ def rmtree(path):
     return shutil.rmtree(path, False, onerror)
 
 
-def get_container_client(account_name, account_key, container_name):
+def get_container_client(account_name, account_key, container_name, connection_string=None):
 
-    connection_string = f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
+    if connection_string is None:
+        connection_string = f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
     blob_service_client = BlobServiceClient.from_connection_string(connection_string)
     container_client = blob_service_client.get_container_client(container_name)
 
     return container_client
 
-def publish_repositories_backups(container_client, local_organization_directory):
-    
-    for repo_backup in os.listdir(local_organization_directory):
-        repo_backup_path = os.path.join(local_organization_directory, repo_backup)
 
-        if os.path.isfile(repo_backup_path) and repo_backup.endswith(".zip"):
-            blob_name = f"{repo_backup}"
-            with open(repo_backup_path, "rb") as data:
-                container_client.upload_blob(name=blob_name, data=data, overwrite=True)
+class UploadManifest:
+    """sha256 of every published artifact, kept in upload_manifest.json.
 
+    artifacts maps an archive name to its hash, size and the blob holding that content.
+    An archive identical to the last one published for its repository is not uploaded,
+    it is recorded as a reference to the blob that already holds it."""
 
-                  
-def backup_repository_resources(repo, org_folder, repo_clone, include_labels, include_issues, access_token, publish_backup):
-    #TODO Fixme . This should be a env variable instead
-    remove_local_repo_dir = False
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data or {"artifacts": {}, "latest": {}}
+        self.lock = threading.Lock()
+        self.recorded = set()
+
+    @classmethod
+    def load(cls, path, container_client=None):
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                return cls(path, json.load(file))
+        if container_client is not None:
+            # A fresh runner starts from the copy published with the previous run
+            try:
+                return cls(path, json.loads(container_client.download_blob(UPLOAD_MANIFEST_NAME).readall()))
+            except Exception as e:
+                logging.info(f"No published upload manifest found: {e}")
+        return cls(path)
+
+    def latest(self, repository):
+        with self.lock:
+            artifact = self.data["latest"].get(repository)
+            return dict(self.data["artifacts"][artifact]) if artifact else None
+
+    def record(self, repository, artifact, sha256, size, blob):
+        with self.lock:
+            self.data["artifacts"][artifact] = {
+                "repository": repository,
+                "sha256": sha256,
+                "size": size,
+                "blob": blob,
+                "recorded_at": datetime.datetime.now().isoformat()
+            }
+            self.data["latest"][repository] = artifact
+            self.recorded.add(repository)
+
+    def merge(self, published):
+        """Add the entries another node published, the repositories recorded here keep their latest artifact."""
+        with self.lock:
+            for artifact, entry in published.get("artifacts", {}).items():
+                self.data["artifacts"].setdefault(artifact, entry)
+            for repository, artifact in published.get("latest", {}).items():
+                if repository not in self.recorded:
+                    self.data["latest"][repository] = artifact
+
+    def publish(self, container_client):
+        # The published copy is replaced only if no other node updated it since it was read
+        for attempt in range(UPLOAD_MANIFEST_SAVE_ATTEMPTS):
+            etag = None
+            try:
+                downloader = container_client.download_blob(UPLOAD_MANIFEST_NAME)
+                published = json.loads(downloader.readall())
+                etag = downloader.properties.etag
+                self.merge(published)
+            except Exception as e:
+                logging.info(f"No published upload manifest to merge: {e}")
+            with self.lock:
+                content = json.dumps(self.data, indent=4, sort_keys=True)
+            try:
+                if etag:
+                    container_client.upload_blob(name=UPLOAD_MANIFEST_NAME, data=content, overwrite=True, etag=etag,
+                                                 match_condition=MatchConditions.IfNotModified)
+                else:
+                    container_client.upload_blob(name=UPLOAD_MANIFEST_NAME, data=content, overwrite=False)
+                return
+            except (ResourceModifiedError, ResourceExistsError):
+                logging.info("Upload manifest updated by another node, merging again")
+        logging.warning("Upload manifest kept changing, overwriting it")
+        container_client.upload_blob(name=UPLOAD_MANIFEST_NAME, data=content, overwrite=True)
+
+    def save(self, container_client=None):
+        if container_client is not None:
+            self.publish(container_client)
+        with self.lock:
+            content = json.dumps(self.data, indent=4, sort_keys=True)
+        partial_path = f"{self.path}.partial"
+        with open(partial_path, "w") as file:
+            file.write(content)
+        os.replace(partial_path, self.path)
+
+
+class BackupState:
+    """What every repository looked like at its last successful backup, kept in backup_state.json.
+
+    An entry holds the pushed_at and updated_at of the repository listing, a digest of its
+    refs and the options it was backed up with."""
+
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data or {"repositories": {}}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    return cls(path, json.load(file))
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable backup state {path}: {e}")
+        return cls(path)
+
+    def get(self, repository):
+        with self.lock:
+            entry = self.data["repositories"].get(repository)
+            return dict(entry) if entry else None
+
+    def record(self, repository, entry):
+        with self.lock:
+            self.data["repositories"][repository] = dict(entry, backed_up_at=datetime.datetime.now().isoformat())
+
+    def save(self):
+        with self.lock:
+            content = json.dumps(self.data, indent=4, sort_keys=True)
+        partial_path = f"{self.path}.partial"
+        with open(partial_path, "w") as file:
+            file.write(content)
+        os.replace(partial_path, self.path)
+
+
+class BackupJournal:
+    """Journal of the steps every repository completed in a run, one JSON line appended per step.
+
+    Every line is flushed and synced before the run goes on, so a run killed at any point
+    is resumed from the journal: completed steps are not done again and the step that was
+    interrupted is redone. A line cut short by the crash is ignored. The journal of a run
+    that finished is removed, without resume a run starts a new one."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.steps = {}
+        self.lock = threading.Lock()
+        if resume and os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Ignoring a truncated line of the backup journal {path}")
+                        continue
+                    self.steps[(entry["repository"], entry["step"])] = entry
+            logging.info(f"Resuming from {path}, {len(self.steps)} steps already completed")
+        else:
+            open(path, "w").close()
+
+    def completed(self, repository, step):
+        """The entry recorded when the step of the repository completed, None if it did not."""
+        with self.lock:
+            entry = self.steps.get((repository, step))
+            return dict(entry) if entry else None
+
+    def record(self, repository, step, **details):
+        entry = dict(details, repository=repository, step=step)
+        with self.lock:
+            self.steps[(repository, step)] = entry
+            with open(self.path, "a") as file:
+                file.write(json.dumps(entry, sort_keys=True) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def finish(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def list_remote_refs_digest(repo, token):
+    """sha256 of the branches, tags and notes of the remote repository, from a single ls-remote."""
+    output = Git().ls_remote("--refs", get_clone_url(repo, token))
+    # Pull request refs change with every fork push, they are not backed up
+    refs = sorted(line for line in output.splitlines() if not line.split("\t")[-1].startswith("refs/pull/"))
+    return hashlib.sha256("\n".join(refs).encode()).hexdigest()
+
+
+def get_repository_state(repo, options, refs=None):
+    return {
+        "pushed_at": repo.pushed_at.isoformat() if repo.pushed_at else None,
+        "updated_at": repo.updated_at.isoformat() if repo.updated_at else None,
+        "refs": refs,
+        "options": options
+    }
+
+
+def is_repository_unchanged(entry, current):
+    # A state recorded without refs, or with other options, cannot vouch for the clone
+    return entry is not None and entry.get("refs") is not None and \
+        all(entry.get(key) == current[key] for key in ("pushed_at", "updated_at", "refs", "options"))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def publish_repository_backup(container_client, repo_backup_path, manifest=None, repository=None):
+    blob_name = os.path.basename(repo_backup_path)
+    sha256 = file_sha256(repo_backup_path)
+    size = os.path.getsize(repo_backup_path)
+    add_stage_counters(bytes_read=size)
+    repository = repository or blob_name
+
+    if manifest is not None:
+        previous = manifest.latest(repository)
+        if previous and previous["sha256"] == sha256:
+            manifest.record(repository, blob_name, sha256, size, previous["blob"])
+            logging.info(f"Backup {blob_name} unchanged, referencing {previous['blob']} instead of uploading it")
+            return previous["blob"]
+
+    with open(repo_backup_path, "rb") as data:
+        container_client.upload_blob(name=blob_name, data=data, overwrite=True, max_concurrency=UPLOAD_MAX_CONCURRENCY,
+                                     metadata={"sha256": sha256})
+    add_stage_counters(bytes_written=size)
+    if manifest is not None:
+        manifest.record(repository, blob_name, sha256, size, blob_name)
+    logging.info(f"Backup published: {blob_name}")
+    return blob_name
+
+
+class BlobUploadStream:
+    """Write only stream uploading what is written to it as the blocks of a block blob.
+
+    Every UPLOAD_BLOCK_SIZE bytes are staged as a block by one of workers threads while
+    the next ones are written, at most twice as many blocks wait in memory. The sha256 of
+    the content is computed on the way. Nothing is visible in the container before commit,
+    blocks never committed are discarded by the storage service."""
+
+    def __init__(self, blob_client, block_size=None, workers=UPLOAD_MAX_CONCURRENCY):
+        self.blob_client = blob_client
+        self.block_size = block_size or UPLOAD_BLOCK_SIZE
+        self.max_pending = max(1, workers) * 2
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="block-upload")
+        self.buffer = bytearray()
+        self.pending = []
+        self.block_ids = []
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.digest.update(data)
+        self.size += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._stage(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _stage(self, block):
+        # Block ids of a blob must all have the same length
+        block_id = f"{len(self.block_ids):08d}"
+        self.block_ids.append(block_id)
+        self.pending.append(self.executor.submit(self.blob_client.stage_block, block_id, block))
+        if len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+
+    def finish(self):
+        """Stage what is left and wait for every block, returns the sha256 of the content."""
+        if self.buffer:
+            self._stage(bytes(self.buffer))
+            self.buffer.clear()
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        return self.digest.hexdigest()
+
+    def commit(self, metadata=None):
+        self.blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in self.block_ids], metadata=metadata)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def publish_streamed_backup(upload, repo_backup_path, manifest=None, repository=None):
+    """Commit the blocks an archive was uploaded as while it was written, see BlobUploadStream.
+
+    An archive identical to the latest one of the repository is referenced by the manifest
+    instead of being committed, its blocks are left to expire."""
+    blob_name = os.path.basename(repo_backup_path)
+    sha256 = upload.finish()
+    repository = repository or blob_name
+
+    if manifest is not None:
+        previous = manifest.latest(repository)
+        if previous and previous["sha256"] == sha256:
+            manifest.record(repository, blob_name, sha256, upload.size, previous["blob"])
+            logging.info(f"Backup {blob_name} unchanged, referencing {previous['blob']} instead of committing it")
+            return previous["blob"]
+
+    upload.commit({"sha256": sha256})
+    add_stage_counters(bytes_written=upload.size)
+    if manifest is not None:
+        manifest.record(repository, blob_name, sha256, upload.size, blob_name)
+    logging.info(f"Backup published: {blob_name}")
+    return blob_name
+
+
+def verify_published_backups(container_client, manifest, download=False):
+    """Check every artifact of the manifest against the blob holding it.
+
+    The sha256 stored as blob metadata is compared by default, download=True hashes
+    the blob content itself. Returns the list of problems found."""
+    problems = []
+    for artifact, entry in sorted(manifest.data["artifacts"].items()):
+        try:
+            blob_client = container_client.get_blob_client(entry["blob"])
+            stored_sha256 = blob_client.get_blob_properties().metadata.get("sha256")
+            if download:
+                digest = hashlib.sha256()
+                for chunk in blob_client.download_blob().chunks():
+                    digest.update(chunk)
+                stored_sha256 = digest.hexdigest()
+        except Exception as e:
+            problems.append(f"{artifact}: blob {entry['blob']} cannot be read ({e})")
+            continue
+        if stored_sha256 != entry["sha256"]:
+            problems.append(f"{artifact}: blob {entry['blob']} has sha256 {stored_sha256}, expected {entry['sha256']}")
+
+    for problem in problems:
+        logging.error(f"Integrity check failed for {problem}")
+    return problems
+
+
+def publish_repository_stage(metrics, container_client, repo_backup_path, manifest, repository):
+    with metrics.stage(repository, "publish"):
+        return publish_repository_backup(container_client, repo_backup_path, manifest, repository)
+
+
+def new_backup_job(repository, folder=None, compress=False):
+    """What the stages of the backup pipeline know about a repository."""
+    return {"repository": repository, "folder": folder, "compress": compress, "files": None, "cloned_folder": None,
+            "size": 0, "archive": None, "published": False, "unchanged": False, "state": None, "claimed": True}
+
+
+def fetch_repository_resources(repo, org_folder, repo_clone, include_labels, include_issues, access_token, full_resync=False, mirror_cache_dir=None, backup_format="zip", bundle_full_interval=BUNDLE_FULL_INTERVAL,
+                               issues_format="json", compress_issues=False, export_engine="rest", metrics=None, state=None, unchanged="backup", journal=None):
+    """Network bound part of a repository backup: labels, issues, metadata and the clone or bundle.
+
+    With a state and an unchanged mode other than backup, a repository whose timestamps
+    and refs match its last backup is skipped, or with metadata only its labels, issues
+    and metadata are refreshed and archived with the clone or bundles of the previous
+    backup, see find_previous_clone. With a journal the metadata and clone steps are recorded
+    once complete, and not done again when the journal of a resumed run holds them.
+    Returns the backup job compress_repository_backup archives."""
+    metrics = metrics or RunMetrics()
     repo_backup_folder = os.path.join(org_folder, repo.name)
+    options = {"repo_clone": repo_clone, "backup_format": backup_format, "include_labels": include_labels, "include_issues": include_issues,
+               "issues_format": issues_format, "compress_issues": compress_issues, "export_engine": export_engine}
+    job = new_backup_job(repo.name, repo_backup_folder, repo_clone)
+
+    fetched = journal.completed(repo.name, "metadata") if journal is not None else None
+    if fetched is not None:
+        logging.info(f"Metadata of {repo.name} already backed up by the interrupted run")
+        job.update(state=fetched["state"], unchanged=fetched["unchanged"], compress=fetched["compress"])
+        if job["unchanged"] and unchanged == "skip":
+            return job
+    else:
+        fetch_repository_metadata(repo, job, options, access_token, full_resync, metrics, state, unchanged)
+        if journal is not None:
+            journal.record(repo.name, "metadata", state=job["state"], unchanged=job["unchanged"], compress=job["compress"])
+        if job["unchanged"] and unchanged == "skip":
+            return job
+
+    if job["compress"]:
+        cloned = journal.completed(repo.name, "clone") if journal is not None else None
+        if is_clone_still_there(repo_backup_folder, cloned):
+            logging.info(f"Clone of {repo.name} already made by the interrupted run")
+            job.update(files=cloned["files"], cloned_folder=cloned["cloned_folder"], size=cloned["size"])
+            return job
+        previous = find_previous_clone(repo, repo_backup_folder, backup_format) if job["unchanged"] else None
+        if previous is not None:
+            logging.info(f"{repo.name} is archived with the history of its previous backup")
+            job.update(previous)
+        else:
+            clone_repository_stage(repo, job, access_token, mirror_cache_dir, backup_format, bundle_full_interval, metrics)
+        if journal is not None:
+            journal.record(repo.name, "clone", files=job["files"], cloned_folder=job["cloned_folder"], size=job["size"])
+    return job
+
+
+def clone_repository_stage(repo, job, access_token, mirror_cache_dir, backup_format, bundle_full_interval, metrics):
+    repo_backup_folder = job["folder"]
+    with metrics.stage(repo.name, "clone") as stage:
+        if backup_format == "bundle":
+            job["files"] = backup_repository_bundle(repo, repo_backup_folder, access_token, mirror_cache_dir, bundle_full_interval)
+            stage.add(bytes_written=sum(path_size(os.path.join(repo_backup_folder, name)) for name in job["files"] if name.endswith(".bundle")))
+        else:
+            job["cloned_folder"] = clone_repository(repo, repo_backup_folder, access_token, mirror_cache_dir)
+            stage.add(bytes_written=path_size(job["cloned_folder"]))
+        job["size"] = stage.counters["bytes_written"]
+
+
+def find_previous_clone(repo, repo_backup_folder, backup_format="zip"):
+    """What the previous backup of an unchanged repository left to archive, None when it is gone.
+
+    A zip backup keeps its clone in repo_cloned_<repository>, a bundle backup the bundles of
+    its chain. The history is unchanged, only the refreshed metadata makes a new archive."""
+    if backup_format == "bundle":
+        chain = load_bundle_manifest(repo_backup_folder)["chain"]
+        if not chain or not all(os.path.exists(os.path.join(repo_backup_folder, entry["file"])) for entry in chain if entry["file"]):
+            return None
+        files = bundle_archive_files(repo_backup_folder)
+        return {"files": files, "size": sum(path_size(os.path.join(repo_backup_folder, name)) for name in files if name.endswith(".bundle"))}
+    cloned_folder = os.path.join(repo_backup_folder, f"repo_cloned_{repo.name}")
+    if not os.path.isdir(cloned_folder):
+        return None
+    return {"cloned_folder": cloned_folder, "size": path_size(cloned_folder)}
+
+
+def is_clone_still_there(repo_backup_folder, entry):
+    """Whether the clone, or the bundle files, a journal entry records can be archived as they are."""
+    if entry is None:
+        return False
+    if entry["files"] is not None:
+        return all(os.path.exists(os.path.join(repo_backup_folder, name)) for name in entry["files"])
+    return bool(entry["cloned_folder"]) and os.path.isdir(entry["cloned_folder"])
+
+
+def fetch_repository_metadata(repo, job, options, access_token, full_resync, metrics, state, unchanged):
+    """Labels, issues and metadata of a repository, once the state tells it is not skipped."""
+    repo_backup_folder = job["folder"]
+    include_labels, include_issues = options["include_labels"], options["include_issues"]
+    issues_format, compress_issues, export_engine = options["issues_format"], options["compress_issues"], options["export_engine"]
+    if state is not None:
+        # The refs are listed before the clone, a push in between is picked up by the next run
+        with metrics.stage(repo.name, "check"):
+            refs = None
+            try:
+                refs = list_remote_refs_digest(repo, access_token) if options["repo_clone"] else ""
+            except GitCommandError as e:
+                logging.warning(f"Refs of {repo.name} could not be listed: {str(e)}")
+            job["state"] = get_repository_state(repo, options, refs)
+            job["unchanged"] = unchanged != "backup" and not full_resync and is_repository_unchanged(state.get(repo.name), job["state"])
+        if job["unchanged"]:
+            logging.info(f"{repo.name} is unchanged since its last backup, {'skipping it' if unchanged == 'skip' else 'refreshing its metadata'}")
+            if unchanged == "skip":
+                job["compress"] = False
+                return
+
     create_folder(repo_backup_folder)
 
     if include_labels:
-        backup_labels(repo, repo_backup_folder)
-        
+        with metrics.stage(repo.name, "labels") as stage:
+            backup_labels(repo, repo_backup_folder, export_engine)
+            stage.add(bytes_written=path_size(os.path.join(repo_backup_folder, "labels.json")))
+
     if include_issues:
-        backup_issues(repo, repo_backup_folder)
-        
-    backup_repository(repo, repo_backup_folder)
-    
-    if repo_clone:
-        cloned_folder = clone_repository(repo, repo_backup_folder, access_token )
-        compress_directory(repo_backup_folder)
-        time.sleep(4)
-
-    if  os.path.exists(cloned_folder) and remove_local_repo_dir:
+        issues_path = os.path.join(repo_backup_folder, get_issues_file_name(issues_format, compress_issues))
+        with metrics.stage(repo.name, "issues") as stage:
+            # An incremental backup reads the stored issues back to merge the updated ones
+            stored_size = 0 if full_resync else path_size(issues_path)
+            backup_issues(repo, repo_backup_folder, full_resync, issues_format, compress_issues, export_engine)
+            stage.add(bytes_read=stored_size, bytes_written=path_size(issues_path))
+
+    with metrics.stage(repo.name, "metadata") as stage:
+        backup_repository(repo, repo_backup_folder)
+        stage.add(bytes_written=path_size(os.path.join(repo_backup_folder, "repository.json")))
+
+
+def compress_repository_backup(job, metrics=None, archive_format="zip", archive_workers=ARCHIVE_WORKERS, container_client=None, manifest=None):
+    """CPU bound part of a repository backup: archive what fetch_repository_resources saved.
+
+    With a container_client the archive is uploaded while it is written and published
+    once complete, job["published"] is then set. Returns the archive created, if any."""
+    #TODO Fixme . This should be a env variable instead
+    remove_local_repo_dir = False
+    metrics = metrics or RunMetrics()
+    if not job["compress"]:
+        return None
+
+    archive_path = new_archive_path(job["folder"], archive_format)
+    upload = BlobUploadStream(container_client.get_blob_client(os.path.basename(archive_path))) if container_client is not None else None
+    try:
+        with metrics.stage(job["repository"], "compress") as stage:
+            if job["files"] is None:
+                stage.add(bytes_read=path_size(job["folder"]))
+            else:
+                stage.add(bytes_read=sum(path_size(os.path.join(job["folder"], name)) for name in job["files"]))
+            compress_directory(job["folder"], job["files"], archive_format, archive_workers, archive_path, [upload] if upload else ())
+            stage.add(bytes_written=path_size(archive_path))
+        if upload is not None:
+            # The blocks were staged during the compression, only the commit is left
+            with metrics.stage(job["repository"], "publish"):
+                publish_streamed_backup(upload, archive_path, manifest, job["repository"])
+            job["published"] = True
+    finally:
+        if upload is not None:
+            upload.close()
+
+    cloned_folder = job["cloned_folder"]
+    if cloned_folder and os.path.exists(cloned_folder) and remove_local_repo_dir:
         try:
             rmtree(cloned_folder)
         except OSError as e:
             print("Error: %s - %s." % (e.filename, e.strerror))
-               
-    if publish_backup: 
-       print(f"Azure Account Name: {azure_account_name}")
-       print(f"Azure Container Name: {azure_container_name}")
-       container_client = get_container_client(azure_account_name, azure_account_key, azure_container_name)
-    
-       publish_repositories_backups(container_client, org_folder)
-
-def backup_organization_resources(org_name, access_token, output_dir, repo_names=None, include_labels=True, include_issues=True, repo_clone=False, publish_backup=False):
+
+    return archive_path
+
+
+def backup_repository_resources(repo, org_folder, repo_clone, include_labels, include_issues, access_token, metrics=None, **options):
+    """Back up one repository into org_folder and return the archive created, if any.
+
+    Every stage is timed and its API calls, bytes and retries are recorded in metrics."""
+    metrics = metrics or RunMetrics()
+    job = fetch_repository_resources(repo, org_folder, repo_clone, include_labels, include_issues, access_token, metrics=metrics, **options)
+    return compress_repository_backup(job, metrics)
+
+
+def backup_repository_worker(repo, org_folder, repo_clone, include_labels, include_issues, access_token, **options):
+    worker_repo = bind_repository_to_thread(repo, access_token)
+    return fetch_repository_resources(worker_repo, org_folder, repo_clone, include_labels, include_issues, access_token, **options)
+
+
+def backup_organization_resources(org_name, access_token, output_dir, repo_names=None, include_labels=True, include_issues=True, repo_clone=False, publish_backup=False, workers=1, full_resync=False, mirror_cache_dir=None, backup_format="zip", bundle_full_interval=BUNDLE_FULL_INTERVAL, container_client=None, upload_workers=UPLOAD_WORKERS, verify_published=False, issues_format="json", compress_issues=False, export_engine="rest",
+                                  report_file=None, prometheus_file=None, compress_workers=COMPRESS_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, queue_max_bytes=None,
+                                  unchanged="backup", shard=None, work_queue=None, node_id=None, archive_format="zip", archive_workers=ARCHIVE_WORKERS,
+                                  stream_uploads=False, resume=False):
+    """Back up the repositories of an organization into output_dir and return the run report.
+
+    Repositories go through a pipeline: workers fetch their metadata and clones,
+    compress_workers archive them and upload_workers publish the archives, so network
+    and CPU bound work overlap. The queues between the stages hold at most queue_size
+    repositories, and queue_max_bytes of clones or archives when given, a stage waits
+    for the next one to catch up instead of filling the disk.
+
+    The state of every repository backed up is kept in backup_state.json. With unchanged
+    set to metadata or skip, repositories unchanged since their last backup are not cloned
+    again, see fetch_repository_resources.
+
+    shard, (i, N), limits the run to the repositories of shard i of N. With a work_queue
+    shared by several nodes a repository is backed up by the node that claims it first,
+    shard first, then the repositories other nodes have not taken yet. Both write an
+    organization.<node_id>.json fragment instead of organization.json, see
+    merge_organization_fragments.
+
+    Archives are written in archive_format, zip, tar.gz or tar.zst, the tar ones compressed
+    by archive_workers threads. With stream_uploads an archive is uploaded while it is
+    written, by the compress stage, instead of by a publish stage once written.
+
+    The steps every repository completes are appended to backup_journal.ndjson, see
+    BackupJournal. With resume a run interrupted by a crash goes on from its journal:
+    repositories it backed up are not backed up again, the others restart from their
+    first step not completed. The journal is removed once the run is over.
+
+    The report, timings and counters of every stage of every repository, is written to
+    report_file (<output_dir>/<org_name>/backup_report.json by default) and, when given,
+    to prometheus_file in the Prometheus text format."""
     logging.info("INIT  backup_organization_resources Method")
+    check_archive_format(archive_format)
+    metrics = RunMetrics()
     g = github_auth(access_token=access_token)
 
     try:
@@ -254,34 +1170,372 @@ def backup_organization_resources(org_name, access_token, output_dir, repo_names
     }
 
     try:
-        repositories = org.get_repos()
+        repositories = [repo for repo in org.get_repos() if repo_names is None or repo.name in repo_names]
         logging.info("Getting repositories for the organization " + str(repo_names))
     except Exception as e:
         print(f"Error getting the list of repositories: {e}")
         return
 
-    for repo in repositories:
-        if repo_names is None or repo.name in repo_names:
-            try:
-                backup_repository_resources(repo, org_folder, repo_clone, include_labels, include_issues, access_token, publish_backup)
-                org_data["repositories"].append(repo.name)
-            except Exception as e:
-                print(f"Error backing up the repository {repo.name}: {e}")
+    if shard is not None:
+        own = [repo for repo in repositories if shard_of(repo.name, shard[1]) == shard[0]]
+        logging.info(f"Shard {shard[0]}/{shard[1]}: {len(own)} of {len(repositories)} repositories")
+        # With a work queue the node goes on with the repositories of slower nodes
+        repositories = own + ([repo for repo in repositories if repo not in own] if work_queue is not None else [])
+    if shard is not None or work_queue is not None:
+        node_id = node_id or (f"shard-{shard[0]}-of-{shard[1]}" if shard is not None else default_node_id())
+
+    if publish_backup and container_client is None:
+        container_client = get_container_client(os.getenv("AZURE_ACCOUNT_NAME"), os.getenv("AZURE_ACCOUNT_KEY"),
+                                                os.getenv("AZURE_CONTAINER_NAME"), os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+    manifest = UploadManifest.load(os.path.join(org_folder, UPLOAD_MANIFEST_NAME), container_client) if publish_backup else None
+    state = BackupState.load(os.path.join(org_folder, STATE_FILE_NAME))
+    # Nodes sharing the folder keep journals of their own
+    journal_name = JOURNAL_FILE_NAME if node_id is None else JOURNAL_FILE_NAME.replace(".ndjson", f".{node_id}.ndjson")
+    journal = BackupJournal(os.path.join(org_folder, journal_name), resume)
+
+    repo_options = {
+        "full_resync": full_resync,
+        "mirror_cache_dir": mirror_cache_dir,
+        "backup_format": backup_format,
+        "bundle_full_interval": bundle_full_interval,
+        "issues_format": issues_format,
+        "compress_issues": compress_issues,
+        "export_engine": export_engine,
+        "metrics": metrics,
+        "state": state,
+        "unchanged": unchanged,
+        "journal": journal
+    }
+    backed_up = set()
+
+    def fetch(repo):
+        if work_queue is not None and not work_queue.claim(repo.name):
+            return dict(new_backup_job(repo.name), claimed=False)
+        job = resume_backup_job(journal, repo.name, manifest)
+        if job is not None:
+            return job
+        return backup_repository_worker(repo, org_folder, repo_clone, include_labels, include_issues, access_token, **repo_options)
 
-    with open(os.path.join(org_folder, "organization.json"), "w") as org_file:
-        org_file.write(json.dumps(org_data, indent=4))
-        
+    def compress(job):
+        if job["compress"]:
+            job["archive"] = compress_repository_backup(job, metrics, archive_format, archive_workers,
+                                                        container_client if publish_backup and stream_uploads else None, manifest)
+            journal.record(job["repository"], "archive", archive=job["archive"], state=job["state"], unchanged=job["unchanged"])
+            if job["published"]:
+                journal.record(job["repository"], "upload", **get_upload_details(manifest, job["repository"]))
+        return job
+
+    def publish(job):
+        # Only the archive of this repository is sent, uploads overlap with the remaining backups
+        if job["archive"] and not job["published"]:
+            publish_repository_stage(metrics, container_client, job["archive"], manifest, job["repository"])
+            job["published"] = True
+            journal.record(job["repository"], "upload", **get_upload_details(manifest, job["repository"]))
+        return job
+
+    def done(repo, job):
+        if not job["claimed"]:
+            return
+        journal.record(repo.name, "done", archive=job["archive"], state=job["state"], unchanged=job["unchanged"])
+        backed_up.add(repo.name)
+        if work_queue is not None:
+            work_queue.complete(repo.name, job["archive"] and os.path.basename(job["archive"]))
+        # The entry of an unchanged repository still describes its last archive
+        if job["unchanged"]:
+            metrics.set_status(repo.name, "unchanged")
+        else:
+            metrics.set_status(repo.name, "backed_up")
+            if job["state"] is not None:
+                state.record(repo.name, job["state"])
+
+    def failed(repo, stage_name, e):
+        if work_queue is not None:
+            work_queue.release(repo.name)
+        if stage_name == "publish":
+            print(f"Error publishing the backup of the repository {repo.name}: {e}")
+            metrics.set_status(repo.name, "publish_failed")
+        else:
+            print(f"Error backing up the repository {repo.name}: {e}")
+            metrics.set_status(repo.name, "failed")
+
+    stages = [
+        PipelineStage("fetch", fetch, workers),
+        PipelineStage("compress", compress, compress_workers, queue_size, queue_max_bytes, size=lambda job: job["size"])
+    ]
+    if publish_backup and not stream_uploads:
+        stages.append(PipelineStage("publish", publish, upload_workers, queue_size, queue_max_bytes,
+                                    size=lambda job: os.path.getsize(job["archive"]) if job["archive"] else 0))
+    if work_queue is not None:
+        work_queue.start()
+    try:
+        pipeline_report = run_pipeline(repositories, stages, done, failed)
+    finally:
+        if work_queue is not None:
+            work_queue.stop()
+    state.save()
+    journal.finish()
+
+    if publish_backup:
+        manifest.save(container_client)
+        if verify_published:
+            verify_published_backups(container_client, manifest)
+
+    # Keep the listing order whatever order the workers finished in
+    org_data["repositories"] = [repo.name for repo in repositories if repo.name in backed_up]
+
+    if node_id is not None:
+        org_data["node"] = node_id
+        org_data["shard"] = f"{shard[0]}/{shard[1]}" if shard is not None else None
+        save_data_to_json(org_data, os.path.join(org_folder, f"organization.{node_id}.json"))
+        if work_queue is not None:
+            work_queue.put(f"fragments/organization.{node_id}.json", org_data)
+    else:
+        save_data_to_json(org_data, os.path.join(org_folder, "organization.json"))
+
+    logging.info(f"GitHub API usage: {json.dumps(get_default_governor().report())}")
+    if get_default_cache() is not None:
+        logging.info(f"GitHub HTTP cache: {json.dumps(get_default_cache().report())}")
+
+    report = write_run_report(metrics, org_name, org_folder, report_file, prometheus_file, pipeline=pipeline_report)
     logging.info("END backup_organization_resources Method")
+    return report
+
+
+def get_upload_details(manifest, repository):
+    # The manifest is saved at the end of the run, the journal keeps what it recorded until then
+    return {"manifest": manifest.latest(repository) if manifest is not None else None}
+
+
+def resume_backup_job(journal, repository, manifest=None):
+    """Job of a repository whose archive the interrupted run of journal already wrote, None otherwise.
+
+    The job goes through the remaining stages as it is: an archive published is not
+    published again and its manifest entry is recorded again."""
+    finished = journal.completed(repository, "done")
+    archived = finished or journal.completed(repository, "archive")
+    if archived is None or (archived["archive"] and not os.path.isfile(archived["archive"])):
+        return None
+    uploaded = journal.completed(repository, "upload")
+    if uploaded is not None and uploaded["manifest"] is not None and manifest is not None:
+        entry = uploaded["manifest"]
+        manifest.record(repository, os.path.basename(archived["archive"]), entry["sha256"], entry["size"], entry["blob"])
+    logging.info(f"{repository} already backed up by the interrupted run, resuming after its archive")
+    return dict(new_backup_job(repository), archive=archived["archive"], published=finished is not None or uploaded is not None,
+                state=archived["state"], unchanged=archived["unchanged"])
+
+
+def write_run_report(metrics, org_name, org_folder, report_file=None, prometheus_file=None, **extra):
+    metrics.finish()
+    report = metrics.report(organization=org_name, api_usage=get_default_governor().report(),
+                            http_cache=get_default_cache().report() if get_default_cache() is not None else None, **extra)
+    save_data_to_json(report, report_file or os.path.join(org_folder, REPORT_FILE_NAME))
+    if prometheus_file:
+        metrics.write_prometheus_textfile(prometheus_file, labels={"organization": org_name})
+    logging.info(f"Backup stages: {json.dumps(report['stages'])}")
+    return report
+
+
+def write_migration_repository(org_name, org_folder, name, data, bundle_full_interval=BUNDLE_FULL_INTERVAL):
+    """Write a repository read from a migration archive in the layout of a bundle backup.
+
+    Returns the files of its archive: the metadata, the bundles.json manifest and the bundles of its chain."""
+    repo_backup_folder = os.path.join(org_folder, name)
+    create_folder(repo_backup_folder)
+    save_data_to_json(data["repository"], os.path.join(repo_backup_folder, "repository.json"))
+    save_data_to_json(data["labels"], os.path.join(repo_backup_folder, "labels.json"))
+    save_data_to_json(data["issues"], os.path.join(repo_backup_folder, "issues.json"))
+    # An export is complete, an incremental issues run must not merge into it
+    for stale_file in ISSUES_FILES[1:] + ("issues_state.json",):
+        if os.path.exists(os.path.join(repo_backup_folder, stale_file)):
+            os.remove(os.path.join(repo_backup_folder, stale_file))
+    if data["git_dir"]:
+        # The bare repository of the archive takes the place of the mirror, the bundle chain goes on from the previous backups
+        repo = types.SimpleNamespace(name=name, full_name=f"{org_name}/{name}")
+        create_repository_bundle(repo, repo_backup_folder, data["git_dir"], bundle_full_interval)
+    return bundle_archive_files(repo_backup_folder)
+
+
+def backup_organization_migration(org_name, access_token, output_dir, repo_names=None, publish_backup=False, workers=1, batch_size=MIGRATION_BATCH_SIZE,
+                                  poll_interval=POLL_INTERVAL, bundle_full_interval=BUNDLE_FULL_INTERVAL, container_client=None, upload_workers=UPLOAD_WORKERS,
+                                  compress_workers=COMPRESS_WORKERS, keep_archives=False, archive_path=None, report_file=None, prometheus_file=None,
+                                  archive_format="zip", archive_workers=ARCHIVE_WORKERS, stream_uploads=False):
+    """Back up the repositories of an organization through migration exports and return the run report.
+
+    GitHub exports batches of batch_size repositories, workers batches at a time, with
+    their git data, labels and issues. Every archive is streamed to
+    <output_dir>/<org_name>/migrations/, converted into the layout of a bundle backup,
+    then archived and published per repository like any backup, so restore.py reads it.
+    With archive_path, a migration archive downloaded before is converted instead.
+    keep_archives keeps the migration archives, on GitHub and locally, and publishes them when publishing.
+    archive_format, archive_workers and stream_uploads are those of backup_organization_resources."""
+    logging.info("INIT  backup_organization_migration Method")
+    check_archive_format(archive_format)
+    metrics = RunMetrics()
+    g = github_auth(access_token=access_token)
+
+    try:
+        org = g.get_organization(org_name)
+        repositories = [repo for repo in org.get_repos() if repo_names is None or repo.name in repo_names]
+    except Exception as e:
+        print(f"Error getting the organization repositories: {e}")
+        return
+
+    org_folder = os.path.join(output_dir, org_name)
+    migrations_folder = os.path.join(org_folder, "migrations")
+    create_folder(migrations_folder)
+    if publish_backup and container_client is None:
+        container_client = get_container_client(os.getenv("AZURE_ACCOUNT_NAME"), os.getenv("AZURE_ACCOUNT_KEY"),
+                                                os.getenv("AZURE_CONTAINER_NAME"), os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+    manifest = UploadManifest.load(os.path.join(org_folder, UPLOAD_MANIFEST_NAME), container_client) if publish_backup else None
+    exporter = MigrationExporter(HTTPExporter.from_requester(g.requester, get_default_governor(), get_default_cache()), org.url, poll_interval)
+
+    if archive_path:
+        batches = [repositories]
+    else:
+        batches = [repositories[index:index + batch_size] for index in range(0, len(repositories), batch_size)]
+    repositories_by_name = {repo.name: repo for repo in repositories}
+    run_date = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    migrations = [{"repositories": [repo.name for repo in batch]} for batch in batches]
+    backed_up = set()
+
+    def export(item):
+        index, batch = item
+        if archive_path:
+            return archive_path
+        started = time.monotonic()
+        path = os.path.join(migrations_folder, f"migration_{run_date}_{index + 1}.tar.gz")
+        migration, size = exporter.export([repo.name for repo in batch], path, keep_archive=keep_archives)
+        migrations[index].update(id=migration["id"], archive=os.path.basename(path), archive_bytes=size,
+                                 seconds=round(time.monotonic() - started, 3))
+        return path
+
+    def convert(path):
+        git_dir = tempfile.mkdtemp(prefix="gh_migration_", dir=migrations_folder)
+        try:
+            converted = read_migration_archive(path, git_dir)
+            jobs = []
+            for name, data in converted.items():
+                if repo_names is not None and name not in repo_names:
+                    continue
+                with metrics.stage(name, "convert") as stage:
+                    job = new_backup_job(name, os.path.join(org_folder, name), compress=True)
+                    job["files"] = write_migration_repository(org_name, org_folder, name, data, bundle_full_interval)
+                    if name in repositories_by_name:
+                        # The listing has every field of the REST metadata, the archive lacks some
+                        backup_repository(repositories_by_name[name], job["folder"])
+                    stage.add(bytes_written=sum(path_size(os.path.join(job["folder"], file)) for file in job["files"]))
+                jobs.append(job)
+        finally:
+            shutil.rmtree(git_dir, ignore_errors=True)
+        if not keep_archives and not archive_path:
+            os.remove(path)
+        return {"archive": path, "jobs": jobs}
+
+    def compress_job(job):
+        streamed_to = container_client if publish_backup and stream_uploads else None
+        return compress_repository_backup(job, metrics, archive_format, archive_workers, streamed_to, manifest)
+
+    def compress(batch):
+        with ThreadPoolExecutor(max_workers=compress_workers) as executor:
+            for job, archive in zip(batch["jobs"], executor.map(compress_job, batch["jobs"])):
+                job["archive"] = archive
+        return batch
+
+    def publish_job(job):
+        if job["published"]:
+            return
+        try:
+            publish_repository_stage(metrics, container_client, job["archive"], manifest, job["repository"])
+        except Exception as e:
+            print(f"Error publishing the backup of the repository {job['repository']}: {e}")
+            job["error"] = "publish_failed"
+
+    def publish(batch):
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            list(executor.map(publish_job, batch["jobs"]))
+        if keep_archives and not archive_path:
+            with open(batch["archive"], "rb") as data:
+                container_client.upload_blob(name=f"migrations/{org_name}/{os.path.basename(batch['archive'])}", data=data,
+                                             overwrite=True, max_concurrency=UPLOAD_MAX_CONCURRENCY)
+        return batch
+
+    def done(item, batch):
+        repos = item[1]
+        for job in batch["jobs"]:
+            metrics.set_status(job["repository"], job.get("error", "backed_up"))
+            if "error" not in job:
+                backed_up.add(job["repository"])
+        for repo in repos:
+            if repo.name not in {job["repository"] for job in batch["jobs"]}:
+                print(f"Repository {repo.name} is missing from the migration archive")
+                metrics.set_status(repo.name, "failed")
+
+    def failed(item, stage_name, e):
+        repos = item[1]
+        print(f"Error backing up the repositories {', '.join(repo.name for repo in repos)} through a migration: {e}")
+        for repo in repos:
+            metrics.set_status(repo.name, "publish_failed" if stage_name == "publish" else "failed")
+
+    stages = [
+        PipelineStage("export", export, workers),
+        PipelineStage("convert", convert),
+        PipelineStage("compress", compress)
+    ]
+    if publish_backup:
+        stages.append(PipelineStage("publish", publish))
+    pipeline_report = run_pipeline(list(enumerate(batches)), stages, done, failed)
+
+    if publish_backup:
+        manifest.save(container_client)
+
+    org_data = {
+        "name": org_name,
+        "description": org.description,
+        "website": org.blog,
+        "location": org.location,
+        "repositories": [repo.name for repo in repositories if repo.name in backed_up]
+    }
+    save_data_to_json(org_data, os.path.join(org_folder, "organization.json"))
+
+    report = write_run_report(metrics, org_name, org_folder, report_file, prometheus_file, pipeline=pipeline_report, migrations=migrations)
+    logging.info("END backup_organization_migration Method")
+    return report
+
+
+def merge_organization_fragments(org_folder, work_queue=None):
+    """Merge the organization.<node_id>.json fragments of a sharded run into organization.json.
+
+    Fragments are read from org_folder, where the artifacts of every node were collected,
+    and from the work queue when the nodes shared one. Repositories are sorted by name."""
+    fragments = {}
+    if os.path.isdir(org_folder):
+        for name in sorted(os.listdir(org_folder)):
+            if name.startswith("organization.") and name.endswith(".json") and name != "organization.json":
+                with open(os.path.join(org_folder, name), "r") as file:
+                    fragments[name] = json.load(file)
+    if work_queue is not None:
+        for name in work_queue.store.list("fragments/"):
+            fragments[os.path.basename(name)] = work_queue.store.read(name)[0]
+    if not fragments:
+        raise ValueError(f"No organization fragments found in {org_folder}")
+
+    org_data = {key: value for key, value in next(iter(fragments.values())).items() if key not in ("node", "shard")}
+    org_data["repositories"] = sorted({repository for fragment in fragments.values() for repository in fragment["repositories"]})
+    org_data["nodes"] = sorted(fragment.get("node") for fragment in fragments.values())
+    create_folder(org_folder)
+    save_data_to_json(org_data, os.path.join(org_folder, "organization.json"))
+    logging.info(f"Merged {len(fragments)} organization fragments, {len(org_data['repositories'])} repositories")
+    return org_data
 
 
 if __name__ == "__main__":
-    
-        ##  TODO Logging based on configuration 
+
+        ##  TODO Logging based on configuration
         ##  logging.basicConfig(filename='backup.log', level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        
+
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         parser = argparse.ArgumentParser(description='Backup GitHub organization resources.')
-        
+
         parser.add_argument('-o', '--org_name', type=str, help='GitHub organization name')
         parser.add_argument('-t', '--access_token', type=str, help='GitHub access token')
         parser.add_argument('-d', '--output_dir', type=str, help='Output directory for backup')
@@ -290,9 +1544,43 @@ if __name__ == "__main__":
         parser.add_argument('-i', '--issues', action='store_true', help='Including issues as part of the backup')
         parser.add_argument('-rc', '--repo_clone', action='store_true', help='Including whole repo clone as part of the backup')
         parser.add_argument('-pb', '--publish_backup', action='store_true', help='Publish backup as a zip file in remote storage')
+        parser.add_argument('-w', '--workers', type=int, help='Number of repositories backed up concurrently')
+        parser.add_argument('-mc', '--mirror_cache_dir', type=str, help='Directory keeping a bare mirror of every repository between runs (default: <output_dir>/.mirror_cache)')
+        parser.add_argument('-nmc', '--no_mirror_cache', action='store_true', help='Clone every repository from scratch instead of updating the mirror cache')
+        parser.add_argument('-f', '--backup_format', type=str, choices=BACKUP_FORMATS, default="zip", help='zip: archive a checked out clone, bundle: archive full and incremental git bundles')
+        parser.add_argument('-bfi', '--bundle_full_interval', type=int, default=BUNDLE_FULL_INTERVAL, help='Number of bundles in a chain before a new full bundle is created')
+        parser.add_argument('-uw', '--upload_workers', type=int, default=UPLOAD_WORKERS, help='Number of archives uploaded concurrently when publishing')
+        parser.add_argument('-cw', '--compress_workers', type=int, default=int(os.getenv("GITHUB_COMPRESS_WORKERS", COMPRESS_WORKERS)), help='Number of archives compressed concurrently')
+        parser.add_argument('-af', '--archive_format', type=str, choices=ARCHIVE_FORMATS, default=os.getenv("GITHUB_ARCHIVE_FORMAT", "zip"), help='zip, tar.gz compressed by several threads, or tar.zst (needs the zstandard package)')
+        parser.add_argument('-aw', '--archive_workers', type=int, default=int(os.getenv("GITHUB_ARCHIVE_WORKERS", ARCHIVE_WORKERS)), help='Threads compressing one tar.gz or tar.zst archive')
+        parser.add_argument('-su', '--stream_uploads', action='store_true', default=os.getenv("GITHUB_STREAM_UPLOADS", "").lower() == "true", help='Upload every archive while it is written instead of once it is complete')
+        parser.add_argument('-qs', '--queue_size', type=int, default=int(os.getenv("GITHUB_PIPELINE_QUEUE_SIZE", PIPELINE_QUEUE_SIZE)), help='Repositories waiting between two stages of the pipeline')
+        parser.add_argument('-qm', '--queue_max_mb', type=int, default=os.getenv("GITHUB_PIPELINE_QUEUE_MAX_MB"), help='Size limit in MB of the clones or archives waiting between two stages')
+        parser.add_argument('-vp', '--verify_published', action='store_true', help='Check the sha256 of every published backup after publishing')
+        parser.add_argument('-hc', '--http_cache_dir', type=str, help='Directory caching GitHub API responses for conditional requests (default: <output_dir>/.http_cache)')
+        parser.add_argument('-hcm', '--http_cache_max_mb', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024), help='Size limit of the HTTP cache in MB')
+        parser.add_argument('-nhc', '--no_http_cache', action='store_true', help='Do not cache GitHub API responses')
+        parser.add_argument('-if', '--issues_format', type=str, choices=ISSUES_FORMATS, default="json", help='json: one indented document, ndjson: one issue per line streamed as pages arrive')
+        parser.add_argument('-ci', '--compress_issues', action='store_true', help='gzip the NDJSON issues file while it is written')
+        parser.add_argument('-e', '--export_engine', type=str, choices=EXPORT_ENGINES, default=os.getenv("GITHUB_EXPORT_ENGINE", "rest"), help='rest: REST listings, graphql: issues and pull requests with their labels, and labels, in bulk GraphQL queries, http: the REST listings read ahead on a pooled session')
+        parser.add_argument('-rp', '--report_file', type=str, default=os.getenv("GITHUB_BACKUP_REPORT_FILE"), help='JSON report of the run, per repository and stage timings and counters (default: <output_dir>/<org_name>/backup_report.json)')
+        parser.add_argument('-pf', '--prometheus_file', type=str, default=os.getenv("GITHUB_BACKUP_PROMETHEUS_FILE"), help='Also write the report in the Prometheus text format, for the node_exporter textfile collector')
+        parser.add_argument('-u', '--unchanged', type=str, choices=UNCHANGED_MODES, default=os.getenv("GITHUB_BACKUP_UNCHANGED", "backup"), help='Repositories whose timestamps and refs did not change since their last backup are backed up again (backup), only get their labels, issues and metadata refreshed (metadata) or are skipped (skip)')
+        parser.add_argument('-sh', '--shard', type=str, default=os.getenv("GITHUB_BACKUP_SHARD"), help='Only back up shard i of N of the repositories, given as i/N (1/4 to 4/4)')
+        parser.add_argument('-wq', '--work_queue', type=str, default=os.getenv("GITHUB_BACKUP_WORK_QUEUE"), help='Share the repositories with the other nodes of the run through leases kept in this directory, or in the Azure container with azure')
+        parser.add_argument('-ri', '--run_id', type=str, default=os.getenv("GITHUB_RUN_ID") or datetime.date.today().isoformat(), help='Run shared by the nodes of the work queue (default: GITHUB_RUN_ID or the date)')
+        parser.add_argument('-ni', '--node_id', type=str, help='Name of this node in the work queue and of its organization fragment (default: shard-i-of-N or host-pid)')
+        parser.add_argument('-ls', '--lease_seconds', type=int, default=DEFAULT_LEASE_SECONDS, help='Seconds a claimed repository stays leased without renewal')
+        parser.add_argument('-mf', '--merge_fragments', action='store_true', help='Only merge the organization fragments of a sharded run into organization.json')
+        parser.add_argument('-mg', '--migration', action='store_true', default=os.getenv("GITHUB_BACKUP_MIGRATION", "").lower() == "true", help='Back up the repositories through organization migration exports, in the bundle layout')
+        parser.add_argument('-mbs', '--migration_batch_size', type=int, default=int(os.getenv("GITHUB_MIGRATION_BATCH_SIZE", MIGRATION_BATCH_SIZE)), help='Repositories exported by one migration')
+        parser.add_argument('-mpi', '--migration_poll_interval', type=int, default=POLL_INTERVAL, help='Seconds between two checks of a running migration export')
+        parser.add_argument('-kma', '--keep_migration_archives', action='store_true', help='Keep the migration archives on GitHub and in <output_dir>/<org_name>/migrations, and publish them when publishing')
+        parser.add_argument('-ma', '--migration_archive', type=str, help='Convert this migration archive, downloaded before, instead of starting an export')
+        parser.add_argument('-rs', '--resume', action='store_true', default=os.getenv("GITHUB_BACKUP_RESUME", "").lower() == "true", help='Go on with an interrupted run from its journal instead of backing every repository up again')
+        parser.add_argument('-fr', '--full_resync', action='store_true', help='Download every issue again instead of only the ones updated since the last backup')
         args = parser.parse_args()
 
-
         org_name = args.org_name or os.getenv("GITHUB_ORG")
         access_token = args.access_token or os.getenv("GITHUB_ACCESS_TOKEN")
         output_dir = args.output_dir or os.getenv("GITHUB_BACKUP_DIR")
@@ -301,16 +1589,64 @@ if __name__ == "__main__":
         include_labels = args.labels
         include_issues = args.issues
         publish_backup = args.publish_backup
-        
+        workers = args.workers or int(os.getenv("GITHUB_BACKUP_WORKERS", "1"))
+        full_resync = args.full_resync
+
         if org_name is None or access_token is None or output_dir is None:
             raise ValueError("Please provide organization name, access token, and output directory.")
-        
+
+        if not args.no_http_cache:
+            http_cache_dir = args.http_cache_dir or os.getenv("GITHUB_HTTP_CACHE_DIR") or os.path.join(output_dir, ".http_cache")
+            configure_default_cache(http_cache_dir, args.http_cache_max_mb * 1024 * 1024)
+
+        mirror_cache_dir = None
+        if not args.no_mirror_cache:
+            mirror_cache_dir = args.mirror_cache_dir or os.getenv("GITHUB_MIRROR_CACHE_DIR") or os.path.join(output_dir, ".mirror_cache")
+
+        container_client = None
         if publish_backup:
             azure_account_name = os.getenv("AZURE_ACCOUNT_NAME")
             azure_account_key  = os.getenv("AZURE_ACCOUNT_KEY")
             azure_container_name = os.getenv("AZURE_CONTAINER_NAME")
-            
-            if azure_account_name is None or azure_account_key is None or azure_container_name is None:
+            # A full connection string (Azurite, sovereign clouds) takes precedence over account name and key
+            azure_connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+
+            if azure_container_name is None or (azure_connection_string is None and (azure_account_name is None or azure_account_key is None)):
                 raise ValueError("Please provide Azure account and container values if you are expecting to publish the backups")
-        
-        backup_organization_resources(org_name, access_token, output_dir, repo_names, include_labels, include_issues, repo_clone, publish_backup)
+
+            print(f"Azure Account Name: {azure_account_name}")
+            print(f"Azure Container Name: {azure_container_name}")
+            container_client = get_container_client(azure_account_name, azure_account_key, azure_container_name, azure_connection_string)
+
+        work_queue = None
+        if args.work_queue == "azure":
+            queue_container_client = container_client or get_container_client(os.getenv("AZURE_ACCOUNT_NAME"), os.getenv("AZURE_ACCOUNT_KEY"),
+                                                                              os.getenv("AZURE_CONTAINER_NAME"), os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+            work_queue = WorkQueue(ContainerLeaseStore(queue_container_client, f"work_queue/{org_name}/{args.run_id}/"), args.node_id, args.lease_seconds)
+        elif args.work_queue:
+            work_queue = WorkQueue(DirectoryLeaseStore(os.path.join(args.work_queue, org_name, args.run_id)), args.node_id, args.lease_seconds)
+
+        if args.merge_fragments:
+            merge_organization_fragments(os.path.join(output_dir, org_name), work_queue)
+            sys.exit(0)
+
+        if args.migration or args.migration_archive:
+            backup_organization_migration(org_name, access_token, output_dir, repo_names, publish_backup, workers=workers,
+                                          batch_size=args.migration_batch_size, poll_interval=args.migration_poll_interval,
+                                          bundle_full_interval=args.bundle_full_interval, container_client=container_client,
+                                          upload_workers=args.upload_workers, compress_workers=args.compress_workers,
+                                          keep_archives=args.keep_migration_archives, archive_path=args.migration_archive,
+                                          report_file=args.report_file, prometheus_file=args.prometheus_file, archive_format=args.archive_format,
+                                          archive_workers=args.archive_workers, stream_uploads=args.stream_uploads)
+            sys.exit(0)
+
+        backup_organization_resources(org_name, access_token, output_dir, repo_names, include_labels, include_issues, repo_clone, publish_backup,
+                                      workers=workers, full_resync=full_resync, mirror_cache_dir=mirror_cache_dir, backup_format=args.backup_format,
+                                      bundle_full_interval=args.bundle_full_interval, container_client=container_client,
+                                      upload_workers=args.upload_workers, verify_published=args.verify_published, issues_format=args.issues_format,
+                                      compress_issues=args.compress_issues, export_engine=args.export_engine, report_file=args.report_file,
+                                      prometheus_file=args.prometheus_file, compress_workers=args.compress_workers, queue_size=args.queue_size,
+                                      queue_max_bytes=int(args.queue_max_mb) * 1024 * 1024 if args.queue_max_mb else None, unchanged=args.unchanged,
+                                      shard=parse_shard(args.shard) if args.shard else None, work_queue=work_queue, node_id=args.node_id,
+                                      archive_format=args.archive_format, archive_workers=args.archive_workers, stream_uploads=args.stream_uploads,
+                                      resume=args.resume)
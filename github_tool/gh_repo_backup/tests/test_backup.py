@@ -3,9 +3,65 @@ import tempfile
 import shutil
 import os
 import json
+import threading
+import time
+import datetime
+import zipfile
+import socket
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+from azure.storage.blob import BlobServiceClient
+from git import Repo
+from github import Github
 
 # Import the functions you want to test from your script
+from gh_repo_backup import backup
 from gh_repo_backup.backup import create_folder
+from gh_common.work_queue import DirectoryLeaseStore, WorkQueue, shard_of
+
+AZURITE_CONNECTION_STRING = os.getenv("AZURITE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+
+
+def azurite_available():
+    try:
+        with socket.create_connection(("127.0.0.1", 10000), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def make_repo(name):
+    repo = mock.MagicMock()
+    repo.name = name
+    return repo
+
+
+def make_org(repos):
+    org = mock.MagicMock()
+    org.description = "description"
+    org.blog = "https://example.com"
+    org.location = "Earth"
+    org.get_repos.return_value = repos
+    return org
+
+
+def make_issue(number, updated_at, title=None):
+    issue = mock.MagicMock()
+    issue.number = number
+    issue.title = title or f"Issue {number}"
+    issue.body = "body"
+    issue.state = "open"
+    issue.created_at = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    issue.updated_at = updated_at
+    issue.closed_at = None
+    issue.user.login = "octocat"
+    issue.labels = []
+    return issue
+
 
 class TestBackupScript(unittest.TestCase):
     def setUp(self):
@@ -23,5 +79,828 @@ class TestBackupScript(unittest.TestCase):
         create_folder(test_dir)
         self.assertTrue(os.path.exists(test_dir))
 
+    def test_json_is_written_atomically(self):
+        output_file = os.path.join(self.temp_dir, "data.json")
+        backup.save_data_to_json({"name": "repo"}, output_file)
+        # A value json cannot encode leaves the previous file as it was
+        backup.save_data_to_json({"name": object()}, output_file)
+
+        with open(output_file) as file:
+            self.assertEqual(json.load(file), {"name": "repo"})
+        self.assertEqual(os.listdir(self.temp_dir), ["data.json"])
+
+
+class TestBackupJournal(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.path = os.path.join(self.temp_dir, backup.JOURNAL_FILE_NAME)
+
+    def test_resumed_journal_holds_the_completed_steps(self):
+        journal = backup.BackupJournal(self.path)
+        journal.record("repo", "metadata", state={"refs": "abc"}, unchanged=False, compress=True)
+        journal.record("repo", "clone", files=None, cloned_folder="/tmp/clone", size=3)
+        # A crash while a line is written leaves it cut short
+        with open(self.path, "a") as file:
+            file.write('{"repository": "repo", "st')
+
+        resumed = backup.BackupJournal(self.path, resume=True)
+        self.assertEqual(resumed.completed("repo", "metadata")["state"], {"refs": "abc"})
+        self.assertEqual(resumed.completed("repo", "clone")["size"], 3)
+        self.assertIsNone(resumed.completed("repo", "archive"))
+
+    def test_a_new_run_starts_a_new_journal(self):
+        backup.BackupJournal(self.path).record("repo", "done", archive=None, state=None, unchanged=False)
+        self.assertIsNone(backup.BackupJournal(self.path).completed("repo", "done"))
+
+        journal = backup.BackupJournal(self.path, resume=True)
+        journal.finish()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestIncrementalIssues(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.day1 = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        self.day2 = datetime.datetime(2023, 1, 2, tzinfo=datetime.timezone.utc)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def load_issues(self):
+        with open(os.path.join(self.temp_dir, "issues.json")) as file:
+            return json.load(file)
+
+    def test_second_run_only_fetches_updated_issues(self):
+        repo = mock.MagicMock()
+        repo.get_issues.return_value = [make_issue(2, self.day1), make_issue(1, self.day1)]
+        backup.backup_issues(repo, self.temp_dir)
+        repo.get_issues.assert_called_with(state="all")
+
+        repo.get_issues.return_value = [make_issue(3, self.day2), make_issue(1, self.day2, title="Renamed")]
+        backup.backup_issues(repo, self.temp_dir)
+        repo.get_issues.assert_called_with(state="all", since=self.day1)
+
+        issues = self.load_issues()
+        self.assertEqual([issue["number"] for issue in issues], [3, 2, 1])
+        self.assertEqual(issues[2]["title"], "Renamed")
+        with open(os.path.join(self.temp_dir, "issues_state.json")) as file:
+            self.assertEqual(json.load(file)["updated_at"], self.day2.isoformat())
+
+    def test_full_resync_ignores_watermark(self):
+        repo = mock.MagicMock()
+        repo.get_issues.return_value = [make_issue(2, self.day1), make_issue(1, self.day1)]
+        backup.backup_issues(repo, self.temp_dir)
+
+        repo.get_issues.return_value = [make_issue(1, self.day2)]
+        backup.backup_issues(repo, self.temp_dir, full_resync=True)
+        repo.get_issues.assert_called_with(state="all")
+        self.assertEqual([issue["number"] for issue in self.load_issues()], [1])
+
+
+class PagedIssues:
+    """Stand-in for a PaginatedList that refuses to be iterated as a whole."""
+
+    def __init__(self, issues, per_page):
+        self.pages = [issues[index:index + per_page] for index in range(0, len(issues), per_page)]
+        self.requested_pages = []
+
+    def get_page(self, page):
+        self.requested_pages.append(page)
+        return self.pages[page] if page < len(self.pages) else []
+
+    def __iter__(self):
+        raise AssertionError("iterating a PaginatedList keeps every issue in memory")
+
+
+class TestNdjsonIssues(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.day1 = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        self.day2 = datetime.datetime(2023, 1, 2, tzinfo=datetime.timezone.utc)
+        self.repo = make_repo("repo")
+        self.repo.requester.per_page = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_issues_are_streamed_page_by_page(self):
+        issues = PagedIssues([make_issue(number, self.day1) for number in range(5, 0, -1)], 2)
+        self.repo.get_issues.return_value = issues
+        backup.backup_issues(self.repo, self.temp_dir, issues_format="ndjson", compress_issues=True)
+
+        self.assertEqual(issues.requested_pages, [0, 1, 2])
+        stored = list(backup.iter_ndjson(os.path.join(self.temp_dir, "issues.ndjson.gz")))
+        self.assertEqual([issue["number"] for issue in stored], [5, 4, 3, 2, 1])
+        self.assertEqual(stored[0], backup.serialize_issue(make_issue(5, self.day1)))
+
+    def test_incremental_run_merges_into_the_stream(self):
+        self.repo.get_issues.return_value = PagedIssues([make_issue(number, self.day1) for number in range(3, 0, -1)], 2)
+        backup.backup_issues(self.repo, self.temp_dir, issues_format="ndjson")
+
+        self.repo.get_issues.return_value = PagedIssues([make_issue(4, self.day2), make_issue(2, self.day2, title="Renamed")], 2)
+        backup.backup_issues(self.repo, self.temp_dir, issues_format="ndjson")
+        self.repo.get_issues.assert_called_with(state="all", since=self.day1)
+
+        stored = list(backup.iter_ndjson(os.path.join(self.temp_dir, "issues.ndjson")))
+        self.assertEqual([issue["number"] for issue in stored], [4, 3, 2, 1])
+        self.assertEqual(stored[2]["title"], "Renamed")
+        with open(os.path.join(self.temp_dir, "issues_state.json")) as file:
+            self.assertEqual(json.load(file)["updated_at"], self.day2.isoformat())
+
+    def test_graphql_engine_writes_the_same_layout(self):
+        exported = [backup.serialize_issue(make_issue(number, self.day1)) for number in (2, 1)]
+        exporter = mock.MagicMock()
+        exporter.iter_issues.return_value = iter(exported)
+        exporter.get_labels.return_value = [{"name": "bug", "color": "ff0000"}]
+        exporter.report.return_value = {"queries": 1, "cost": 1}
+        self.repo.full_name = "org/repo"
+
+        with mock.patch.object(backup, "get_graphql_exporter", return_value=exporter):
+            backup.backup_issues(self.repo, self.temp_dir, issues_format="ndjson", export_engine="graphql")
+            backup.backup_labels(self.repo, self.temp_dir, export_engine="graphql")
+
+        exporter.iter_issues.assert_called_once_with("org", "repo", None)
+        self.repo.get_issues.assert_not_called()
+        self.assertEqual(list(backup.iter_ndjson(os.path.join(self.temp_dir, "issues.ndjson"))), exported)
+        with open(os.path.join(self.temp_dir, "labels.json")) as file:
+            self.assertEqual(json.load(file), [{"name": "bug", "color": "ff0000"}])
+        with open(os.path.join(self.temp_dir, "issues_state.json")) as file:
+            self.assertEqual(json.load(file)["updated_at"], self.day1.isoformat())
+
+    def test_switching_format_removes_the_previous_file(self):
+        self.repo.get_issues.return_value = [make_issue(1, self.day1)]
+        backup.backup_issues(self.repo, self.temp_dir)
+        self.repo.get_issues.return_value = PagedIssues([make_issue(1, self.day1)], 2)
+        backup.backup_issues(self.repo, self.temp_dir, issues_format="ndjson")
+        # The watermark belonged to issues.json, the NDJSON file starts with a full export
+        self.repo.get_issues.assert_called_with(state="all")
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ["issues.ndjson", "issues_state.json"])
+
+
+class FakeIssuesApi(BaseHTTPRequestHandler):
+    issue_count = 65
+    per_page = 30
+    requested_paths = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.requested_paths.append(url.path)
+        base = f"http://{self.headers['Host']}"
+        if url.path == "/repos/org/repo":
+            self.send_json({"name": "repo", "full_name": "org/repo", "url": f"{base}/repos/org/repo"})
+        elif url.path == "/repos/org/repo/issues":
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            first = self.issue_count - (page - 1) * self.per_page
+            numbers = range(first, max(first - self.per_page, 0), -1)
+            issues = [{
+                "number": number,
+                "title": f"Issue {number}",
+                "body": "body",
+                "state": "closed" if number % 5 == 0 else "open",
+                "created_at": "2023-01-01T00:00:00Z",
+                "updated_at": f"2023-01-{number % 28 + 1:02d}T10:20:30Z",
+                "closed_at": "2023-02-01T00:00:00Z" if number % 5 == 0 else None,
+                "user": {"login": "octocat"},
+                "labels": [{"name": "bug", "color": "d73a4a"}] + ([{"name": "ü-label", "color": "000000"}] if number % 3 == 0 else []),
+                "url": f"{base}/repos/org/repo/issues/{number}",
+            } for number in numbers]
+            headers = {}
+            if page * self.per_page < self.issue_count:
+                last = -(-self.issue_count // self.per_page)
+                headers["Link"] = (f'<{base}/repos/org/repo/issues?state=all&page={page + 1}>; rel="next", '
+                                   f'<{base}/repos/org/repo/issues?state=all&page={last}>; rel="last"')
+            self.send_json(issues, headers)
+        elif url.path == "/repos/org/repo/labels":
+            self.send_json([{"name": "bug", "color": "d73a4a", "description": None}, {"name": "ü-label", "color": "000000"}])
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+
+class TestIssueRequests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        FakeIssuesApi.requested_paths = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeIssuesApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_one_request_per_page_of_issues(self):
+        client = Github(base_url=f"http://127.0.0.1:{self.server.server_port}", per_page=FakeIssuesApi.per_page)
+        repo = client.get_repo("org/repo")
+        FakeIssuesApi.requested_paths = []
+
+        backup.backup_issues(repo, self.temp_dir)
+
+        self.assertEqual(FakeIssuesApi.requested_paths, ["/repos/org/repo/issues"] * 3)
+        with open(os.path.join(self.temp_dir, "issues.json")) as file:
+            issues = json.load(file)
+        self.assertEqual(len(issues), FakeIssuesApi.issue_count)
+        self.assertEqual(issues[0]["labels"], ["bug"])
+
+    def test_http_engine_writes_the_same_files_as_pygithub(self):
+        client = Github(base_url=f"http://127.0.0.1:{self.server.server_port}", per_page=FakeIssuesApi.per_page)
+        repo = client.get_repo("org/repo")
+        for issues_format in backup.ISSUES_FORMATS:
+            folders = {}
+            for engine in ("rest", "http"):
+                folders[engine] = os.path.join(self.temp_dir, issues_format, engine)
+                create_folder(folders[engine])
+                backup.backup_labels(repo, folders[engine], engine)
+                backup.backup_issues(repo, folders[engine], issues_format=issues_format, export_engine=engine)
+
+            self.assertEqual(sorted(os.listdir(folders["http"])), sorted(os.listdir(folders["rest"])))
+            for name in os.listdir(folders["rest"]):
+                with open(os.path.join(folders["rest"], name), "rb") as rest_file, open(os.path.join(folders["http"], name), "rb") as http_file:
+                    self.assertEqual(http_file.read(), rest_file.read(), name)
+
+
+class OriginRepositoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.origin_path = os.path.join(self.temp_dir, "origin")
+        self.origin = Repo.init(self.origin_path, initial_branch="main")
+        self.origin.git.config("user.email", "test@example.com")
+        self.origin.git.config("user.name", "test")
+        self.commit("first")
+        self.repo = make_repo("repo")
+        self.repo.full_name = "org/repo"
+        self.cache_dir = os.path.join(self.temp_dir, "cache")
+        patcher = mock.patch.object(backup, "get_clone_url", return_value=self.origin_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def commit(self, message):
+        with open(os.path.join(self.origin_path, "file.txt"), "a") as file:
+            file.write(message + "\n")
+        self.origin.git.add("file.txt")
+        self.origin.git.commit("-m", message)
+
+
+class TestMirrorCache(OriginRepositoryTestCase):
+    def test_later_runs_fetch_into_the_existing_mirror(self):
+        mirror_path = backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        self.assertEqual(mirror_path, os.path.join(self.cache_dir, "org", "repo.git"))
+        self.assertEqual(Repo(mirror_path).git.config("--bool", "core.bare"), "true")
+
+        self.origin.git.branch("feature")
+        self.commit("second")
+        with mock.patch.object(backup.Repo, "clone_from", side_effect=AssertionError("cloned again")):
+            backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        mirror = Repo(mirror_path)
+        self.assertEqual(mirror.git.rev_parse("main"), self.origin.git.rev_parse("main"))
+        self.assertIn("feature", [head.name for head in mirror.heads])
+
+        self.origin.git.branch("-D", "feature")
+        backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        self.assertNotIn("feature", [head.name for head in Repo(mirror_path).heads])
+
+    def test_snapshot_is_cloned_from_the_mirror(self):
+        repo_folder = os.path.join(self.temp_dir, "backup", "repo")
+        snapshot = backup.clone_repository(self.repo, repo_folder, "token", self.cache_dir)
+        self.assertEqual(Repo(snapshot).head.commit.hexsha, self.origin.head.commit.hexsha)
+        self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, "org", "repo.git")))
+
+    def test_clones_of_unchanged_history_archive_to_the_same_bytes(self):
+        repo_folder = os.path.join(self.temp_dir, "backup", "repo")
+        create_folder(repo_folder)
+        with open(os.path.join(repo_folder, "issues.json"), "w") as file:
+            file.write("[]")
+        backup.clone_repository(self.repo, repo_folder, "token", self.cache_dir)
+        first = backup.file_sha256(backup.compress_directory(repo_folder))
+        time.sleep(1)
+        snapshot = backup.clone_repository(self.repo, repo_folder, "token", self.cache_dir)
+
+        self.assertEqual(backup.file_sha256(backup.compress_directory(repo_folder)), first)
+        self.assertEqual(os.path.basename(snapshot), "repo_cloned_repo")
+        # origin is set to the clone URL without the token
+        backup.get_clone_url.assert_called_with(self.repo)
+
+
+class TestRepositoryBundles(OriginRepositoryTestCase):
+    def test_chain_of_full_and_incremental_bundles(self):
+        mirror_path = backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        repo_folder = os.path.join(self.temp_dir, "backup", "repo")
+        create_folder(repo_folder)
+
+        full = backup.create_repository_bundle(self.repo, repo_folder, mirror_path)
+        self.assertTrue(os.path.exists(full))
+        self.assertIsNone(backup.create_repository_bundle(self.repo, repo_folder, mirror_path))
+
+        self.commit("second")
+        backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        time.sleep(1)
+        incremental = backup.create_repository_bundle(self.repo, repo_folder, mirror_path)
+
+        chain = backup.load_bundle_manifest(repo_folder)["chain"]
+        self.assertEqual([entry["type"] for entry in chain], ["full", "incremental"])
+        self.assertEqual(chain[1]["prerequisites"], [chain[0]["refs"]["refs/heads/main"]])
+        self.assertEqual(chain[1]["refs"]["refs/heads/main"], self.origin.head.commit.hexsha)
+        # The incremental bundle cannot be read without the objects of the full one
+        verify = Repo.init(os.path.join(self.temp_dir, "verify"), bare=True)
+        with self.assertRaises(Exception):
+            verify.git.bundle("verify", incremental)
+
+    def test_archive_holds_the_whole_chain(self):
+        repo_folder = os.path.join(self.temp_dir, "backup", "repo")
+        create_folder(repo_folder)
+        first = backup.backup_repository_bundle(self.repo, repo_folder, "token", self.cache_dir)
+        self.commit("second")
+        time.sleep(1)
+        second = backup.backup_repository_bundle(self.repo, repo_folder, "token", self.cache_dir)
+
+        chain = backup.load_bundle_manifest(repo_folder)["chain"]
+        self.assertEqual([entry["type"] for entry in chain], ["full", "incremental"])
+        self.assertEqual([name for name in first if name.endswith(".bundle")], [chain[0]["file"]])
+        self.assertEqual([name for name in second if name.endswith(".bundle")], [entry["file"] for entry in chain])
+        # Nothing new, the archive is the same as the last one
+        self.assertEqual(backup.backup_repository_bundle(self.repo, repo_folder, "token", self.cache_dir), second)
+        self.assertIn("bundles.json", second)
+
+        zip_file_name = backup.compress_directory(repo_folder, second)
+        with zipfile.ZipFile(zip_file_name) as zip_file:
+            self.assertEqual(zip_file.getinfo(second[-1]).compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(sorted(zip_file.namelist()), sorted(second))
+
+    def test_large_incremental_bundles_start_a_new_chain(self):
+        mirror_path = backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        repo_folder = os.path.join(self.temp_dir, "backup", "repo")
+        create_folder(repo_folder)
+        backup.create_repository_bundle(self.repo, repo_folder, mirror_path)
+        with open(os.path.join(self.origin_path, "large.bin"), "wb") as file:
+            file.write(os.urandom(backup.BUNDLE_CHAIN_MIN_BYTES))
+        self.origin.git.add("large.bin")
+        self.commit("large")
+        backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        time.sleep(1)
+        backup.create_repository_bundle(self.repo, repo_folder, mirror_path)
+        self.commit("third")
+        backup.update_mirror_cache(self.repo, self.cache_dir, "token")
+        time.sleep(1)
+        backup.create_repository_bundle(self.repo, repo_folder, mirror_path)
+
+        chain = backup.load_bundle_manifest(repo_folder)["chain"]
+        self.assertEqual([entry["type"] for entry in chain], ["full"])
+        self.assertEqual([name for name in os.listdir(repo_folder) if name.endswith(".bundle")], [chain[0]["file"]])
+
+
+class TestSkipUnchanged(OriginRepositoryTestCase):
+    def setUp(self):
+        super().setUp()
+        timestamp = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        self.repo.created_at = self.repo.updated_at = self.repo.pushed_at = timestamp
+        self.org_folder = os.path.join(self.temp_dir, "backup")
+        self.state = backup.BackupState(os.path.join(self.org_folder, backup.STATE_FILE_NAME))
+
+    def fetch(self, unchanged, backup_format="zip"):
+        job = backup.fetch_repository_resources(self.repo, self.org_folder, True, False, False, "token", mirror_cache_dir=self.cache_dir,
+                                                backup_format=backup_format, state=self.state, unchanged=unchanged)
+        if not job["unchanged"]:
+            self.state.record(self.repo.name, job["state"])
+        return job
+
+    def test_unchanged_repository_is_not_cloned_again(self):
+        self.assertFalse(self.fetch("skip")["unchanged"])
+        with mock.patch.object(backup, "clone_repository", side_effect=AssertionError("cloned again")), \
+                mock.patch.object(backup, "backup_repository", side_effect=AssertionError("metadata refreshed")):
+            job = self.fetch("skip")
+        self.assertTrue(job["unchanged"])
+        self.assertFalse(job["compress"])
+
+        with mock.patch.object(backup, "clone_repository", side_effect=AssertionError("cloned again")), \
+                mock.patch.object(backup, "backup_repository") as backup_repository:
+            self.assertTrue(self.fetch("metadata")["unchanged"])
+        backup_repository.assert_called_once()
+
+    def test_refreshed_metadata_is_archived_with_the_previous_clone(self):
+        cloned_folder = self.fetch("metadata")["cloned_folder"]
+        with mock.patch.object(backup, "clone_repository", side_effect=AssertionError("cloned again")):
+            job = self.fetch("metadata")
+        self.assertTrue(job["unchanged"])
+        self.assertTrue(job["compress"])
+        self.assertEqual(job["cloned_folder"], cloned_folder)
+        self.assertGreater(job["size"], 0)
+
+        # Without a previous clone to archive, it is cloned again
+        backup.rmtree(cloned_folder)
+        job = self.fetch("metadata")
+        self.assertTrue(job["compress"])
+        self.assertTrue(os.path.isdir(job["cloned_folder"]))
+
+    def test_refreshed_metadata_is_archived_with_the_previous_bundles(self):
+        files = self.fetch("metadata", backup_format="bundle")["files"]
+        with mock.patch.object(backup, "backup_repository_bundle", side_effect=AssertionError("bundled again")):
+            job = self.fetch("metadata", backup_format="bundle")
+        self.assertTrue(job["unchanged"])
+        self.assertTrue(job["compress"])
+        self.assertEqual(job["files"], files)
+
+    def test_new_commits_or_timestamps_are_backed_up(self):
+        self.fetch("skip")
+        # Pushes are seen by ls-remote even before the listing timestamps catch up
+        self.commit("second")
+        self.assertFalse(self.fetch("skip")["unchanged"])
+
+        self.repo.updated_at = datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc)
+        self.assertFalse(self.fetch("skip")["unchanged"])
+        self.assertTrue(self.fetch("skip")["unchanged"])
+
+    def test_state_of_other_options_is_not_trusted(self):
+        self.fetch("skip")
+        job = backup.fetch_repository_resources(self.repo, self.org_folder, True, False, False, "token", mirror_cache_dir=self.cache_dir,
+                                                backup_format="bundle", state=self.state, unchanged="skip")
+        self.assertFalse(job["unchanged"])
+
+    def test_resumed_fetch_reuses_the_completed_steps(self):
+        journal = backup.BackupJournal(os.path.join(self.temp_dir, backup.JOURNAL_FILE_NAME))
+        job = backup.fetch_repository_resources(self.repo, self.org_folder, True, False, False, "token", mirror_cache_dir=self.cache_dir,
+                                                state=self.state, journal=journal)
+
+        resumed = backup.BackupJournal(journal.path, resume=True)
+        with mock.patch.object(backup, "clone_repository", side_effect=AssertionError("cloned again")), \
+                mock.patch.object(backup, "backup_repository", side_effect=AssertionError("metadata fetched again")):
+            resumed_job = backup.fetch_repository_resources(self.repo, self.org_folder, True, False, False, "token", mirror_cache_dir=self.cache_dir,
+                                                            state=self.state, journal=resumed)
+        self.assertEqual(resumed_job, job)
+
+        # A clone that is gone is made again
+        backup.rmtree(job["cloned_folder"])
+        with mock.patch.object(backup, "backup_repository", side_effect=AssertionError("metadata fetched again")):
+            job = backup.fetch_repository_resources(self.repo, self.org_folder, True, False, False, "token", mirror_cache_dir=self.cache_dir,
+                                                    state=self.state, journal=resumed)
+        self.assertTrue(os.path.isdir(job["cloned_folder"]))
+        self.assertEqual([name for name in os.listdir(os.path.join(self.org_folder, "repo")) if name.startswith("repo_cloned_")],
+                         [os.path.basename(job["cloned_folder"])])
+
+    def test_state_is_saved_atomically(self):
+        self.fetch("skip")
+        self.state.save()
+        loaded = backup.BackupState.load(self.state.path)
+        self.assertEqual(loaded.get("repo")["refs"], self.state.get("repo")["refs"])
+        self.assertFalse(os.path.exists(f"{self.state.path}.partial"))
+
+
+class TestBackupOrganizationResources(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_backup(self, repos, worker, workers, container_client=None, **options):
+        client = mock.MagicMock()
+        client.get_organization.return_value = make_org(repos)
+
+        def fetch(repo, *args, **kwargs):
+            # The worker stands for the fetch stage, what it returns is the archive to publish
+            return dict(backup.new_backup_job(repo.name), archive=worker(repo, *args, **kwargs))
+
+        with mock.patch.object(backup, "github_auth", return_value=client), \
+                mock.patch.object(backup, "backup_repository_worker", side_effect=fetch):
+            backup.backup_organization_resources("org", "token", self.temp_dir, workers=workers,
+                                                 publish_backup=container_client is not None, container_client=container_client, **options)
+        org_file_name = f"organization.{options['node_id']}.json" if options.get("node_id") else "organization.json"
+        with open(os.path.join(self.temp_dir, "org", org_file_name)) as org_file:
+            return json.load(org_file)
+
+    def test_failed_repository_does_not_stop_the_others(self):
+        def worker(repo, *args, **kwargs):
+            if repo.name == "broken":
+                raise RuntimeError("boom")
+            return repo.name
+
+        repos = [make_repo(name) for name in ["a", "broken", "b"]]
+        org_data = self.run_backup(repos, worker, workers=3)
+        self.assertEqual(org_data["repositories"], ["a", "b"])
+
+    def test_repositories_keep_listing_order(self):
+        def worker(repo, *args, **kwargs):
+            # Earlier repositories finish last
+            time.sleep(0.05 * (5 - int(repo.name)))
+            return repo.name
+
+        repos = [make_repo(str(i)) for i in range(5)]
+        org_data = self.run_backup(repos, worker, workers=5)
+        self.assertEqual(org_data["repositories"], ["0", "1", "2", "3", "4"])
+
+    def test_worker_pool_is_bounded(self):
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+
+        def worker(repo, *args, **kwargs):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(0.02)
+            with lock:
+                state["running"] -= 1
+            return repo.name
+
+        repos = [make_repo(str(i)) for i in range(10)]
+        org_data = self.run_backup(repos, worker, workers=3)
+        self.assertEqual(len(org_data["repositories"]), 10)
+        self.assertLessEqual(state["peak"], 3)
+
+    def write_archive(self, repo):
+        archive_path = os.path.join(self.temp_dir, "org", f"{repo.name}_2023-01-01.zip")
+        with open(archive_path, "wb") as archive:
+            archive.write(repo.name.encode())
+        return archive_path
+
+    def test_each_archive_is_published_once(self):
+        container_client = mock.MagicMock()
+        repos = [make_repo(str(i)) for i in range(6)]
+        org_data = self.run_backup(repos, lambda repo, *args, **kwargs: self.write_archive(repo), 3, container_client)
+
+        uploaded = sorted(call.kwargs["name"] for call in container_client.upload_blob.call_args_list)
+        self.assertEqual(uploaded, [f"{i}_2023-01-01.zip" for i in range(6)] + [backup.UPLOAD_MANIFEST_NAME])
+        self.assertEqual(len(org_data["repositories"]), 6)
+
+    def test_failed_upload_is_reported_per_repository(self):
+        container_client = mock.MagicMock()
+        container_client.upload_blob.side_effect = lambda name, **kwargs: self.fail_on(name, "b_2023-01-01.zip")
+        repos = [make_repo(name) for name in ["a", "b", "c"]]
+        org_data = self.run_backup(repos, lambda repo, *args, **kwargs: self.write_archive(repo), 2, container_client)
+        self.assertEqual(org_data["repositories"], ["a", "c"])
+
+    def test_run_report_records_the_status_and_publish_stage(self):
+        container_client = mock.MagicMock()
+        container_client.upload_blob.side_effect = lambda name, **kwargs: self.fail_on(name, "b_2023-01-01.zip")
+        repos = [make_repo(name) for name in ["a", "b", "c"]]
+        self.run_backup(repos, lambda repo, *args, **kwargs: self.write_archive(repo), 2, container_client)
+
+        with open(os.path.join(self.temp_dir, "org", backup.REPORT_FILE_NAME)) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report["repositories_by_status"], {"backed_up": 2, "publish_failed": 1})
+        self.assertEqual(report["repositories"]["a"]["stages"]["publish"]["bytes_written"], 1)
+        self.assertIn("upload failed", report["repositories"]["b"]["stages"]["publish"]["error"])
+        self.assertIn("api_usage", report)
+
+    def test_shards_write_fragments_merged_into_the_organization(self):
+        repos = [make_repo(f"repo-{i}") for i in range(8)]
+        fragments = [self.run_backup(repos, lambda repo, *args, **kwargs: None, 2, shard=(i, 3), node_id=f"node-{i}") for i in (1, 2, 3)]
+
+        self.assertEqual(sorted(len(fragment["repositories"]) for fragment in fragments), sorted(
+            sum(shard_of(repo.name, 3) == i for repo in repos) for i in (1, 2, 3)))
+        org_data = backup.merge_organization_fragments(os.path.join(self.temp_dir, "org"))
+        self.assertEqual(org_data["repositories"], sorted(repo.name for repo in repos))
+        self.assertEqual(org_data["nodes"], ["node-1", "node-2", "node-3"])
+        with open(os.path.join(self.temp_dir, "org", "organization.json")) as org_file:
+            self.assertEqual(json.load(org_file), org_data)
+
+    def test_nodes_sharing_a_work_queue_back_each_repository_up_once(self):
+        store = DirectoryLeaseStore(os.path.join(self.temp_dir, "queue"))
+        repos = [make_repo(f"repo-{i}") for i in range(12)]
+        backed_up = []
+        lock = threading.Lock()
+
+        def worker(repo, *args, **kwargs):
+            with lock:
+                backed_up.append(repo.name)
+            time.sleep(0.01)
+
+        threads = [threading.Thread(target=self.run_backup, args=(repos, worker, 2),
+                                    kwargs={"shard": (i, 2), "work_queue": WorkQueue(store, f"node-{i}"), "node_id": f"node-{i}"})
+                   for i in (1, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(backed_up), sorted(repo.name for repo in repos))
+        # The fragments are also shared through the queue, a fresh folder is enough to merge them
+        merge_folder = os.path.join(self.temp_dir, "merge")
+        create_folder(merge_folder)
+        org_data = backup.merge_organization_fragments(merge_folder, WorkQueue(store))
+        self.assertEqual(org_data["repositories"], sorted(repo.name for repo in repos))
+
+    def test_resumed_run_only_redoes_what_was_not_completed(self):
+        create_folder(os.path.join(self.temp_dir, "org"))
+        journal = backup.BackupJournal(os.path.join(self.temp_dir, "org", backup.JOURNAL_FILE_NAME))
+        journal.record("a", "done", archive=self.write_archive(make_repo("a")), state=None, unchanged=False)
+        journal.record("b", "archive", archive=self.write_archive(make_repo("b")), state=None, unchanged=False)
+        fetched = []
+
+        def worker(repo, *args, **kwargs):
+            fetched.append(repo.name)
+            return self.write_archive(repo)
+
+        container_client = mock.MagicMock()
+        repos = [make_repo(name) for name in ["a", "b", "c"]]
+        org_data = self.run_backup(repos, worker, 2, container_client, resume=True)
+
+        self.assertEqual(fetched, ["c"])
+        uploaded = sorted(call.kwargs["name"] for call in container_client.upload_blob.call_args_list)
+        self.assertEqual(uploaded, ["b_2023-01-01.zip", "c_2023-01-01.zip", backup.UPLOAD_MANIFEST_NAME])
+        self.assertEqual(org_data["repositories"], ["a", "b", "c"])
+        self.assertFalse(os.path.exists(journal.path))
+
+    def fail_on(self, name, failing_name):
+        if name == failing_name:
+            raise RuntimeError("upload failed")
+
+
+class TestContentDeduplication(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.container_client = mock.MagicMock()
+        self.blobs = {}
+        self.container_client.upload_blob.side_effect = self.upload_blob
+        self.container_client.get_blob_client.side_effect = self.get_blob_client
+        self.manifest = backup.UploadManifest(os.path.join(self.temp_dir, backup.UPLOAD_MANIFEST_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def upload_blob(self, name, data, overwrite, metadata=None, **kwargs):
+        self.blobs[name] = metadata
+
+    def get_blob_client(self, name):
+        blob_client = mock.MagicMock()
+        blob_client.get_blob_properties.return_value.metadata = self.blobs[name]
+        return blob_client
+
+    def write_archive(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "wb") as archive:
+            archive.write(content)
+        return path
+
+    def test_unchanged_archive_is_recorded_as_a_reference(self):
+        first = backup.publish_repository_backup(self.container_client, self.write_archive("repo_2023-01-01.zip", b"same"), self.manifest, "repo")
+        second = backup.publish_repository_backup(self.container_client, self.write_archive("repo_2023-01-02.zip", b"same"), self.manifest, "repo")
+        third = backup.publish_repository_backup(self.container_client, self.write_archive("repo_2023-01-03.zip", b"changed"), self.manifest, "repo")
+
+        self.assertEqual((first, second, third), ("repo_2023-01-01.zip", "repo_2023-01-01.zip", "repo_2023-01-03.zip"))
+        self.assertEqual(sorted(self.blobs), ["repo_2023-01-01.zip", "repo_2023-01-03.zip"])
+        self.assertEqual(self.manifest.data["artifacts"]["repo_2023-01-02.zip"]["blob"], "repo_2023-01-01.zip")
+        self.assertEqual(self.blobs["repo_2023-01-03.zip"]["sha256"], backup.file_sha256(os.path.join(self.temp_dir, "repo_2023-01-03.zip")))
+
+        self.manifest.save()
+        reloaded = backup.UploadManifest.load(self.manifest.path)
+        self.assertEqual(reloaded.latest("repo")["blob"], "repo_2023-01-03.zip")
+
+    def test_verify_reports_mismatching_blobs(self):
+        backup.publish_repository_backup(self.container_client, self.write_archive("a.zip", b"a"), self.manifest, "a")
+        backup.publish_repository_backup(self.container_client, self.write_archive("b.zip", b"b"), self.manifest, "b")
+        self.assertEqual(backup.verify_published_backups(self.container_client, self.manifest), [])
+
+        self.blobs["b.zip"] = {"sha256": "0" * 64}
+        problems = backup.verify_published_backups(self.container_client, self.manifest)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("b.zip"))
+
+    def test_saving_keeps_the_entries_published_by_other_nodes(self):
+        self.container_client.download_blob.return_value.readall.return_value = json.dumps({
+            "artifacts": {"other_2023-01-01.zip": {"repository": "other", "blob": "other_2023-01-01.zip"},
+                          "repo_2022-12-01.zip": {"repository": "repo", "blob": "repo_2022-12-01.zip"}},
+            "latest": {"other": "other_2023-01-01.zip", "repo": "repo_2022-12-01.zip"}})
+        self.container_client.download_blob.return_value.properties.etag = "etag-1"
+        backup.publish_repository_backup(self.container_client, self.write_archive("repo_2023-01-01.zip", b"repo"), self.manifest, "repo")
+        self.manifest.save(self.container_client)
+
+        upload = self.container_client.upload_blob.call_args_list[-1].kwargs
+        self.assertEqual(upload["etag"], "etag-1")
+        published = json.loads(upload["data"])
+        self.assertEqual(published["latest"], {"other": "other_2023-01-01.zip", "repo": "repo_2023-01-01.zip"})
+        self.assertIn("repo_2022-12-01.zip", published["artifacts"])
+
+    def test_archives_of_unchanged_content_are_identical(self):
+        folder = os.path.join(self.temp_dir, "repo")
+        create_folder(folder)
+        with open(os.path.join(folder, "issues.json"), "w") as file:
+            file.write("[]")
+        first = backup.file_sha256(backup.compress_directory(folder))
+        os.utime(os.path.join(folder, "issues.json"), (0, 0))
+        self.assertEqual(backup.file_sha256(backup.compress_directory(folder)), first)
+
+
+class StagedBlobClient:
+    """Blocks staged and committed as the block blob API of a container does, kept in memory."""
+
+    def __init__(self, blobs, name):
+        self.blobs = blobs
+        self.name = name
+        self.staged = {}
+
+    def stage_block(self, block_id, data):
+        self.staged[block_id] = data
+
+    def commit_block_list(self, block_list, metadata=None):
+        self.blobs[self.name] = (b"".join(self.staged[block.id] for block in block_list), metadata)
+
+
+class TestStreamedUploads(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.folder = os.path.join(self.temp_dir, "org", "repo")
+        create_folder(self.folder)
+        with open(os.path.join(self.folder, "issues.json"), "wb") as file:
+            file.write(os.urandom(300 * 1024))
+        self.blobs = {}
+        self.container_client = mock.MagicMock()
+        self.container_client.get_blob_client.side_effect = lambda name: StagedBlobClient(self.blobs, name)
+        self.manifest = backup.UploadManifest(os.path.join(self.temp_dir, backup.UPLOAD_MANIFEST_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def compress(self, archive_format):
+        job = backup.new_backup_job("repo", self.folder, compress=True)
+        with mock.patch.object(backup, "UPLOAD_BLOCK_SIZE", 64 * 1024):
+            return job, backup.compress_repository_backup(job, archive_format=archive_format, container_client=self.container_client, manifest=self.manifest)
+
+    def test_archive_is_committed_as_it_was_written(self):
+        for archive_format in ("zip", "tar.gz"):
+            job, archive_path = self.compress(archive_format)
+
+            self.assertTrue(job["published"])
+            with open(archive_path, "rb") as file:
+                content = file.read()
+            self.assertEqual(self.blobs[os.path.basename(archive_path)], (content, {"sha256": backup.file_sha256(archive_path)}))
+        self.assertFalse([name for name in os.listdir(os.path.dirname(self.folder)) if name.endswith(".partial")])
+
+    def test_unchanged_archive_is_not_committed(self):
+        first = self.compress("zip")[1]
+        second = self.compress("zip")[1]
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(list(self.blobs), [os.path.basename(first)])
+        self.assertEqual(self.manifest.latest("repo")["blob"], os.path.basename(first))
+
+
+@unittest.skipUnless(azurite_available(), "Azurite is not running, see scripts/install_azurite.sh")
+class TestPublishToAzurite(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        service = BlobServiceClient.from_connection_string(AZURITE_CONNECTION_STRING)
+        self.container_client = service.create_container(f"backups-{uuid.uuid4().hex}")
+
+    def tearDown(self):
+        self.container_client.delete_container()
+        shutil.rmtree(self.temp_dir)
+
+    def test_publish_only_uploads_new_archives(self):
+        manifest = backup.UploadManifest(os.path.join(self.temp_dir, backup.UPLOAD_MANIFEST_NAME))
+        for name, content in [("a_1", b"a"), ("b_1", b"b"), ("b_2", b"b"), ("b_3", b"c")]:
+            with open(os.path.join(self.temp_dir, f"{name}.zip"), "wb") as archive:
+                archive.write(content * 1024)
+
+        backup.publish_repository_backup(self.container_client, os.path.join(self.temp_dir, "b_1.zip"), manifest, "b")
+        self.assertEqual([blob.name for blob in self.container_client.list_blobs()], ["b_1.zip"])
+
+        # Older archives left in the folder are not sent again, an unchanged one is only referenced
+        self.assertEqual(backup.publish_repository_backup(self.container_client, os.path.join(self.temp_dir, "b_2.zip"), manifest, "b"), "b_1.zip")
+        backup.publish_repository_backup(self.container_client, os.path.join(self.temp_dir, "b_3.zip"), manifest, "b")
+        self.assertEqual(sorted(blob.name for blob in self.container_client.list_blobs()), ["b_1.zip", "b_3.zip"])
+        self.assertEqual(self.container_client.download_blob("b_3.zip").readall(), b"c" * 1024)
+        self.assertEqual(manifest.latest("b")["blob"], "b_3.zip")
+
+    def test_streamed_upload_is_committed(self):
+        folder = os.path.join(self.temp_dir, "repo")
+        create_folder(folder)
+        with open(os.path.join(folder, "issues.json"), "wb") as file:
+            file.write(os.urandom(100 * 1024))
+        job = backup.new_backup_job("repo", folder, compress=True)
+        with mock.patch.object(backup, "UPLOAD_BLOCK_SIZE", 32 * 1024):
+            archive_path = backup.compress_repository_backup(job, archive_format="tar.gz", container_client=self.container_client)
+
+        with open(archive_path, "rb") as file:
+            self.assertEqual(self.container_client.download_blob(os.path.basename(archive_path)).readall(), file.read())
+
+    def test_published_hashes_can_be_verified(self):
+        manifest = backup.UploadManifest(os.path.join(self.temp_dir, backup.UPLOAD_MANIFEST_NAME))
+        path = os.path.join(self.temp_dir, "a.zip")
+        with open(path, "wb") as archive:
+            archive.write(b"a" * 1024)
+        backup.publish_repository_backup(self.container_client, path, manifest, "a")
+        manifest.save(self.container_client)
+
+        self.assertEqual(backup.verify_published_backups(self.container_client, manifest, download=True), [])
+        os.remove(manifest.path)
+        self.assertEqual(backup.UploadManifest.load(manifest.path, self.container_client).latest("a")["blob"], "a.zip")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,21 +1,151 @@
+import gzip
+import io
 import json
 import argparse
 import os
+import re
 import logging
+import threading
 import zipfile
 import shutil
-import git 
+import subprocess
+import tempfile
+import time
+import git
 from git import Repo, GitCommandError
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from github import Github
+from github import Auth, UnknownObjectException
+from github.Repository import Repository
+
+from gh_common.archive import EXTRACT_OPTIONS, get_archive_format, open_tar_archive, parse_archive_name
+from gh_common.github_client import build_github_client, get_git_url
+from gh_common.http_cache import get_default_cache
+from gh_common.ndjson import iter_ndjson
+from gh_common.ratelimit import get_default_governor
+from gh_repo_backup.backup import get_container_client
 
 global org_name
-global access_token 
+global access_token
 global backup_zip_path
 
-
-def restore_git_repository(repo_restored_name, local_repo_path, token):
+# The streamed formats are preferred, a backup holds a single one
+ISSUES_FILES = ('issues.ndjson.gz', 'issues.ndjson', 'issues.json')
+REQUIRED_FILES = ('labels.json', 'repository.json')
+METADATA_FILES = REQUIRED_FILES + ISSUES_FILES
+
+# Creates are paced by the rate limit governor, a few workers keep it busy while requests are in flight
+RESTORE_WORKERS = 4
+# Hidden in the body of every restored issue, it maps the issue back to the backed up one
+SOURCE_ISSUE_MARKER = '<!-- gh-backup source-issue: {} -->'
+SOURCE_ISSUE_PATTERN = re.compile(r'<!-- gh-backup source-issue: (\d+) -->')
+
+# GitHub rejects pushes over 2 GB, larger repositories are pushed in steps
+MAX_PUSH_BYTES = 1536 * 1024 * 1024
+RESTORED_REF_PREFIXES = ('refs/heads/', 'refs/tags/', 'refs/notes/')
+
+# Repositories restored at a time by an organization restore
+REPOSITORY_WORKERS = 4
+
+_thread_state = threading.local()
+
+
+def get_restore_refs(git_dir):
+    """Map every ref to restore on the remote to its local source ref.
+
+    A backed up clone keeps the branches of the origin under refs/remotes/origin, they are
+    pushed back as branches. A bare repository, rebuilt from bundles, is pushed as it is.
+    refs/pull/* is left out, GitHub refuses pushes to it."""
+    refs = {}
+    output = subprocess.run(["git", "--git-dir", git_dir, "for-each-ref", "--format=%(refname)"],
+                            capture_output=True, text=True, check=True).stdout
+    for ref in output.splitlines():
+        if ref.startswith("refs/remotes/origin/") and ref != "refs/remotes/origin/HEAD":
+            refs["refs/heads/" + ref[len("refs/remotes/origin/"):]] = ref
+    for ref in output.splitlines():
+        if ref.startswith(RESTORED_REF_PREFIXES):
+            # A local branch of a clone tracks the remote one already mapped
+            refs.setdefault(ref, ref)
+    return refs
+
+
+def get_repository_size(git_dir):
+    counts = subprocess.run(["git", "--git-dir", git_dir, "count-objects", "-v"], capture_output=True, text=True, check=True).stdout
+    sizes = dict(line.split(": ", 1) for line in counts.splitlines())
+    return (int(sizes.get("size", 0)) + int(sizes.get("size-pack", 0))) * 1024
+
+
+def get_default_branch(git_dir, refs):
+    head = subprocess.run(["git", "--git-dir", git_dir, "symbolic-ref", "-q", "HEAD"], capture_output=True, text=True).stdout.strip()
+    for ref in (head, "refs/heads/main", "refs/heads/master"):
+        if ref in refs:
+            return ref
+    branches = sorted(ref for ref in refs if ref.startswith("refs/heads/"))
+    return branches[0] if branches else None
+
+
+def git_push(git_dir, remote_url, refspecs):
+    """Push the refspecs, forwarding the progress git reports, which ends with the transfer rate."""
+    command = ["git", "--git-dir", git_dir, "push", "--progress", "--force", remote_url] + refspecs
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    output = []
+    for line in process.stderr:
+        # Progress lines are rewritten with carriage returns, only their final state is logged
+        line = line.rstrip().split("\r")[-1]
+        output.append(line)
+        if line:
+            logging.info(f"git push: {line}")
+    if process.wait() != 0:
+        raise GitCommandError(["git", "push", "--progress", "--force", "<remote>"] + refspecs, process.returncode, "\n".join(output[-20:]))
+
+
+def push_repository(git_dir, remote_url, max_push_bytes=MAX_PUSH_BYTES):
+    """Push every branch, tag and note of the repository to remote_url and return a summary.
+
+    When the repository is larger than max_push_bytes each branch is first pushed in steps
+    along its first parent history, so no single push goes over GitHub's push size limit.
+    Commits already on the remote are not sent again by the following pushes."""
+    refs = get_restore_refs(git_dir)
+    if not refs:
+        logging.warning("The backed up repository has no refs to restore")
+        return {"refs": 0, "pushes": 0, "bytes": 0, "seconds": 0.0}
+
+    size = get_repository_size(git_dir)
+    chunks = -(-size // max_push_bytes)
+    started = time.monotonic()
+    pushes = 0
+
+    branches = sorted(ref for ref in refs if ref.startswith("refs/heads/"))
+    default_branch = get_default_branch(git_dir, refs)
+    if default_branch:
+        # GitHub makes the first branch pushed to an empty repository its default branch
+        branches.remove(default_branch)
+        branches.insert(0, default_branch)
+    if chunks > 1:
+        for branch in branches:
+            commits = subprocess.run(["git", "--git-dir", git_dir, "rev-list", "--first-parent", "--reverse", refs[branch]],
+                                     capture_output=True, text=True, check=True).stdout.split()
+            steps = sorted({len(commits) * step // chunks for step in range(1, chunks)} - {0})
+            for number, index in enumerate(steps, 1):
+                git_push(git_dir, remote_url, [f"+{commits[index - 1]}:{branch}"])
+                pushes += 1
+                elapsed = time.monotonic() - started
+                logging.info(f"Pushed {branch} step {number}/{len(steps)} ({index}/{len(commits)} commits), {elapsed:.1f}s elapsed")
+
+    refspecs = [f"+{source}:{target}" for target, source in sorted(refs.items(), key=lambda item: item[0] != default_branch)]
+    git_push(git_dir, remote_url, refspecs)
+    pushes += 1
+
+    seconds = time.monotonic() - started
+    logging.info(f"Pushed {len(refs)} refs, {size / 1048576:.1f} MiB in {pushes} push(es) and {seconds:.1f}s "
+                 f"({size / 1048576 / max(seconds, 0.001):.1f} MiB/s)")
+    return {"refs": len(refs), "pushes": pushes, "bytes": size, "seconds": round(seconds, 3),
+            "default_branch": default_branch[len("refs/heads/"):] if default_branch else None}
+
+
+def restore_git_repository(repo_restored_name, local_repo_path, token, remote_url=None, max_push_bytes=MAX_PUSH_BYTES):
+    """Push the history of a backup to the restored repository, from the .git folder of a clone or from a bundle chain."""
     try:
         logging.info(f"Parameters: repo_restored_name={repo_restored_name}, local_repo_path={local_repo_path}")
 
@@ -23,32 +153,18 @@ def restore_git_repository(repo_restored_name, local_repo_path, token):
             logging.error(f"Local repository folder does not exist: {local_repo_path}")
             return
 
-        git_folder = find_git_folder(local_repo_path)
+        if os.path.exists(os.path.join(local_repo_path, 'bundles.json')):
+            git_folder = rebuild_repository_from_bundles(local_repo_path, os.path.join(local_repo_path, 'rebuilt.git'))
+        else:
+            git_folder = find_git_folder(local_repo_path)
         if not git_folder:
-            raise RuntimeError("Git repository folder is missing in the ZIP archive.")
-
-        # Create a new repository in the specified directory
-        repo = Repo.init(local_repo_path)
-
-        # Add all files from the existing Git repository to the new repository
-        for item in os.listdir(git_folder):
-            item_path = os.path.join(git_folder, item)
-            if os.path.isfile(item_path):
-                shutil.copy2(item_path, local_repo_path)
-
-        # Add and commit the changes
-        repo.git.add('--all')
-        repo.git.commit('-m', 'Initial commit before restoring')
+            raise RuntimeError("Git repository folder is missing in the backup archive.")
 
-        # Set up the remote
-        remote_url = f'https://{token}@github.com/{org_name}/{repo_restored_name}.git'
-        origin = repo.create_remote('origin', remote_url)
-
-        # Create and push the 'main' branch to the remote repository
-        repo.create_head('main')
-        origin.push('main')
+        remote_url = remote_url or get_git_url(f'{org_name}/{repo_restored_name}', token)
+        summary = push_repository(git_folder, remote_url, max_push_bytes)
 
         logging.info("Repository restored successfully")
+        return summary
 
     except GitCommandError as e:
         logging.error(f"Error during repository restoration: {str(e)}")
@@ -58,85 +174,333 @@ def restore_git_repository(repo_restored_name, local_repo_path, token):
         logging.info("Removing temporary directory...")
         shutil.rmtree(local_repo_path)
 
+
 def find_git_folder(repo_path):
     git_folder = os.path.join(repo_path, '.git')
     if os.path.exists(git_folder) and os.path.isdir(git_folder):
         logging.info(f"Git folder found: {git_folder}")
         return git_folder
     else:
-      logging.warning("Local repository NOT FOUND!") 
+      logging.warning("Local repository NOT FOUND!")
       return None
 
-def create_local_path_from_backup_zip_file(zip_file_path):
+
+def is_git_payload(name):
+    """Whether an archive entry belongs to the repository content: the .git folder of a clone or a bundle chain."""
+    return '.git' in name.split('/')[:-1] or name.endswith('.bundle') or name == 'bundles.json'
+
+
+def check_backup_archive(archive):
+    if not all(backup_file_exists(archive, file) for file in REQUIRED_FILES) or find_issues_file(archive) is None:
+        raise RuntimeError("Required files are missing in the backup archive.")
+
+
+def extract_tar_backup(tar_file_path):
+    """Extract the git payload and the metadata files of a tar.gz or tar.zst backup in one pass.
+
+    A compressed tar is only read from start to end, its metadata cannot be read later
+    without decompressing it again, so it is extracted next to the payload."""
+    temp_dir = tempfile.mkdtemp(prefix='gh_restore_')
     try:
-        temp_dir = 'temp_restore'
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            logging.info(f"Removed existing temporary directory: {temp_dir}")
+        with open_tar_archive(tar_file_path) as tar_file:
+            for member in tar_file:
+                if is_git_payload(member.name) or member.name in METADATA_FILES:
+                    tar_file.extract(member, temp_dir, **EXTRACT_OPTIONS)
+        check_backup_archive(temp_dir)
+    except Exception:
+        shutil.rmtree(temp_dir)
+        raise
+    return temp_dir
 
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
 
-        required_files = ['issues.json', 'labels.json', 'repository.json']
-        if not all(os.path.exists(os.path.join(temp_dir, file)) for file in required_files):
-            raise RuntimeError("Required files are missing in the ZIP archive.")
+def create_local_path_from_backup_zip_file(zip_file_path):
+    """Extract the git payload of a backup archive into a new temporary directory and return it.
+
+    The metadata files are read from the archive directly and the checked out work tree
+    of a clone is skipped, git restores it from .git, so only the repository history is
+    written to disk. Every call gets its own directory and restores can run side by side.
+    The metadata files of a tar archive are extracted as well, see extract_tar_backup."""
+    try:
+        if get_archive_format(zip_file_path) != 'zip':
+            return extract_tar_backup(zip_file_path)
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            check_backup_archive(zip_ref)
+            temp_dir = tempfile.mkdtemp(prefix='gh_restore_')
+            try:
+                for member in zip_ref.infolist():
+                    if is_git_payload(member.filename):
+                        zip_ref.extract(member, temp_dir)
+            except Exception:
+                shutil.rmtree(temp_dir)
+                raise
 
         return temp_dir
 
     except FileNotFoundError as e:
         logging.error(f"File not found: {str(e)}")
-        raise RuntimeError("Failed to create local path from backup ZIP file.")
+        raise RuntimeError("Failed to create local path from backup archive.")
 
     except Exception as e:
-        logging.error(f"Error creating local path from backup ZIP file: {str(e)}")
-        raise RuntimeError("Failed to create local path from backup ZIP file.")
+        logging.error(f"Error creating local path from backup archive: {str(e)}")
+        raise RuntimeError("Failed to create local path from backup archive.")
+
 
 def find_git_folder(base_path):
-    for root, dirs, files in os.walk(base_path):
-        if '.git' in dirs:
-            return os.path.join(root, '.git')
+    git_folders = [os.path.join(root, '.git') for root, dirs, files in os.walk(base_path) if '.git' in dirs]
+    # Clone folders are named after the time they were taken, the newest one is restored
+    return max(git_folders) if git_folders else None
+
+
+def rebuild_repository_from_bundles(bundle_folder, target_path, until=None):
+    """Rebuild a bare repository from the bundles.json chain written by a bundle backup.
+
+    The bundles are fetched in order up to the last entry created at or before until
+    (a datetime, the newest entry when None) and the refs are then set to the ones that
+    entry recorded."""
+    with open(os.path.join(bundle_folder, "bundles.json"), "r") as file:
+        chain = json.load(file)["chain"]
+
+    entries = [entry for entry in chain if until is None or datetime.fromisoformat(entry["created_at"]) <= until]
+    if not entries:
+        raise RuntimeError("No bundle in the chain matches the requested point in time.")
+    # Archives of older versions only carry the bundle of their own run
+    missing = [entry["file"] for entry in entries if entry["file"] and not os.path.exists(os.path.join(bundle_folder, entry["file"]))]
+    if missing:
+        raise RuntimeError(f"Bundles of the chain missing from the backup: {', '.join(missing)}")
+
+    repo = Repo.init(target_path, bare=True)
+    for entry in entries:
+        if entry["file"]:
+            logging.info(f"Fetching {entry['type']} bundle {entry['file']}")
+            repo.git.fetch(os.path.join(bundle_folder, entry["file"]), "+refs/*:refs/*")
+
+    refs = entries[-1]["refs"]
+    existing_refs = {line.split(" ", 1)[1] for line in repo.git.for_each_ref("--format=%(objectname) %(refname)").splitlines()}
+    commands = [f"delete {ref}" for ref in sorted(existing_refs - refs.keys())]
+    commands += [f"update {ref} {sha}" for ref, sha in sorted(refs.items())]
+    subprocess.run(["git", "update-ref", "--stdin"], input="\n".join(commands) + "\n", text=True, cwd=target_path, check=True)
+
+    for default_branch in ("refs/heads/main", "refs/heads/master"):
+        if default_branch in refs:
+            repo.git.symbolic_ref("HEAD", default_branch)
+            break
+
+    logging.info(f"Repository rebuilt from {len(entries)} bundle(s) in {target_path}")
+    return target_path
+
+
+def backup_file_exists(backup, name):
+    if isinstance(backup, zipfile.ZipFile):
+        return name in backup.namelist()
+    return os.path.exists(os.path.join(backup, name))
+
+
+def open_backup_file(backup, name):
+    """Open a backup file for binary reading, from a backup folder or straight from its ZipFile."""
+    if isinstance(backup, zipfile.ZipFile):
+        return backup.open(name)
+    return open(os.path.join(backup, name), 'rb')
+
+
+def read_backup_json(backup, name):
+    with open_backup_file(backup, name) as file:
+        return json.load(file)
+
+
+def find_issues_file(backup):
+    for issues_file in ISSUES_FILES:
+        if backup_file_exists(backup, issues_file):
+            return issues_file
     return None
-        
-def restore_labels(repo, labels_data):
+
+
+def read_issues(backup):
+    """Yield the backed up issues one at a time, whatever format they were saved in."""
+    issues_file = find_issues_file(backup)
+    with open_backup_file(backup, issues_file) as file:
+        if issues_file.endswith('.json'):
+            yield from json.load(file)
+            return
+        lines = gzip.open(file, 'rt', encoding='utf-8') if issues_file.endswith('.gz') else io.TextIOWrapper(file, encoding='utf-8')
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_thread_github_client(access_token):
+    """Return the Github client owned by the calling thread.
+
+    PyGithub keeps a single connection object per client, so worker threads
+    must not share one."""
+    client = getattr(_thread_state, 'github', None)
+    if client is None:
+        client = build_github_client(get_default_governor(), get_default_cache(), auth=Auth.Token(access_token), per_page=100)
+        _thread_state.github = client
+        _thread_state.repositories = {}
+        _thread_state.organizations = {}
+    return client
+
+
+def get_thread_repository(repo, access_token):
+    """Return the repository bound to the Github client of the calling thread."""
+    if access_token is None:
+        return repo
+    client = get_thread_github_client(access_token)
+    repositories = _thread_state.repositories
+    if repo.full_name not in repositories:
+        # Rebuild the repository from the payload already fetched, no extra API call is made
+        repositories[repo.full_name] = client.create_from_raw_data(Repository, repo._rawData, repo._headers)
+    return repositories[repo.full_name]
+
+
+class RestoreCheckpoint:
+    """Journal of the objects a restore created, one JSON line appended per object.
+
+    Every line is flushed before the next create is reported, so a restore that is
+    interrupted resumes from the journal without creating the same object twice. The
+    first line names the org/repo restored into, see start, the journal of a restore
+    into another repository is not resumed."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.target = None
+        self.done = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            for entry in iter_ndjson(path):
+                if entry['kind'] == 'target':
+                    self.target = entry['key']
+                else:
+                    self.done[(entry['kind'], entry['key'])] = entry.get('number')
+
+    def start(self, target, reset=False):
+        """Bind the journal to the org/repo restored into.
+
+        The entries of a restore into another repository, of a journal that does not name
+        its target, or every entry with reset, are dropped and the journal starts over."""
+        with self.lock:
+            if self.target == target and not reset:
+                return
+            if self.done:
+                logging.info(f"Checkpoint {self.path} does not belong to a restore into {target}, starting over")
+            self.target = target
+            self.done = {}
+            if self.path:
+                with open(self.path, 'w') as file:
+                    file.write(json.dumps({'kind': 'target', 'key': target}) + '\n')
+                    file.flush()
+                    os.fsync(file.fileno())
+
+    def contains(self, kind, key):
+        with self.lock:
+            return (kind, key) in self.done
+
+    def record(self, kind, key, number=None):
+        with self.lock:
+            self.done[(kind, key)] = number
+            if self.path:
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps({'kind': kind, 'key': key, 'number': number}) + '\n')
+                    file.flush()
+                    os.fsync(file.fileno())
+
+    def remove(self):
+        """Drop the journal of a restore that completed, a later restore starts from scratch."""
+        with self.lock:
+            self.done = {}
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def run_bounded(function, items, workers):
+    """Call function on every item from a pool of workers and return the results in completion order.
+
+    At most twice as many items as workers are pulled from the iterable at a time, so a
+    streamed issues file is never held in memory."""
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(function, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+        results.extend(future.result() for future in pending)
+    return results
+
+
+def restore_labels(repo, labels_data, access_token=None, workers=RESTORE_WORKERS, checkpoint=None):
+    checkpoint = checkpoint or RestoreCheckpoint()
     existing_labels = {label.name.lower(): label for label in repo.get_labels()}
-    
-    for label_info in labels_data:
+
+    def restore_label(label_info):
         label_name = label_info['name'].lower()
-        
-        if label_name in existing_labels:
+
+        if label_name in existing_labels or checkpoint.contains('label', label_name):
             logging.info(f"Label {label_info['name']} already exists, skipping...")
-            continue
+            return 'skipped'
 
         try:
-            repo.create_label(label_info['name'], label_info['color'])
+            get_thread_repository(repo, access_token).create_label(label_info['name'], label_info['color'])
+            checkpoint.record('label', label_name)
             logging.info(f"Label {label_info['name']} created successfully.")
+            return 'created'
         except Exception as e:
             error_message = str(e)
             if "Validation Failed" in error_message and "already_exists" in error_message:
                 logging.warning(f"The label '{label_info['name']}' already exists, skipping creation.")
-            else:
-                logging.error(f"Error creating label {label_info['name']}: {e}")
+                checkpoint.record('label', label_name)
+                return 'skipped'
+            logging.error(f"Error creating label {label_info['name']}: {e}")
+            return 'failed'
 
+    results = run_bounded(restore_label, labels_data, workers)
+    logging.info(f"Labels restored: {results.count('created')} created, {results.count('skipped')} skipped, {results.count('failed')} failed")
+    return results
 
-def restore_issues(repo, issues_data):
-    existing_issues = {issue.title.lower(): issue for issue in repo.get_issues()}
 
-    for issue_info in issues_data:
-        issue_title = issue_info['title'].lower()
+def index_existing_issues(repo):
+    """Index every issue of the repository, open and closed, by the backed up issue it was restored from.
 
-        if issue_title in existing_issues:
+    Issues restored before the source marker existed are indexed by their lowercased title."""
+    by_source, by_title = {}, {}
+    for issue in repo.get_issues(state='all'):
+        match = SOURCE_ISSUE_PATTERN.search(issue.body or '')
+        if match:
+            by_source[int(match.group(1))] = issue.number
+        else:
+            by_title.setdefault(issue.title.lower(), issue.number)
+    return by_source, by_title
+
+
+def restore_issues(repo, issues_data, access_token=None, workers=RESTORE_WORKERS, checkpoint=None):
+    checkpoint = checkpoint or RestoreCheckpoint()
+    by_source, by_title = index_existing_issues(repo)
+
+    def restore_issue(issue_info):
+        source = issue_info['number']
+
+        if source in by_source or issue_info['title'].lower() in by_title or checkpoint.contains('issue', source):
             print(f"Issue {issue_info['title']} already exists, skipping...")
-            continue
+            return 'skipped'
 
+        body = issue_info['body'] or ''
         try:
-            repo.create_issue(
+            issue = get_thread_repository(repo, access_token).create_issue(
                 title=issue_info['title'],
-                body=issue_info['body'],
+                body=f"{body}\n\n{SOURCE_ISSUE_MARKER.format(source)}" if body else SOURCE_ISSUE_MARKER.format(source),
                 labels=issue_info['labels']
             )
+            checkpoint.record('issue', source, issue.number)
             print(f"Issue {issue_info['title']} created successfully.")
+            return 'created'
         except Exception as e:
             print(f"Error creating issue {issue_info['title']}: {e}")
+            return 'failed'
+
+    results = run_bounded(restore_issue, issues_data, workers)
+    logging.info(f"Issues restored: {results.count('created')} created, {results.count('skipped')} skipped, {results.count('failed')} failed")
+    return results
 
 
 def restore_repository(repo, repo_data):
@@ -147,56 +511,185 @@ def restore_repository(repo, repo_data):
         )
     except Exception as e:
         print(f"Error updating repository information: {e}")
-        
-def restore_organization_resources(org_name, access_token, backup_zip_file_path):
-    g = Github(access_token)
-    org = g.get_organization(org_name)
 
-    try:
-        backup_path = create_local_path_from_backup_zip_file(backup_zip_file_path)
 
-        if backup_path:
+def count_results(results):
+    return {status: results.count(status) for status in ('created', 'skipped', 'failed')}
+
+
+def restore_repository_archive(org, access_token, backup_zip_file_path, workers=RESTORE_WORKERS, checkpoint=None):
+    """Restore one backup archive into the organization and return what was restored."""
+    checkpoint = checkpoint or RestoreCheckpoint(f"{backup_zip_file_path}.checkpoint.ndjson")
+    backup_path = create_local_path_from_backup_zip_file(backup_zip_file_path)
+
+    # The metadata is read from a zip archive, only the git payload was extracted, a tar one had it extracted as well
+    archive = zipfile.ZipFile(backup_zip_file_path, 'r') if get_archive_format(backup_zip_file_path) == 'zip' else backup_path
+    try:
+        labels_data = read_backup_json(archive, "labels.json")
+        issues_data = read_issues(archive)
+        repo_data = read_backup_json(archive, "repository.json")
+
+        repo_name = repo_data['name']
+        current_date = datetime.today().strftime('%Y%m%d')
+        #repo_restored_name = f"repo_restored_{current_date}_{repo_name}"
+        repo_restored_name = f"{repo_name}"
+        checkpoint.start(f"{org.login}/{repo_restored_name}")
+        repo = None
+        if checkpoint.contains('repository', repo_restored_name):
             try:
-                with open(os.path.join(backup_path, "labels.json"), "r") as file:
-                    labels_data = json.load(file)
-
-                with open(os.path.join(backup_path, "issues.json"), "r") as file:
-                    issues_data = json.load(file)
-
-                with open(os.path.join(backup_path, "repository.json"), "r") as file:
-                    repo_data = json.load(file)
-
-                repo_name = repo_data['name']
-                current_date = datetime.today().strftime('%Y%m%d')
-                #repo_restored_name = f"repo_restored_{current_date}_{repo_name}"
-                repo_restored_name = f"{repo_name}"
-                org.create_repo(
-                        repo_restored_name,
-                        allow_rebase_merge=True,
-                        auto_init=False,
-                        description=repo_data['description'],
-                        has_issues=True,
-                        has_projects=False,
-                        has_wiki=False,
-                        private=True,
-                    )
-                
                 repo = org.get_repo(repo_restored_name)
-                restore_labels(repo, labels_data)
-                restore_issues(repo, issues_data)
-                restore_git_repository(repo_restored_name, backup_path, access_token)
-                
-            finally:
-                if os.path.exists(backup_path):
-                     logging.info("removing.....")
-                   # shutil.rmtree(backup_path)
+            except UnknownObjectException:
+                logging.warning(f"{org.login}/{repo_restored_name} was deleted since the interrupted restore, restoring it from the start")
+                checkpoint.start(f"{org.login}/{repo_restored_name}", reset=True)
+        if repo is None:
+            org.create_repo(
+                repo_restored_name,
+                allow_rebase_merge=True,
+                auto_init=False,
+                description=repo_data['description'],
+                has_issues=True,
+                has_projects=False,
+                has_wiki=False,
+                private=True,
+            )
+            checkpoint.record('repository', repo_restored_name)
+            repo = org.get_repo(repo_restored_name)
+
+        result = {
+            "restored_as": repo_restored_name,
+            "labels": count_results(restore_labels(repo, labels_data, access_token, workers, checkpoint)),
+            "issues": count_results(restore_issues(repo, issues_data, access_token, workers, checkpoint)),
+            "git": None
+        }
+
+        # A backup taken without -rc holds no history
+        if set(os.listdir(backup_path)) - set(METADATA_FILES):
+            remote_url = get_git_url(f'{org.login}/{repo_restored_name}', access_token)
+            summary = restore_git_repository(repo_restored_name, backup_path, access_token, remote_url)
+            result["git"] = summary or "failed"
+            if summary and summary["default_branch"] and summary["default_branch"] != repo.default_branch:
+                repo.edit(default_branch=summary["default_branch"])
+        # Only a restore with failures is resumed
+        if not result["labels"]["failed"] and not result["issues"]["failed"] and result["git"] != "failed":
+            checkpoint.remove()
+        return result
+
+    finally:
+        if isinstance(archive, zipfile.ZipFile):
+            archive.close()
+        if os.path.exists(backup_path):
+            logging.info("removing.....")
+            shutil.rmtree(backup_path)
 
-        else:
-            raise RuntimeError("Error creating local path from backup ZIP file.")
 
+def restore_organization_resources(org_name, access_token, backup_zip_file_path, workers=RESTORE_WORKERS, checkpoint_file=None):
+    g = build_github_client(get_default_governor(), get_default_cache(), auth=Auth.Token(access_token), per_page=100)
+    org = g.get_organization(org_name)
+
+    try:
+        checkpoint = RestoreCheckpoint(checkpoint_file or f"{backup_zip_file_path}.checkpoint.ndjson")
+        restore_repository_archive(org, access_token, backup_zip_file_path, workers, checkpoint)
     except RuntimeError as e:
         logging.error(str(e))
 
+    logging.info(f"GitHub API usage: {json.dumps(get_default_governor().report())}")
+
+
+def select_latest_archives(names):
+    """Map every repository to its newest archive among archive paths or blob names."""
+    latest = {}
+    for name in names:
+        parsed = parse_archive_name(name)
+        if not parsed:
+            continue
+        repository, key = parsed
+        # Archives are named <repository>_<YYYY-mm-dd>_<time>.<format>, the newest has the largest key
+        if repository not in latest or latest[repository][0] < key:
+            latest[repository] = (key, name)
+    return {repository: name for repository, (key, name) in latest.items()}
+
+
+def list_directory_archives(source_dir):
+    return select_latest_archives(os.path.join(root, file) for root, dirs, files in os.walk(source_dir) for file in files)
+
+
+def list_container_archives(container_client):
+    return select_latest_archives(blob.name for blob in container_client.list_blobs())
+
+
+def download_archive(container_client, blob_name, target_dir):
+    path = os.path.join(target_dir, os.path.basename(blob_name))
+    with open(path, 'wb') as file:
+        container_client.download_blob(blob_name).readinto(file)
+    return path
+
+
+def get_thread_organization(org_name, access_token):
+    client = get_thread_github_client(access_token)
+    organizations = _thread_state.organizations
+    if org_name not in organizations:
+        organizations[org_name] = client.get_organization(org_name)
+    return organizations[org_name]
+
+
+def restore_organization_archives(org_name, access_token, source_dir=None, container_client=None, repo_names=None,
+                                  repo_workers=REPOSITORY_WORKERS, workers=RESTORE_WORKERS, checkpoint_dir=None, report_file=None):
+    """Restore the newest archive of every repository found in source_dir, or in the Azure container.
+
+    repo_workers repositories are restored at a time, each with workers label and issue
+    workers, and every API request goes through the shared rate limit governor. Archives
+    are downloaded from the container one by one as their restore starts. Returns the
+    report, with the result of every repository, also written to report_file."""
+    archives = list_container_archives(container_client) if container_client is not None else list_directory_archives(source_dir)
+    if repo_names:
+        archives = {repository: archive for repository, archive in archives.items() if repository in repo_names}
+    logging.info(f"Restoring {len(archives)} repositories into {org_name}")
+
+    checkpoint_dir = checkpoint_dir or source_dir or 'restore_checkpoints'
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    download_dir = tempfile.mkdtemp(prefix='gh_restore_archives_') if container_client is not None else None
+
+    def restore_archive(repository, archive):
+        started = time.monotonic()
+        result = {"repository": repository, "archive": archive, "status": "restored"}
+        path = None
+        try:
+            org = get_thread_organization(org_name, access_token)
+            path = download_archive(container_client, archive, download_dir) if download_dir else archive
+            checkpoint = RestoreCheckpoint(os.path.join(checkpoint_dir, f"{repository}.checkpoint.ndjson"))
+            result.update(restore_repository_archive(org, access_token, path, workers, checkpoint))
+            if result["labels"]["failed"] or result["issues"]["failed"] or result["git"] == "failed":
+                result["status"] = "partial"
+        except Exception as e:
+            logging.error(f"Error restoring {repository} from {archive}: {e}")
+            result.update(status="failed", error=str(e))
+        finally:
+            if download_dir and path and os.path.exists(path):
+                os.remove(path)
+        result["seconds"] = round(time.monotonic() - started, 3)
+        logging.info(f"Repository {repository}: {result['status']} in {result['seconds']}s")
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=repo_workers) as executor:
+            futures = [executor.submit(restore_archive, repository, archive) for repository, archive in sorted(archives.items())]
+            results = sorted((future.result() for future in futures), key=lambda result: result["repository"])
+    finally:
+        if download_dir:
+            shutil.rmtree(download_dir)
+
+    report = {
+        "organization": org_name,
+        "repositories": results,
+        "totals": {status: sum(result["status"] == status for result in results) for status in ('restored', 'partial', 'failed')},
+        "api_usage": get_default_governor().report()
+    }
+    if report_file:
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent=4)
+    logging.info(f"Restore finished: {json.dumps(report['totals'])}")
+    return report
+
 
 if __name__ == "__main__":
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -204,12 +697,28 @@ if __name__ == "__main__":
         parser.add_argument('-o', '--org_name', type=str, help='GitHub organization name')
         parser.add_argument('-t', '--access_token', type=str, help='backup folder')
         parser.add_argument('-z', '--backup_zip_path', type=str, help='backup zip path')
+        parser.add_argument('-w', '--workers', type=int, default=int(os.getenv("GITHUB_RESTORE_WORKERS", RESTORE_WORKERS)), help='labels and issues created in parallel')
+        parser.add_argument('-c', '--checkpoint_file', type=str, help='journal of the created objects, an interrupted restore resumes from it (default: <backup_zip_path>.checkpoint.ndjson)')
+        parser.add_argument('-s', '--source_dir', type=str, help='restore the newest archive of every repository found in this directory')
+        parser.add_argument('-ac', '--azure_container', action='store_true', help='restore the newest archive of every repository published to the Azure container (AZURE_* settings)')
+        parser.add_argument('-r', '--repo_names', type=str, nargs='*', help='List of repository names to restore from the directory or container')
+        parser.add_argument('-rw', '--repo_workers', type=int, default=int(os.getenv("GITHUB_RESTORE_REPO_WORKERS", REPOSITORY_WORKERS)), help='repositories restored in parallel')
+        parser.add_argument('-cd', '--checkpoint_dir', type=str, help='checkpoints of an organization restore, one per repository (default: the source directory)')
+        parser.add_argument('-rp', '--report_file', type=str, default='restore_report.json', help='JSON report of an organization restore')
         args = parser.parse_args()
 
         org_name = args.org_name or os.environ.get("GITHUB_ORG")
         access_token = args.access_token or os.environ.get("GITHUB_ACCESS_TOKEN")
         backup_zip_path = args.backup_zip_path
-        if org_name is None or access_token is None or backup_zip_path is None:
-            raise ValueError("Please provide organization name, access token, and the backup.zip path")
-        
-        restore_organization_resources(org_name, access_token, backup_zip_path)
+        if org_name is None or access_token is None or (backup_zip_path is None and args.source_dir is None and not args.azure_container):
+            raise ValueError("Please provide organization name, access token, and the backup.zip path, a source directory or the Azure container")
+
+        if backup_zip_path:
+            restore_organization_resources(org_name, access_token, backup_zip_path, args.workers, args.checkpoint_file)
+        else:
+            container_client = None
+            if args.azure_container:
+                container_client = get_container_client(os.getenv("AZURE_ACCOUNT_NAME"), os.getenv("AZURE_ACCOUNT_KEY"),
+                                                        os.getenv("AZURE_CONTAINER_NAME"), os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+            restore_organization_archives(org_name, access_token, args.source_dir, container_client, args.repo_names,
+                                          args.repo_workers, args.workers, args.checkpoint_dir, args.report_file)
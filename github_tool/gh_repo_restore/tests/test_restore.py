@@ -2,8 +2,37 @@ import unittest
 import os
 import tempfile
 import shutil
+import time
+import threading
+import json
+import gzip
+import socket
+import uuid
+import tarfile
+import io
+import zipfile
+
+from datetime import datetime
+from unittest import mock
+
+from azure.storage.blob import BlobServiceClient
+from git import Repo
+
+from github_tool.gh_repo_restore import restore
+from github_tool.gh_repo_restore.restore import create_local_path_from_backup_zip_file, find_git_folder, rebuild_repository_from_bundles, read_issues, restore_issues, restore_labels, RestoreCheckpoint, read_backup_json, restore_git_repository
+from gh_repo_backup import backup
+from gh_repo_backup.backup import create_repository_bundle, load_bundle_manifest
+
+AZURITE_CONNECTION_STRING = os.getenv('AZURITE_CONNECTION_STRING', 'UseDevelopmentStorage=true')
+
+
+def azurite_available():
+    try:
+        with socket.create_connection(('127.0.0.1', 10000), timeout=0.5):
+            return True
+    except OSError:
+        return False
 
-from github_tool.gh_repo_restore.restore import create_local_path_from_backup_zip_file, find_git_folder
 
 class TestRestore(unittest.TestCase):
 
@@ -14,21 +43,55 @@ class TestRestore(unittest.TestCase):
         shutil.rmtree(self.temp_dir)
 
     def test_create_local_path_from_backup_zip_file(self):
-        # Crear un archivo de prueba ZIP
+        # Crear un archivo ZIP con la estructura de un backup
         zip_file_path = os.path.join(self.temp_dir, 'repo-test.zip')
-        with open(zip_file_path, 'w'):
-            pass  # Aquí deberías añadir contenido al archivo ZIP, como las carpetas y archivos esperados
+        with zipfile.ZipFile(zip_file_path, 'w') as zip_file:
+            zip_file.writestr('labels.json', '[]')
+            zip_file.writestr('issues.json', '[]')
+            zip_file.writestr('repository.json', '{"name": "repo-test"}')
+            zip_file.writestr('repo_cloned_1/.git/HEAD', 'ref: refs/heads/main\n')
+            zip_file.writestr('repo_cloned_1/README.md', 'work tree')
 
         # Ejecutar la función bajo prueba
         local_path = create_local_path_from_backup_zip_file(zip_file_path)
+        self.addCleanup(shutil.rmtree, local_path)
 
-        # Verificar si la carpeta local se creó correctamente
-        expected_local_path = os.path.join(self.temp_dir, 'temp_restore')
-        self.assertEqual(local_path, expected_local_path)
-        self.assertTrue(os.path.exists(local_path))
+        # Solo se extrae el contenido de git, en una carpeta propia de cada restauración
         self.assertTrue(os.path.isdir(local_path))
+        other_path = create_local_path_from_backup_zip_file(zip_file_path)
+        self.addCleanup(shutil.rmtree, other_path)
+        self.assertNotEqual(local_path, other_path)
+        self.assertTrue(os.path.isfile(os.path.join(local_path, 'repo_cloned_1', '.git', 'HEAD')))
+        self.assertFalse(os.path.exists(os.path.join(local_path, 'repo_cloned_1', 'README.md')))
+        self.assertFalse(os.path.exists(os.path.join(local_path, 'labels.json')))
+
+        with zipfile.ZipFile(zip_file_path) as archive:
+            self.assertEqual(read_backup_json(archive, 'repository.json'), {'name': 'repo-test'})
+            self.assertEqual(list(read_issues(archive)), [])
 
-        # También podrías verificar si los archivos esperados están presentes en la carpeta local
+    def test_tar_archive_is_extracted_in_one_pass(self):
+        tar_file_path = os.path.join(self.temp_dir, 'repo-test_2023-01-01_10-00-00-000000.tar.gz')
+        with tarfile.open(tar_file_path, 'w:gz') as tar_file:
+            for name, content in (('labels.json', '[]'), ('issues.json', '[]'), ('repository.json', '{"name": "repo-test"}'),
+                                  ('repo_cloned_1/.git/HEAD', 'ref: refs/heads/main\n'), ('repo_cloned_1/README.md', 'work tree')):
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                tar_file.addfile(member, io.BytesIO(content.encode()))
+
+        local_path = create_local_path_from_backup_zip_file(tar_file_path)
+        self.addCleanup(shutil.rmtree, local_path)
+
+        self.assertTrue(os.path.isfile(os.path.join(local_path, 'repo_cloned_1', '.git', 'HEAD')))
+        self.assertFalse(os.path.exists(os.path.join(local_path, 'repo_cloned_1', 'README.md')))
+        # The metadata of a tar is read from the extracted files
+        self.assertEqual(read_backup_json(local_path, 'repository.json'), {'name': 'repo-test'})
+
+    def test_create_local_path_requires_the_metadata(self):
+        zip_file_path = os.path.join(self.temp_dir, 'repo-test.zip')
+        with zipfile.ZipFile(zip_file_path, 'w') as zip_file:
+            zip_file.writestr('labels.json', '[]')
+        with self.assertRaises(RuntimeError):
+            create_local_path_from_backup_zip_file(zip_file_path)
 
     def test_find_git_folder(self):
         # Crear una estructura de carpeta con una carpeta .git de prueba
@@ -44,5 +107,340 @@ class TestRestore(unittest.TestCase):
         self.assertTrue(os.path.exists(git_folder))
         self.assertTrue(os.path.isdir(git_folder))
 
+
+class TestReadIssues(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.issues = [{'number': 2, 'title': 'b'}, {'number': 1, 'title': 'a'}]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_json(self):
+        with open(os.path.join(self.temp_dir, 'issues.json'), 'w') as file:
+            json.dump(self.issues, file, indent=4)
+        self.assertEqual(list(read_issues(self.temp_dir)), self.issues)
+
+    def test_compressed_ndjson_in_archive(self):
+        zip_file_path = os.path.join(self.temp_dir, 'backup.zip')
+        with zipfile.ZipFile(zip_file_path, 'w') as zip_file:
+            zip_file.writestr('issues.ndjson.gz', gzip.compress(''.join(json.dumps(issue) + '\n' for issue in self.issues).encode()))
+        with zipfile.ZipFile(zip_file_path) as archive:
+            self.assertEqual(list(read_issues(archive)), self.issues)
+
+    def test_compressed_ndjson(self):
+        with gzip.open(os.path.join(self.temp_dir, 'issues.ndjson.gz'), 'wt') as file:
+            for issue in self.issues:
+                file.write(json.dumps(issue) + '\n')
+        issues = read_issues(self.temp_dir)
+        self.assertEqual(next(issues), self.issues[0])
+        self.assertEqual(list(issues), self.issues[1:])
+
+
+def make_issue(number, title, body=None):
+    issue = mock.MagicMock()
+    issue.number = number
+    issue.title = title
+    issue.body = body
+    return issue
+
+
+class TestRestoreIssues(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.temp_dir, 'checkpoint.ndjson')
+        self.repo = mock.MagicMock()
+        self.created = []
+
+        def create_issue(title, body, labels):
+            self.created.append((title, body))
+            return make_issue(100 + len(self.created), title, body)
+        self.repo.create_issue.side_effect = create_issue
+        self.backed_up = [{'number': number, 'title': f'Issue {number}', 'body': f'body {number}', 'labels': []} for number in range(1, 7)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_closed_and_previously_restored_issues_are_not_recreated(self):
+        self.repo.get_issues.return_value = [
+            make_issue(10, 'Renamed later', 'body 1\n\n<!-- gh-backup source-issue: 1 -->'),
+            make_issue(11, 'issue 2'),
+        ]
+        results = restore_issues(self.repo, iter(self.backed_up), workers=3, checkpoint=RestoreCheckpoint(self.checkpoint_file))
+
+        self.repo.get_issues.assert_called_once_with(state='all')
+        self.assertEqual(results.count('skipped'), 2)
+        self.assertEqual(sorted(title for title, body in self.created), ['Issue 3', 'Issue 4', 'Issue 5', 'Issue 6'])
+        self.assertIn('body 3\n\n<!-- gh-backup source-issue: 3 -->', [body for title, body in self.created])
+
+    def test_interrupted_restore_resumes_from_the_checkpoint(self):
+        self.repo.get_issues.return_value = []
+        checkpoint = RestoreCheckpoint(self.checkpoint_file)
+        restore_issues(self.repo, iter(self.backed_up[:2]), workers=2, checkpoint=checkpoint)
+        self.created.clear()
+
+        results = restore_issues(self.repo, iter(self.backed_up), workers=2, checkpoint=RestoreCheckpoint(self.checkpoint_file))
+        self.assertEqual(results.count('skipped'), 2)
+        self.assertEqual(sorted(title for title, body in self.created), ['Issue 3', 'Issue 4', 'Issue 5', 'Issue 6'])
+
+    def test_labels_are_created_once(self):
+        existing = mock.MagicMock()
+        existing.name = 'Bug'
+        self.repo.get_labels.return_value = [existing]
+        labels = [{'name': 'bug', 'color': 'ff0000'}, {'name': 'docs', 'color': '00ff00'}, {'name': 'help', 'color': '0000ff'}]
+        restore_labels(self.repo, labels, workers=2, checkpoint=RestoreCheckpoint(self.checkpoint_file))
+        restore_labels(self.repo, labels, workers=2, checkpoint=RestoreCheckpoint(self.checkpoint_file))
+
+        self.assertEqual(sorted(call.args[0] for call in self.repo.create_label.call_args_list), ['docs', 'help'])
+
+
+class TestRestoreRepositoryArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.archive = os.path.join(self.temp_dir, 'repo-test_2023-01-01.zip')
+        with zipfile.ZipFile(self.archive, 'w') as zip_file:
+            zip_file.writestr('labels.json', '[{"name": "bug", "color": "ff0000"}]')
+            zip_file.writestr('issues.json', '[]')
+            zip_file.writestr('repository.json', '{"name": "repo-test", "description": "A"}')
+        self.checkpoint_file = f'{self.archive}.checkpoint.ndjson'
+        self.repo = mock.MagicMock()
+        self.repo.get_labels.return_value = []
+        self.repo.get_issues.return_value = []
+        self.org = mock.MagicMock()
+        self.org.login = 'org'
+        self.org.get_repo.return_value = self.repo
+
+    def interrupted_restore(self, target):
+        checkpoint = RestoreCheckpoint(self.checkpoint_file)
+        checkpoint.start(target)
+        checkpoint.record('repository', 'repo-test')
+        checkpoint.record('label', 'bug')
+
+    def test_checkpoint_of_another_organization_is_not_resumed(self):
+        self.interrupted_restore('other-org/repo-test')
+
+        result = restore.restore_repository_archive(self.org, None, self.archive, workers=1)
+
+        self.org.create_repo.assert_called_once()
+        self.assertEqual(result['labels'], {'created': 1, 'skipped': 0, 'failed': 0})
+        # A restore that completed leaves no checkpoint behind
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_repository_deleted_since_the_interrupted_restore_is_created_again(self):
+        self.interrupted_restore('org/repo-test')
+        self.org.get_repo.side_effect = [restore.UnknownObjectException(404, {}, {}), self.repo]
+
+        result = restore.restore_repository_archive(self.org, None, self.archive, workers=1)
+
+        self.org.create_repo.assert_called_once()
+        self.assertEqual(result['labels']['created'], 1)
+
+    def test_interrupted_restore_into_the_same_repository_is_resumed(self):
+        self.interrupted_restore('org/repo-test')
+
+        result = restore.restore_repository_archive(self.org, None, self.archive, workers=1)
+
+        self.org.create_repo.assert_not_called()
+        self.assertEqual(result['labels']['skipped'], 1)
+
+
+class TestRebuildFromBundles(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.mirror = Repo.init(os.path.join(self.temp_dir, 'mirror'), initial_branch='main')
+        self.mirror.git.config('user.email', 'test@example.com')
+        self.mirror.git.config('user.name', 'test')
+        self.backup_folder = os.path.join(self.temp_dir, 'backup')
+        os.makedirs(self.backup_folder)
+        self.repo = mock.MagicMock()
+        self.repo.name = 'repo'
+        self.repo.full_name = 'org/repo'
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def commit_and_bundle(self, message):
+        self.mirror.git.commit('--allow-empty', '-m', message)
+        create_repository_bundle(self.repo, self.backup_folder, self.mirror.working_dir)
+        time.sleep(1)
+        return self.mirror.head.commit.hexsha
+
+    def test_rebuild_latest_and_point_in_time(self):
+        first = self.commit_and_bundle('first')
+        self.mirror.git.tag('v1')
+        self.mirror.git.branch('feature')
+        second = self.commit_and_bundle('second')
+        self.mirror.git.branch('-D', 'feature')
+        third = self.commit_and_bundle('third')
+
+        chain = load_bundle_manifest(self.backup_folder)['chain']
+        self.assertEqual([entry['type'] for entry in chain], ['full', 'incremental', 'incremental'])
+
+        latest = Repo(rebuild_repository_from_bundles(self.backup_folder, os.path.join(self.temp_dir, 'latest')))
+        self.assertEqual(latest.git.rev_parse('main'), third)
+        self.assertEqual(latest.git.rev_parse('v1'), first)
+        self.assertNotIn('feature', [head.name for head in latest.heads])
+
+        until = datetime.fromisoformat(chain[1]['created_at'])
+        middle = Repo(rebuild_repository_from_bundles(self.backup_folder, os.path.join(self.temp_dir, 'middle'), until))
+        self.assertEqual(middle.git.rev_parse('main'), second)
+        self.assertIn('feature', [head.name for head in middle.heads])
+
+
+class TestRestoreGitRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.origin = Repo.init(os.path.join(self.temp_dir, 'origin'), initial_branch='main')
+        self.origin.git.config('user.email', 'test@example.com')
+        self.origin.git.config('user.name', 'test')
+        for message in ('first', 'second', 'third', 'fourth'):
+            self.origin.git.commit('--allow-empty', '-m', message)
+            if message == 'second':
+                self.origin.git.tag('v1')
+                self.origin.git.branch('feature')
+        self.backup_folder = os.path.join(self.temp_dir, 'backup')
+        self.target = Repo.init(os.path.join(self.temp_dir, 'target.git'), bare=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def target_refs(self):
+        output = self.target.git.for_each_ref('--format=%(refname) %(objectname)')
+        return dict(line.split(' ') for line in output.splitlines())
+
+    def expected_refs(self):
+        return {
+            'refs/heads/main': self.origin.git.rev_parse('main'),
+            'refs/heads/feature': self.origin.git.rev_parse('feature'),
+            'refs/tags/v1': self.origin.git.rev_parse('v1'),
+        }
+
+    def test_every_branch_and_tag_of_a_clone_is_pushed(self):
+        Repo.clone_from(self.origin.working_dir, os.path.join(self.backup_folder, 'repo_cloned_repo_2023-01-01_00-00-00'))
+        summary = restore_git_repository('repo', self.backup_folder, None, remote_url=self.target.git_dir)
+
+        self.assertEqual(self.target_refs(), self.expected_refs())
+        self.assertEqual(summary['pushes'], 1)
+        self.assertEqual(summary['default_branch'], 'main')
+        self.assertFalse(os.path.exists(self.backup_folder))
+
+    def test_large_repositories_are_pushed_in_steps(self):
+        Repo.clone_from(self.origin.working_dir, os.path.join(self.backup_folder, 'repo_cloned_repo_2023-01-01_00-00-00'))
+        summary = restore_git_repository('repo', self.backup_folder, None, remote_url=self.target.git_dir, max_push_bytes=1)
+
+        self.assertGreater(summary['pushes'], 1)
+        self.assertEqual(self.target_refs(), self.expected_refs())
+
+    def test_bundle_chain_is_pushed(self):
+        os.makedirs(self.backup_folder)
+        repo = mock.MagicMock()
+        repo.name = 'repo'
+        repo.full_name = 'org/repo'
+        create_repository_bundle(repo, self.backup_folder, self.origin.working_dir)
+        restore_git_repository('repo', self.backup_folder, None, remote_url=self.target.git_dir)
+
+        self.assertEqual(self.target_refs(), self.expected_refs())
+
+    def test_newest_bundle_archive_restores_on_its_own(self):
+        repo = mock.MagicMock()
+        repo.name = 'repo'
+        repo.full_name = 'org/repo'
+        repo_folder = os.path.join(self.backup_folder, 'repo')
+        os.makedirs(repo_folder)
+        for name, data in (('repository.json', {'name': 'repo'}), ('labels.json', []), ('issues.json', [])):
+            with open(os.path.join(repo_folder, name), 'w') as file:
+                json.dump(data, file)
+        archives = []
+        for message in ('fifth', 'sixth'):
+            self.origin.git.commit('--allow-empty', '-m', message)
+            create_repository_bundle(repo, repo_folder, self.origin.working_dir)
+            archives.append(backup.compress_directory(repo_folder, backup.bundle_archive_files(repo_folder)))
+            time.sleep(1)
+        self.assertEqual([entry['type'] for entry in load_bundle_manifest(repo_folder)['chain']], ['full', 'incremental'])
+        # Only the newest archive is left, as restore_organization_archives would pick it
+        shutil.rmtree(repo_folder)
+
+        summary = restore_git_repository('repo', create_local_path_from_backup_zip_file(archives[-1]), None, remote_url=self.target.git_dir)
+
+        self.assertIsNotNone(summary)
+        self.assertEqual(self.target_refs(), self.expected_refs())
+
+
+class TestRestoreOrganizationArchives(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, 'backups')
+        for name in ('org/a/a_2023-01-01.zip', 'org/a/a_2023-02-01.zip', 'org/b/b_2023-01-15.zip', 'org/my_repo/my_repo_2023-01-01.zip',
+                     'org/a/a_2023-02-01.zip.checkpoint.ndjson', 'org/upload_manifest.json'):
+            path = os.path.join(self.source_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as file:
+                file.write(name)
+        patcher = mock.patch.object(restore, 'get_thread_organization', return_value=mock.MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_newest_archive_of_every_repository_is_selected(self):
+        archives = restore.list_directory_archives(self.source_dir)
+        self.assertEqual({repository: os.path.basename(path) for repository, path in archives.items()},
+                         {'a': 'a_2023-02-01.zip', 'b': 'b_2023-01-15.zip', 'my_repo': 'my_repo_2023-01-01.zip'})
+
+    def test_archives_named_after_their_time_are_newer_than_the_ones_of_their_day(self):
+        names = ['a/a_2023-02-01.zip', 'a/a_2023-02-01_09-00-00-000000.tar.gz', 'a/a_2023-02-01_08-00-00-000000.zip']
+        self.assertEqual(restore.select_latest_archives(names), {'a': 'a/a_2023-02-01_09-00-00-000000.tar.gz'})
+
+    def test_repositories_are_restored_concurrently_with_a_report(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def restore_archive(org, access_token, path, workers, checkpoint):
+            barrier.wait()
+            if path.endswith('b_2023-01-15.zip'):
+                raise RuntimeError('Required files are missing in the ZIP archive.')
+            failed = 1 if 'my_repo' in path else 0
+            return {'labels': {'created': 1, 'skipped': 0, 'failed': 0}, 'issues': {'created': 2, 'skipped': 0, 'failed': failed}, 'git': None}
+
+        report_file = os.path.join(self.temp_dir, 'report.json')
+        with mock.patch.object(restore, 'restore_repository_archive', side_effect=restore_archive):
+            report = restore.restore_organization_archives('org', 'token', self.source_dir, repo_workers=3, report_file=report_file)
+
+        self.assertEqual([(result['repository'], result['status']) for result in report['repositories']],
+                         [('a', 'restored'), ('b', 'failed'), ('my_repo', 'partial')])
+        self.assertEqual(report['totals'], {'restored': 1, 'partial': 1, 'failed': 1})
+        with open(report_file) as file:
+            self.assertEqual(json.load(file)['repositories'][1]['error'], 'Required files are missing in the ZIP archive.')
+
+    @unittest.skipUnless(azurite_available(), 'Azurite is not running, see scripts/install_azurite.sh')
+    def test_archives_are_downloaded_from_the_container(self):
+        service = BlobServiceClient.from_connection_string(AZURITE_CONNECTION_STRING)
+        container_client = service.create_container(f'restore-{uuid.uuid4().hex}')
+        self.addCleanup(container_client.delete_container)
+        for name in ('a_2023-01-01.zip', 'a_2023-02-01.zip', 'b_2023-01-15.zip', 'upload_manifest.json'):
+            container_client.upload_blob(name=name, data=name.encode())
+
+        downloaded = {}
+
+        def restore_archive(org, access_token, path, workers, checkpoint):
+            with open(path) as file:
+                downloaded[os.path.basename(path)] = file.read()
+            return {'labels': {'failed': 0}, 'issues': {'failed': 0}, 'git': None}
+
+        with mock.patch.object(restore, 'restore_repository_archive', side_effect=restore_archive):
+            report = restore.restore_organization_archives('org', 'token', container_client=container_client,
+                                                           checkpoint_dir=os.path.join(self.temp_dir, 'checkpoints'))
+
+        self.assertEqual(downloaded, {'a_2023-02-01.zip': 'a_2023-02-01.zip', 'b_2023-01-15.zip': 'b_2023-01-15.zip'})
+        self.assertEqual(report['totals']['restored'], 2)
+
+
 if __name__ == '__main__':
     unittest.main()
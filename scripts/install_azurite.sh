@@ -1,3 +1,7 @@
 npm install -g azurite
 
-azurite --silent --location c:\azurite --debug c:\azurite\debug.log
+AZURITE_LOCATION="${AZURITE_LOCATION:-/tmp/azurite}"
+mkdir -p "$AZURITE_LOCATION"
+
+# The Azurite tests connect with AZURITE_CONNECTION_STRING (default: UseDevelopmentStorage=true)
+azurite --silent --location "$AZURITE_LOCATION" --debug "$AZURITE_LOCATION/debug.log"